@@ -22,11 +22,8 @@ if os.environ.get('HXL_PROXY_CONFIG'):
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 
-# Set up cache
-cache = Cache(app,config={
-    'CACHE_TYPE': 'simple',
-    'CACHE_DEFAULT_TIMEOUT': 3600
-})
+# Set up cache (backend chosen by the CACHE_* config options)
+cache = Cache(app)
 
 # Needed to register annotations
 import hxl_proxy.controllers
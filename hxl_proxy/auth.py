@@ -7,7 +7,7 @@ Started 2015-12 by David Megginson.
 import random
 import requests
 from flask import session
-from hxl_proxy import app
+from hxl_proxy import app, upstream
 
 def get_hid_login_url ():
     """Construct the URL for logging into Humanitarian ID."""
@@ -35,7 +35,8 @@ def get_hid_user (code):
     headers = {
         #'Authorization': 'Basic {secret}'.format(secret=app.config.get('HID_CLIENT_SECRET'))
     }
-    response = requests.post(
+    response = upstream.request(
+        'POST',
         '{base_url}/oauth/access_token'.format(
             base_url = app.config.get('HID_BASE_URL')
         ), 
@@ -50,7 +51,8 @@ def get_hid_user (code):
 
     access_data = response.json()
 
-    response = requests.get(
+    response = upstream.request(
+        'GET',
         '{base_url}/account.json?access_token={access_token}'.format(
             base_url = app.config.get('HID_BASE_URL'),
             access_token = requests.utils.quote(access_data['access_token'])
@@ -0,0 +1,193 @@
+"""
+Extra Flask-Cache backends for the HXL Proxy.
+
+Flask-Cache's 'simple' backend is an unbounded dict inside each WSGI
+worker, so workers never share hits and nothing limits the memory it
+uses. L{SQLiteCache} keeps entries in a single SQLite3 file instead,
+so every process on the host shares the same cache, and the total size
+of the stored values stays under a byte budget (least-recently-used
+entries go first).
+
+Reads stay cheap: a hit records its access time only if the stored one
+is more than L{SQLiteCache.ACCESS_INTERVAL} seconds old, so most hits
+don't write at all, and triggers keep a running total of the stored
+sizes, so a write doesn't have to add up the whole table.
+
+To use it, set the Flask config option C{CACHE_TYPE} to
+C{hxl_proxy.cache_backends.sqlite}. The built-in Flask-Cache types
+(e.g. C{memcached} or C{redis}) still work for multi-host setups.
+
+This module must not import hxl_proxy, because Flask-Cache loads it
+while the application object is still being set up.
+"""
+
+import contextlib, pickle, sqlite3, time
+
+from werkzeug.contrib.cache import BaseCache
+
+
+class SQLiteCache(BaseCache):
+    """Cache stored in a SQLite3 file, with per-entry TTLs and LRU eviction."""
+
+    ACCESS_INTERVAL = 60
+    """Seconds before a hit updates an entry's access time again (so LRU order is only this precise)."""
+
+    SCHEMA = """
+    begin immediate;
+    create table if not exists CacheEntries (
+           key text primary key,
+           value blob not null,
+           size integer not null,
+           expires real not null,
+           accessed real not null
+    );
+    create index if not exists CacheEntriesAccessed on CacheEntries(accessed);
+    create index if not exists CacheEntriesExpires on CacheEntries(expires);
+    create table if not exists CacheSize (
+           id integer primary key check (id = 0),
+           total integer not null
+    );
+    insert or ignore into CacheSize (id, total) select 0, coalesce(sum(size), 0) from CacheEntries;
+    create trigger if not exists CacheEntriesInsert after insert on CacheEntries begin
+           update CacheSize set total = total + new.size where id = 0;
+    end;
+    create trigger if not exists CacheEntriesDelete after delete on CacheEntries begin
+           update CacheSize set total = total - old.size where id = 0;
+    end;
+    commit;
+    """
+    """SQL to create the cache tables (safe to run more than once)."""
+
+    def __init__(self, path, max_bytes=None, default_timeout=300):
+        """Open (and if necessary, create) a cache file.
+        @param path: the filename of the SQLite3 cache file.
+        @param max_bytes: the maximum total size of the pickled values, or None for no limit.
+        @param default_timeout: the default TTL in seconds (0 means never expire).
+        """
+        super(SQLiteCache, self).__init__(default_timeout)
+        self.path = path
+        self.max_bytes = max_bytes
+        with self._transaction() as connection:
+            # write-ahead logging lets readers carry on while another process writes
+            connection.execute('pragma journal_mode=wal')
+            connection.executescript(self.SCHEMA)
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        """Look up several keys with one query.
+        Writes only if some of the entries have expired, or need a new access time.
+        """
+        now = time.time()
+        values = {}
+        expired = []
+        accessed = []
+        with self._transaction() as connection:
+            rows = connection.execute(
+                'select key, value, expires, accessed from CacheEntries where key in ({})'.format(', '.join('?' * len(keys))),
+                keys
+            ).fetchall()
+            for key, value, expires, last_accessed in rows:
+                if self._is_expired(expires, now):
+                    expired.append((key,))
+                else:
+                    values[key] = value
+                    if last_accessed <= now - self.ACCESS_INTERVAL:
+                        accessed.append((now, key,))
+            if expired:
+                connection.executemany('delete from CacheEntries where key=?', expired)
+            if accessed:
+                connection.executemany('update CacheEntries set accessed=? where key=?', accessed)
+        return [pickle.loads(values[key]) if key in values else None for key in keys]
+
+    def set(self, key, value, timeout=None):
+        return self._put('insert or replace', key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self._put('insert or ignore', key, value, timeout)
+
+    def delete(self, key):
+        with self._transaction() as connection:
+            return connection.execute('delete from CacheEntries where key=?', (key,)).rowcount > 0
+
+    def has(self, key):
+        with self._transaction() as connection:
+            row = connection.execute('select expires from CacheEntries where key=?', (key,)).fetchone()
+        return row is not None and not self._is_expired(row[0], time.time())
+
+    def clear(self):
+        with self._transaction() as connection:
+            connection.execute('delete from CacheEntries')
+        return True
+
+    def _put(self, verb, key, value, timeout):
+        """Insert a value, then evict entries to get back under budget.
+        @param verb: the SQL insert statement to use ('insert or replace' or 'insert or ignore')
+        @return: True if the value was stored.
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        timeout = self._normalize_timeout(timeout)
+        expires = now + timeout if timeout else 0
+        with self._transaction() as connection:
+            # an expired entry shouldn't block add()
+            connection.execute('delete from CacheEntries where key=? and expires>0 and expires<=?', (key, now,))
+            if self.max_bytes and len(data) > self.max_bytes:
+                # would push everything else out, and still not fit
+                connection.execute('delete from CacheEntries where key=?', (key,))
+                return False
+            stored = connection.execute(
+                verb + ' into CacheEntries (key, value, size, expires, accessed) values (?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(data), len(data), expires, now,)
+            ).rowcount > 0
+            self._evict(connection, now)
+        return stored
+
+    def _evict(self, connection, now):
+        """Remove expired entries, then least-recently-used ones until under max_bytes."""
+        connection.execute('delete from CacheEntries where expires>0 and expires<=?', (now,))
+        if not self.max_bytes:
+            return
+        total = connection.execute('select total from CacheSize where id=0').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, size in connection.execute('select key, size from CacheEntries order by accessed'):
+            victims.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        connection.executemany('delete from CacheEntries where key=?', victims)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Open a connection for a single transaction, commit, and close it.
+        A new connection each time keeps the cache safe to use from
+        multiple threads and processes.
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        # so that the delete trigger also sees rows that "insert or replace" removes
+        connection.execute('pragma recursive_triggers=on')
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _is_expired(expires, now):
+        return expires > 0 and expires <= now
+
+
+def sqlite(app, config, args, kwargs):
+    """Flask-Cache factory for L{SQLiteCache}.
+    Uses the C{CACHE_SQLITE_FILE} and C{CACHE_MAX_BYTES} config options.
+    """
+    kwargs.update(dict(
+        path=config.get('CACHE_SQLITE_FILE', '/tmp/hxl-proxy-cache.db'),
+        max_bytes=config.get('CACHE_MAX_BYTES')
+    ))
+    return SQLiteCache(*args, **kwargs)
+
+# end
@@ -0,0 +1,357 @@
+"""
+Response caching for the HXL Proxy.
+
+Flask-Cache's @cached decorator stores a finished response object,
+which means materialising the whole transformed dataset before the
+first byte goes out. The functions in this module cache the response
+body as it streams to the client instead, so that a download starts
+as soon as the filter pipeline produces its first row.
+
+Cache entries are plain dicts (body, mimetype, headers), so that they
+can go into any Flask-Cache backend.
+
+Each entry also remembers the version of every recipe and source URL
+it depends on (see L{get_dependencies}). Saving a recipe or forcing a
+refresh just assigns a new version to that recipe or URL, so that only
+the entries built from the old version stop matching.
+
+Responses carry a strong ETag and a Last-Modified date, so that
+clients polling the same data can get a 304 answer straight from the
+cache. When the upstream servers sent their own validators, the entry
+keeps them, and every C{UPSTREAM_CHECK_INTERVAL} seconds we ask
+upstream whether the data changed before serving the entry again.
+
+An entry is fresh for C{CACHE_DEFAULT_TIMEOUT} seconds, but stays in
+the cache for another C{CACHE_STALE_TIMEOUT} seconds. A caller that
+passes a revalidate function to L{get_response} gets a stale entry
+(past its freshness, or from source data that has changed since)
+straight away, while the function rebuilds it in the background. A new
+version of the recipe itself always means a miss.
+
+To stop a burst of requests for the same missing entry from all
+running the same pipeline, the first one claims the key with
+L{start_flight}, and the others L{wait_for_flight} and then take its
+result from the cache.
+"""
+
+import calendar, concurrent.futures, flask, hashlib, json, threading, time, uuid, werkzeug.http
+
+from hxl_proxy import app, cache, fetch
+
+_RECIPE_VERSION_PREFIX = 'version:recipe:'
+_URL_VERSION_PREFIX = 'version:url:'
+
+_revalidation_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=app.config.get('CACHE_REVALIDATE_MAX_WORKERS') or 1
+)
+
+# Keys that a request or background thread is computing now: (event, start time), by cache key
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_response(key, revalidate=None):
+    """Look up a cached response.
+    Answers with 304 Not Modified if the request's If-None-Match or
+    If-Modified-Since headers match the cached entry.
+    @param key: the cache key (see L{hxl_proxy.util.make_cache_key}).
+    @param revalidate: (optional) a function that rebuilds and caches the
+    response. If there is one, a stale entry comes back too (with a
+    Warning header), and the function runs in the background, unless
+    something is already computing this key.
+    @return: a Flask response object, or None if there's nothing usable in the cache.
+    """
+    entry, fresh = _get_entry(key)
+    if entry is None:
+        return None
+    headers = dict(entry['headers'])
+    if not fresh:
+        if revalidate is None or not app.config.get('CACHE_STALE_TIMEOUT'):
+            return None
+        _start_revalidation(key, revalidate)
+        headers['Warning'] = '110 - "Response is Stale"'
+    response = flask.Response(entry['body'], mimetype=entry['mimetype'], headers=headers)
+    return _make_conditional(response, entry['etag'], entry['last_modified'])
+
+def get_body(key):
+    """Look up the body of a cached response (e.g. to reuse a JSON result inside a page).
+    @param key: the cache key (see L{hxl_proxy.util.make_cache_key}).
+    @return: the body as a string, or None if there's nothing in the cache.
+    """
+    entry, fresh = _get_entry(key)
+    return entry['body'] if fresh else None
+
+def cache_response(key, body, mimetype='text/html', headers={}, dependencies={}, upstream={}):
+    """Cache a response body that is already complete (e.g. a rendered template).
+    @param key: the cache key.
+    @param body: the full response body, as a string.
+    @param mimetype: the MIME type for the response.
+    @param headers: a dict of extra HTTP headers for the response.
+    @param dependencies: versions from L{get_dependencies}, taken before building the body.
+    @param upstream: a dict of source URLs and their validators (see L{get_upstream_validators}).
+    @return: a Flask response object.
+    """
+    entry = store_response(key, body, mimetype, headers, dependencies, upstream)
+    response = flask.Response(body, mimetype=mimetype, headers=headers)
+    return _make_conditional(response, entry['etag'], entry['last_modified'])
+
+def stream_response(key, chunks, mimetype, headers={}, dependencies={}, upstream={}, flight=None):
+    """Stream a response to the client, caching the body once it's complete.
+    Nothing is cached if the client disconnects early, or if the body grows
+    beyond the C{CACHE_MAX_ENTRY_SIZE} config option. The response has an
+    ETag only if every upstream source sent validators, since otherwise
+    we don't know it until the body is finished.
+    @param key: the cache key.
+    @param chunks: an iterator over string chunks (e.g. from gen_csv).
+    @param mimetype: the MIME type for the response.
+    @param headers: a dict of extra HTTP headers for the response.
+    @param dependencies: versions from L{get_dependencies}, taken before starting the pipeline.
+    @param upstream: a dict of source URLs and their validators (see L{get_upstream_validators}).
+    @param flight: (optional) the token from L{start_flight}, to finish when the stream ends.
+    @return: a streaming Flask response object.
+    """
+    response = flask.Response(
+        flask.stream_with_context(_tee_to_cache(key, chunks, mimetype, headers, dependencies, upstream, flight)),
+        mimetype=mimetype,
+        headers=headers
+    )
+    if _is_complete(upstream):
+        response = _make_conditional(
+            response, _make_etag(key, dependencies, upstream), _get_last_modified(upstream, time.time())
+        )
+    return response
+
+def store_response(key, body, mimetype, headers={}, dependencies={}, upstream={}):
+    """Save a complete response body in the cache.
+    @return: the new cache entry.
+    """
+    now = time.time()
+    fresh_timeout = app.config.get('CACHE_DEFAULT_TIMEOUT')
+    entry = {
+        'body': body,
+        'mimetype': mimetype,
+        'headers': dict(headers),
+        'dependencies': dict(dependencies),
+        'upstream': dict(upstream),
+        'etag': _make_etag(key, dependencies, upstream, body),
+        'last_modified': _get_last_modified(upstream, now),
+        'fresh_until': now + fresh_timeout if fresh_timeout else None
+    }
+    if fresh_timeout:
+        # keep it around after it goes stale, for stale-while-revalidate
+        cache.set(key, entry, timeout=fresh_timeout + (app.config.get('CACHE_STALE_TIMEOUT') or 0))
+    else:
+        cache.set(key, entry)
+    cache.set(_checked_key(key), now)
+    return entry
+
+def get_upstream_validators(urls):
+    """Collect the upstream validators for a pipeline's source URLs.
+    Call this after the pipeline has opened its sources.
+    @param urls: the upstream URLs (see L{hxl_proxy.filters.get_source_urls}).
+    @return: a dict of URLs and their validators (see L{hxl_proxy.fetch.get_validators}).
+    """
+    return {url: fetch.get_validators(url) for url in urls}
+
+def get_dependencies(recipe_id=None, urls=[]):
+    """Snapshot the current versions of a recipe and its source URLs.
+    Take the snapshot I{before} running the pipeline, so that an
+    invalidation that arrives mid-stream still wins.
+    @param recipe_id: the saved recipe's id, or None for an unsaved recipe.
+    @param urls: the upstream URLs (see L{hxl_proxy.filters.get_source_urls}).
+    @return: a dict of version keys and values, to pass to L{stream_response} or L{cache_response}.
+    """
+    keys = [_url_version_key(url) for url in urls]
+    if recipe_id:
+        keys.append(_recipe_version_key(recipe_id))
+    return {key: _get_version(key) for key in keys}
+
+def invalidate_recipe(recipe_id):
+    """Make all cached output for a saved recipe stale (e.g. after editing it)."""
+    cache.set(_recipe_version_key(recipe_id), _new_version(), timeout=0)
+
+def invalidate_urls(urls):
+    """Make all cached output that reads any of these source URLs stale.
+    Also drops the raw sources from the fetch cache (see L{hxl_proxy.fetch.forget}).
+    """
+    fetch.forget(urls)
+    for url in urls:
+        cache.set(_url_version_key(url), _new_version(), timeout=0)
+
+def start_flight(key):
+    """Claim the job of computing the response for a cache key.
+    A claim older than C{COALESCE_TIMEOUT} seconds counts as abandoned.
+    @param key: the cache key.
+    @return: a token for L{finish_flight}, or None if a request or background thread already has the job.
+    """
+    now = time.time()
+    timeout = app.config.get('COALESCE_TIMEOUT') or 0
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None and now - flight[1] < timeout:
+            return None
+        flight = (threading.Event(), now)
+        _flights[key] = flight
+        return flight
+
+def wait_for_flight(key):
+    """Wait (up to C{COALESCE_TIMEOUT} seconds) for whoever is computing a cache key to finish.
+    @return: True if there was something to wait for.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+    if flight is None:
+        return False
+    flight[0].wait(app.config.get('COALESCE_TIMEOUT'))
+    return True
+
+def finish_flight(key, flight):
+    """Give up the claim on a cache key from L{start_flight}, and wake up the waiting requests.
+    Safe to call more than once, or with None.
+    """
+    if flight is None:
+        return
+    with _flights_lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+    flight[0].set()
+
+def _start_revalidation(key, revalidate):
+    """Run revalidate() in the background, unless something is already computing key."""
+    flight = start_flight(key)
+    if flight is None:
+        return
+    def run():
+        try:
+            revalidate()
+        except Exception as e:
+            app.logger.warning('Revalidating %s failed: %s', key, e)
+        finally:
+            finish_flight(key, flight)
+    _revalidation_executor.submit(run)
+
+def _get_entry(key):
+    """Get a cache entry, and check whether it's still fresh.
+    An entry built from an older version of its recipe is gone; one that
+    is past its freshness, or built from source data that has changed
+    since, comes back as stale.
+    @return: a tuple of the entry (or None) and True if it's fresh.
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None, False
+    changed = _get_changed_dependencies(entry.get('dependencies', {}))
+    if any(version_key.startswith(_RECIPE_VERSION_PREFIX) for version_key in changed):
+        cache.delete(key)
+        return None, False
+    fresh = not changed and (entry.get('fresh_until') is None or time.time() < entry['fresh_until'])
+    if fresh and _upstream_modified(key, entry.get('upstream', {})):
+        invalidate_urls(entry['upstream'].keys())
+        fresh = False
+    return entry, fresh
+
+def _get_changed_dependencies(dependencies):
+    """List the version keys that have changed since a cache entry was saved."""
+    if not dependencies:
+        return []
+    keys = list(dependencies.keys())
+    return [key for key, version in zip(keys, cache.get_many(*keys)) if version != dependencies[key]]
+
+def _upstream_modified(key, upstream):
+    """Ask upstream servers whether a cached entry's sources changed, at most once per interval."""
+    interval = app.config.get('UPSTREAM_CHECK_INTERVAL')
+    if not interval or not any(upstream.values()):
+        return False
+    now = time.time()
+    checked = cache.get(_checked_key(key))
+    if checked is not None and now - checked < interval:
+        return False
+    for url, validators in upstream.items():
+        if validators and fetch.is_modified(url, validators):
+            return True
+    cache.set(_checked_key(key), now)
+    return False
+
+def _get_version(key):
+    """Get the current version for a key, creating one if there isn't one yet."""
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, timeout=0):
+            # another request got there first
+            version = cache.get(key) or version
+    return version
+
+def _new_version():
+    # Never reuse an old value: if the cache evicts a version key, the
+    # entries that depend on it must miss rather than come back to life.
+    return uuid.uuid4().hex
+
+def _make_etag(key, dependencies, upstream, body=None):
+    """Make a strong ETag from the request, the recipe version, and the upstream fingerprint.
+    The upstream fingerprint is the upstream servers' own validators if
+    every source sent them; otherwise, a digest of the finished body.
+    """
+    if _is_complete(upstream):
+        fingerprint = json.dumps(upstream, sort_keys=True)
+    elif body is not None:
+        fingerprint = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    else:
+        return None
+    s = json.dumps([key, dependencies, fingerprint], sort_keys=True)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()[:32]
+
+def _get_last_modified(upstream, default):
+    """Use the newest upstream Last-Modified date if every source sent one."""
+    dates = []
+    for validators in upstream.values():
+        date = werkzeug.http.parse_date(validators.get('last_modified'))
+        if date is None:
+            return default
+        dates.append(calendar.timegm(date.utctimetuple()))
+    return max(dates) if dates else default
+
+def _is_complete(upstream):
+    """Check if every upstream source sent validators."""
+    return bool(upstream) and all(upstream.values())
+
+def _make_conditional(response, etag, last_modified):
+    """Add validators to a response, and turn it into a 304 if the client already has it."""
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    return response.make_conditional(flask.request)
+
+def _checked_key(key):
+    return 'checked:' + key
+
+def _recipe_version_key(recipe_id):
+    return _RECIPE_VERSION_PREFIX + recipe_id
+
+def _url_version_key(url):
+    # URLs can be long or contain spaces, which memcached won't accept
+    return _URL_VERSION_PREFIX + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+def _tee_to_cache(key, chunks, mimetype, headers, dependencies, upstream, flight=None):
+    """Pass through chunks, keeping a copy to cache when the iterator is exhausted.
+    Finishes the flight (if any) when the stream ends, however it ends.
+    """
+    max_size = app.config.get('CACHE_MAX_ENTRY_SIZE')
+    buffer = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if buffer is not None:
+                size += len(chunk)
+                if max_size and size > max_size:
+                    # too big to cache; keep streaming, but stop saving
+                    buffer = None
+                else:
+                    buffer.append(chunk)
+            yield chunk
+        if buffer is not None:
+            store_response(key, ''.join(buffer), mimetype, headers, dependencies, upstream)
+    finally:
+        finish_flight(key, flight)
+
+# end
@@ -0,0 +1,167 @@
+"""
+Chart data for the HXL Proxy.
+
+The chart page used to read the whole pipeline once to list the filter
+values, then have the browser download the full CSV and aggregate it in
+JavaScript. L{make_chart_data} does all of that on the server in a
+single pass over the data, aggregating the rows as they go by, and
+produces only the label/value pairs that the chart needs. (If it has
+to guess which column holds the values, it holds the first
+L{GUESS_SAMPLE_ROWS} rows to guess from.)
+
+The aggregation follows the rules that hxl_proxy.ui.chart used in the
+browser:
+  - with a filter value, use only the rows matching it;
+  - with a filter column but no value or count pattern, sum the values for each label;
+  - with a count pattern, count the rows for each of its values;
+  - otherwise, chart each row's label and value.
+"""
+
+import hxl
+
+from hxl_proxy import util
+
+COUNT_PATTERN = hxl.TagPattern.parse('#meta+count')
+"""Pattern for a column that already contains a count."""
+
+NUMBERY_THRESHOLD = 0.9
+"""Fraction of non-empty values that must be numbers to guess a value column."""
+
+GUESS_SAMPLE_ROWS = 1000
+"""Number of rows to look at when guessing a value column."""
+
+
+def make_chart_data(source, label_tag=None, value_tag=None, count_tag=None, filter_tag=None, filter_value=None):
+    """Compute the data for a chart in one pass through a HXL dataset.
+    @param source: the HXL dataset (usually the output of a filter pipeline).
+    @param label_tag: (optional) a TagPattern for the label column (defaults to the first column).
+    @param value_tag: (optional) a TagPattern for a column that already contains values.
+    @param count_tag: (optional) a TagPattern whose values to count.
+    @param filter_tag: (optional) a TagPattern for the column to filter on.
+    @param filter_value: (optional) the value to filter on.
+    @return: a dict with the keys 'title', 'label_pattern', 'value_pattern', 'rows' (a list
+    of [label, value] pairs) and 'filter_values' (all the values in the filter column).
+    """
+    columns = source.columns
+    label_index = _find_index(columns, label_tag)
+    if label_index is None and columns:
+        label_index = 0
+    count_index = _find_index(columns, count_tag)
+    filter_index = _find_index(columns, filter_tag)
+    if filter_value:
+        normalised_filter_value = hxl.common.normalise_string(filter_value)
+    summing = bool(filter_tag and not filter_value and label_tag)
+
+    # without a value or count column, guess the value column from a sample of rows, and hold only those
+    value_index = None if count_tag else _find_value_index(columns, value_tag)
+    sample = [] if not count_tag and value_index is None else None
+
+    filter_values = set()
+    counts = {}
+    sums = {}
+    pairs = []
+
+    def add_row(values):
+        value = util.to_number(_get(values, value_index)) if value_index is not None else None
+        if value is None:
+            return
+        label = _get(values, label_index)
+        if summing:
+            # sum up the values for each label
+            sums[label] = sums.get(label, 0) + value
+        else:
+            pairs.append([label, value])
+
+    # one pass: collect the filter values, and aggregate the rows as they go by
+    for row in source:
+        values = row.values
+        if filter_index is not None:
+            value = _get(values, filter_index)
+            if value:
+                filter_values.add(value)
+            if filter_value and hxl.common.normalise_string(value) != normalised_filter_value:
+                continue
+        if count_tag:
+            key = _get(values, count_index)
+            counts[key] = counts.get(key, 0) + 1
+        elif sample is not None:
+            sample.append(values)
+            if len(sample) >= GUESS_SAMPLE_ROWS:
+                value_index = _guess_value_index(columns, sample)
+                for values in sample:
+                    add_row(values)
+                sample = None
+        else:
+            add_row(values)
+    if sample is not None:
+        value_index = _guess_value_index(columns, sample)
+        for values in sample:
+            add_row(values)
+
+    if count_tag:
+        label_column = columns[count_index] if count_index is not None else None
+        value_column = None
+        pairs = [[key, counts[key]] for key in sorted(counts, key=str)]
+    else:
+        label_column = columns[label_index] if label_index is not None else None
+        value_column = columns[value_index] if value_index is not None else None
+        if summing:
+            pairs = [[label, sums[label]] for label in sorted(sums, key=str)]
+
+    return {
+        'title': _make_title(value_column, count_tag),
+        'label_pattern': label_column.display_tag if label_column else None,
+        'value_pattern': value_column.display_tag if value_column else None,
+        'rows': pairs,
+        'filter_values': sorted(filter_values)
+    }
+
+def _find_index(columns, pattern):
+    """Find the index of the first column matching a pattern, or None."""
+    if pattern:
+        for index, column in enumerate(columns):
+            if pattern.match(column):
+                return index
+    return None
+
+def _find_value_index(columns, value_tag):
+    """Use the requested value column, or else a count column, or else None."""
+    index = _find_index(columns, value_tag)
+    if index is not None:
+        return index
+    for index, column in enumerate(columns):
+        if COUNT_PATTERN.match(column):
+            return index
+    return None
+
+def _guess_value_index(columns, rows):
+    """Guess the value column from a sample of rows: the first numbery column, or None."""
+    for index in range(len(columns)):
+        total_seen = 0
+        numeric_seen = 0
+        for values in rows:
+            value = _get(values, index)
+            if value:
+                total_seen += 1
+                if util.to_number(value) is not None:
+                    numeric_seen += 1
+        if total_seen > 0 and numeric_seen / total_seen >= NUMBERY_THRESHOLD:
+            return index
+    return None
+
+def _make_title(value_column, count_tag):
+    if count_tag:
+        return 'Count of {}'.format(count_tag)
+    elif value_column is None:
+        return ''
+    elif value_column.header:
+        return '{} ({})'.format(value_column.header, value_column.display_tag)
+    else:
+        return value_column.display_tag
+
+def _get(values, index):
+    if index is not None and index < len(values):
+        return values[index]
+    return ''
+
+# end
@@ -0,0 +1,264 @@
+"""
+Columnar versions of the sort, count, and dedup filters.
+
+libhxl's sort and count filters work row by row: every row builds its
+own sort key or aggregation key, even when a column repeats the same
+few values (e.g. admin1 names) a million times. The filters in this
+module work a column at a time instead. As the rows stream past, each
+key value becomes an integer code, one per distinct value in its
+column (see L{_KeyColumn}), so normalising a value, parsing it as a
+number or date, and comparing it happen once per I{distinct} value
+rather than once per row:
+
+  - sort keeps the rows (as libhxl's sort has to) plus an array of
+    codes for each key column, and sorts them with numpy.lexsort;
+  - count keeps only the running totals for each combination of codes
+    (as libhxl's count does for each combination of values), and sorts
+    the groups by their codes' ranks at the end;
+  - dedup streams like libhxl's, remembering the combinations of
+    codes that it has already seen.
+
+Either way, the output is exactly what the libhxl filter would have
+produced, and it goes out as ordinary HXL rows.
+
+These filters need numpy (pip install hxl-proxy[columnar]). Without it,
+setting the COLUMNAR_ENGINE config option does nothing, and
+hxl_proxy.filters uses the libhxl filters (see L{is_available}).
+"""
+
+import array
+
+import hxl
+import hxl.filters
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def is_available():
+    """Check whether the filters in this module can run (i.e. numpy is installed)."""
+    return numpy is not None
+
+
+class ColumnarSortFilter(hxl.filters.SortFilter):
+    """Same as hxl.filters.SortFilter (and the same arguments), but sorting by ranked key columns."""
+
+    def filter_rows(self):
+        indices = self._make_indices() or range(len(self.columns))
+        keys = [_KeyColumn() for index in indices]
+        rows = []
+        for row in self.source:
+            values = row.values
+            rows.append(values)
+            for key, index in zip(keys, indices):
+                key.add(values[index] if index < len(values) else None)
+        ranks = [
+            key.rank(lambda value, tag=self.columns[index].tag: self._make_sort_value(tag, value))
+            for key, index in zip(keys, indices)
+        ]
+        return [rows[i] for i in _argsort(ranks, len(rows), self.reverse)]
+
+
+class ColumnarCountFilter(hxl.filters.CountFilter):
+    """Same as hxl.filters.CountFilter (and the same arguments), but grouping by coded key columns.
+    Like the libhxl filter, this one keeps only one set of totals per group, not the rows.
+    """
+
+    def filter_rows(self):
+        if self.queries or not self.patterns:
+            return super(ColumnarCountFilter, self).filter_rows()
+
+        columns = self.source.columns
+        key_indices = [_find_indices(pattern, columns) for pattern in self.patterns]
+        keys = [_KeyColumn() for pattern in self.patterns]
+        groups = {} # tuple of key codes -> group number
+        aggregates = []
+        if self.aggregate_pattern is not None:
+            aggregate_indices = _find_indices(self.aggregate_pattern, columns)
+            numbers = {} # value -> float, or None if it's not a number
+        else:
+            aggregate_indices = None
+
+        for row in self.source:
+            values = row.values
+            codes = tuple(key.encode(_get_first(values, indices)) for key, indices in zip(keys, key_indices))
+            group = groups.get(codes)
+            if group is None:
+                group = groups[codes] = len(aggregates)
+                aggregates.append(_Aggregates())
+            if aggregate_indices is None:
+                aggregates[group].count += 1
+            else:
+                value = _get_first(values, aggregate_indices)
+                number = numbers.get(value, False)
+                if number is False:
+                    number = numbers[value] = _parse_number(value)
+                aggregates[group].add(number)
+
+        if not groups:
+            return []
+        group_keys = numpy.array(list(groups), dtype=numpy.int64).reshape(len(groups), len(keys))
+        ranks = [key.rank_codes()[group_keys[:, i]] for i, key in enumerate(keys)]
+        result = []
+        for (codes, aggregate) in ((group_keys[g], aggregates[g]) for g in _argsort(ranks, len(groups))):
+            row_values = [key.get(code) for key, code in zip(keys, codes)]
+            row_values.append(aggregate.count)
+            if aggregate_indices is not None:
+                row_values += aggregate.get_values()
+            result.append(row_values)
+        return result
+
+
+class ColumnarDedupFilter(hxl.filters.DeduplicationFilter):
+    """Same as hxl.filters.DeduplicationFilter (and the same arguments), but with coded keys.
+    Like the libhxl filter, this one streams: it remembers the combinations
+    of key codes that it has seen, and normalises each distinct value once.
+    """
+
+    def __init__(self, source, patterns=None, queries=[]):
+        super(ColumnarDedupFilter, self).__init__(source, patterns, queries)
+        self._indices = None
+        self._codes = {} # value -> code for its normalised form
+        self._normalised = {} # normalised value -> code
+
+    def _make_key(self, row):
+        if self._indices is None:
+            self._indices = [i for i, column in enumerate(row.columns) if self._is_key(column)]
+        values = row.values
+        return tuple(self._get_code(values[i]) for i in self._indices if i < len(values))
+
+    def _get_code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            normalised = hxl.common.normalise_string(value)
+            code = self._normalised.setdefault(normalised, len(self._normalised))
+            self._codes[value] = code
+        return code
+
+
+#
+# Column helpers
+#
+
+class _KeyColumn(object):
+    """One key column, coded as an integer for each distinct value."""
+
+    def __init__(self):
+        self.codes = array.array('q') # the code for each row (see add())
+        self.distinct = {} # value -> code
+        self._values = None # code -> value (see get())
+
+    def encode(self, value):
+        """Get the code for a value."""
+        code = self.distinct.get(value)
+        if code is None:
+            code = self.distinct[value] = len(self.distinct)
+        return code
+
+    def add(self, value):
+        """Add the next row's value."""
+        self.codes.append(self.encode(value))
+
+    def get(self, code):
+        """Get the original value for a code."""
+        if self._values is None:
+            self._values = list(self.distinct)
+        return self._values[code]
+
+    def rank_codes(self, key=None):
+        """Get the rank of each distinct value, by code.
+        Values whose keys are equal get the same rank, so comparing the ranks
+        gives the same answer as comparing the keys. key() runs once per
+        distinct value; missing values (None) get the rank -1, before everything else.
+        @param key: (optional) a function to make a comparable key for a value (default: the value itself).
+        @return: a numpy array of integer ranks, indexed by code.
+        """
+        values = [value for value in self.distinct if value is not None]
+        keys = {value: (key(value) if key else value) for value in values}
+        code_ranks = numpy.full(len(self.distinct), -1, dtype=numpy.int64)
+        rank = -1
+        previous = None
+        for value in sorted(values, key=keys.get):
+            if rank < 0 or keys[value] != previous:
+                rank += 1
+                previous = keys[value]
+            code_ranks[self.distinct[value]] = rank
+        return code_ranks
+
+    def rank(self, key=None):
+        """Get the rank of each row's value (see L{rank_codes}).
+        @return: a numpy array of integer ranks, one for each row added.
+        """
+        return self.rank_codes(key)[numpy.asarray(self.codes)]
+
+
+class _Aggregates(object):
+    """The running count, sum, minimum, and maximum for one group, as in CountFilter."""
+
+    def __init__(self):
+        self.count = 0
+        self.last = 0 # the count at the last number, for the average
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, number):
+        """Add a row, with its number (or None)."""
+        self.count += 1
+        if number is not None:
+            self.last = self.count
+            self.sum += number
+            if self.min is None or number < self.min:
+                self.min = number
+            if self.max is None or number > self.max:
+                self.max = number
+
+    def get_values(self):
+        """Get the sum, average, minimum, and maximum (or four empty strings if there were no numbers)."""
+        # like CountFilter, the average is as it was at the last row with a number
+        if not self.last:
+            return ['', '', '', '']
+        return [self.sum, self.sum / self.last, self.min, self.max]
+
+
+def _find_indices(pattern, columns):
+    """Get the indices of all the columns that match a tag pattern."""
+    return [i for i, column in enumerate(columns) if pattern.match(column)]
+
+def _get_first(values, indices):
+    """Get the first non-empty value in a row from a list of columns, or '' (like hxl.model.Row.get)."""
+    for index in indices:
+        if index < len(values) and values[index]:
+            return str(values[index])
+    return ''
+
+def _parse_number(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+#
+# Operations over ranked columns
+#
+
+def _argsort(keys, size, reverse=False):
+    """Stable sort of row positions by a list of rank columns, the most significant first.
+    As with sorted(), reverse=True keeps rows with equal keys in their original order.
+    @return: a sequence of row positions.
+    """
+    if not keys or size == 0:
+        return range(size)
+    # numpy.lexsort takes the most significant key last
+    keys = list(reversed(keys))
+    if not reverse:
+        return numpy.lexsort(keys)
+    # break ties backwards, so that flipping the result keeps them in order
+    return numpy.lexsort([-numpy.arange(size)] + keys)[::-1]
+
+# end
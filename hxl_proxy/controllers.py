@@ -7,16 +7,17 @@ License: Public Domain
 Documentation: http://hxlstandard.org
 """
 
-import flask, hxl, urllib, werkzeug
+import flask, hxl, json, urllib, werkzeug
 
-from . import app, auth, cache, dao, filters, preview, util, validate
+from . import app, auth, caching, chart, dao, exports, fetch, filters, preview, snapshots, stats, util, validate
 
 
 # FIXME - move somewhere else
 RECIPE_ARG_BLACKLIST = [
     'cloneable',
     'description',
-    'details'
+    'details',
+    'materialise',
     'name',
     'passhash',
     'password',
@@ -56,6 +57,7 @@ def before_request():
     app.secret_key = app.config['SECRET_KEY']
     flask.request.parameter_storage_class = werkzeug.datastructures.ImmutableOrderedMultiDict
     flask.g.member = flask.session.get('member_info')
+    snapshots.start_scheduler()
 
 
 #
@@ -113,16 +115,8 @@ def show_data_tag(recipe_id=None):
     except:
         sheet_index = 0
 
-    preview = []
-    i = 0
-    for row in hxl.io.make_input(recipe['args'].get('url'), sheet_index=0):
-        if i >= 25:
-            break
-        else:
-            i = i + 1
-        if row:
-            preview.append(row)
-        
+    preview = [row for row in fetch.sniff_rows(recipe['args'].get('url'), sheet_index=sheet_index, max_rows=25) if row]
+
     return flask.render_template('data-tagger.html', recipe=recipe, preview=preview, header_row=header_row)
 
 
@@ -159,7 +153,23 @@ def show_data_edit(recipe_id=None):
 
     show_headers = (recipe['args'].get('strip-headers') != 'on')
 
-    return flask.render_template('data-recipe.html', recipe=recipe, source=source, show_headers=show_headers, filter_count=filter_count)
+    # the preview doesn't count the rows, so use a cached count, or else
+    # take it from the per-stage statistics, which come from a background
+    # job if they're not already in the cache (one full pass for both)
+    total_rows = caching.get_body(util.make_cache_key(path='/data/rowcount.json', args_in=recipe['args']))
+    if total_rows is not None:
+        total_rows = json.loads(total_rows)['rows']
+    stats_url = util.make_data_url({'args': recipe['args']}, facet='stats.json')
+    recipe_stats = caching.get_body(util.make_cache_key(path='/data/stats.json', args_in=recipe['args']))
+    if recipe_stats is not None:
+        recipe_stats = json.loads(recipe_stats)
+        if total_rows is None and recipe_stats['stages']:
+            total_rows = recipe_stats['stages'][-1]['rows']
+
+    return flask.render_template(
+        'data-recipe.html', recipe=recipe, source=source, show_headers=show_headers, filter_count=filter_count,
+        total_rows=total_rows, stats_url=stats_url, recipe_stats=recipe_stats
+    )
 
 @app.route("/data/recipe")
 @app.route("/data/<recipe_id>/recipe")
@@ -179,12 +189,15 @@ def show_data_recipe(recipe_id=None):
 @app.route('/data/<recipe_id>/chart')
 @app.route('/data/chart')
 def show_data_chart(recipe_id=None):
-    """Show a chart visualisation for the data."""
+    """Show a chart visualisation for the data.
+    Reads the data only once: the chart data goes into the page itself.
+    """
 
     def find_column(source, pattern):
-        for column in source.columns:
-            if pattern.match(column):
-                return column
+        if pattern:
+            for column in source.columns:
+                if pattern.match(column):
+                    return column
         return None
     
     recipe = util.get_recipe(recipe_id)
@@ -192,48 +205,111 @@ def show_data_chart(recipe_id=None):
         return flask.redirect('/data/source', 303)
 
     source = filters.setup_filters(recipe)
+    chart_args = _get_chart_args()
+    chart_data = chart.make_chart_data(source, **chart_args)
 
-    args = flask.request.args
-
-    value_tag = args.get('value_tag')
-    value_col = None
-    if value_tag:
-        value_tag = hxl.TagPattern.parse(value_tag)
-        value_col = find_column(source, value_tag)
-
-    label_tag = args.get('label_tag')
-    label_col = None
-    if label_tag:
-        label_tag = hxl.TagPattern.parse(label_tag)
-        label_col = find_column(source, label_tag)
-
-    filter_tag = args.get('filter_tag')
-    filter_col = None
-    filter_value = args.get('filter_value')
-    filter_values = set()
-    if filter_tag:
-        filter_tag = hxl.TagPattern.parse(filter_tag)
-        filter_col = find_column(source, filter_tag)
-        filter_values = source.get_value_set(filter_tag)
-
-    count_tag = args.get('count_tag')
-    count_col = None
-    if count_tag:
-        count_tag = hxl.TagPattern.parse(count_tag)
-        count_col = find_column(source, count_tag)
-        
-    type = args.get('type', 'bar')
+    type = flask.request.args.get('type', 'bar')
     
     return flask.render_template(
         'visualise-chart.html',
-        recipe_id=recipe_id, recipe=recipe, type=type, source=source,
-        value_tag=value_tag, value_col=value_col,
-        label_tag=label_tag, label_col=label_col,
-        count_tag=count_tag, count_col=count_col,
-        filter_tag=filter_tag, filter_col=filter_col,
-        filter_values=sorted(filter_values), filter_value=filter_value
+        recipe_id=recipe_id, recipe=recipe, type=type, source=source, chart_data=chart_data,
+        value_tag=chart_args['value_tag'], value_col=find_column(source, chart_args['value_tag']),
+        label_tag=chart_args['label_tag'], label_col=find_column(source, chart_args['label_tag']),
+        count_tag=chart_args['count_tag'], count_col=find_column(source, chart_args['count_tag']),
+        filter_tag=chart_args['filter_tag'], filter_col=find_column(source, chart_args['filter_tag']),
+        filter_values=chart_data['filter_values'], filter_value=chart_args['filter_value']
+    )
+
+@app.route('/data/<recipe_id>/chart.json')
+@app.route('/data/chart.json')
+def show_data_chart_json(recipe_id=None):
+    """Return pre-aggregated chart data as JSON (see L{hxl_proxy.chart.make_chart_data})."""
+    chart_args = _get_chart_args()
+    return _make_cached_json(recipe_id, lambda source: chart.make_chart_data(source, **chart_args))
+
+@app.route('/data/<recipe_id>/rowcount.json')
+@app.route('/data/rowcount.json')
+def show_data_rowcount(recipe_id=None):
+    """Return the number of data rows in a recipe's output, as JSON.
+    (The recipe editor takes its total from /data/stats.json instead, so
+    that opening it starts only one full pass through the data.)
+    """
+    return _make_cached_json(recipe_id, lambda source: {'rows': sum(1 for row in source)})
+
+@app.route('/data/<recipe_id>/stats.json')
+@app.route('/data/stats.json')
+def show_data_stats(recipe_id=None):
+    """Return row counts and column statistics for each stage of a recipe, as JSON.
+    Computing them needs a full pass through the data, so the first
+    request starts a background job (see L{hxl_proxy.stats}) and gets
+    202 Accepted; later requests get the result once it's in the cache.
+    """
+    cache_key = util.make_cache_key()
+    if not util.skip_cache_p():
+        response = caching.get_response(cache_key)
+        if response is not None:
+            return response
+
+    recipe = util.get_recipe(recipe_id, auth=False)
+    if not recipe or not recipe['args'].get('url'):
+        return flask.redirect('/data/source', 303)
+
+    urls = filters.get_source_urls(recipe['args'])
+    if util.skip_cache_p():
+        caching.invalidate_urls(urls)
+    dependencies = caching.get_dependencies(recipe.get('recipe_id'), urls)
+
+    job = stats.submit(cache_key, recipe, dependencies)
+    if not job.done():
+        return flask.Response(
+            json.dumps({'status': 'pending'}),
+            status=202,
+            mimetype='application/json',
+            headers={'Access-Control-Allow-Origin': '*', 'Retry-After': '2'}
+        )
+    # finished already (raises the exception if the job failed)
+    return flask.Response(job.result(), mimetype='application/json', headers={'Access-Control-Allow-Origin': '*'})
+
+def _make_cached_json(recipe_id, make_data):
+    """Run a recipe's pipeline through a function, and cache its result as a JSON response.
+    @param recipe_id: the saved recipe's id, or None to use the request parameters.
+    @param make_data: a function that takes the pipeline, and returns something JSON-serialisable.
+    @return: a Flask response object.
+    """
+    cache_key = util.make_cache_key()
+    if not util.skip_cache_p():
+        response = caching.get_response(cache_key)
+        if response is not None:
+            return response
+
+    recipe = util.get_recipe(recipe_id, auth=False)
+    if not recipe or not recipe['args'].get('url'):
+        return flask.redirect('/data/source', 303)
+
+    urls = filters.get_source_urls(recipe['args'])
+    if util.skip_cache_p():
+        caching.invalidate_urls(urls)
+    dependencies = caching.get_dependencies(recipe.get('recipe_id'), urls)
+
+    data = make_data(filters.setup_filters(recipe))
+    return caching.cache_response(
+        cache_key,
+        json.dumps(data),
+        mimetype='application/json',
+        headers={'Access-Control-Allow-Origin': '*'},
+        dependencies=dependencies,
+        upstream=caching.get_upstream_validators(urls)
     )
 
+def _get_chart_args():
+    """Parse the chart options from the GET parameters."""
+    args = flask.request.args
+    chart_args = {}
+    for name in ('value_tag', 'label_tag', 'filter_tag', 'count_tag'):
+        chart_args[name] = hxl.TagPattern.parse(args.get(name)) if args.get(name) else None
+    chart_args['filter_value'] = args.get('filter_value')
+    return chart_args
+
 @app.route('/data/<recipe_id>/map')
 @app.route('/data/map')
 def show_data_map(recipe_id=None):
@@ -278,13 +354,63 @@ def show_validate(recipe_id=None):
 
     detail_hash = args.get('details', None)
 
-    # If we have a URL, validate the data.
+    # If we have a URL, validate the data (or reuse the report for the same data and schema).
     if url:
-        errors = validate.do_validate(filters.setup_filters(recipe), schema_url, severity_level)
+        if util.skip_cache_p():
+            caching.invalidate_urls(filters.get_source_urls(recipe['args']) + ([schema_url] if schema_url else []))
+        report_key = validate.make_report_key(recipe['args'], schema_url, severity_level)
+        errors = validate.get_errors(recipe, schema_url, severity_level, key=report_key)
+
+    # One page of the errors for a single rule
+    details = None
+    page = 1
+    page_count = 0
+    if errors and detail_hash in errors:
+        try:
+            page = max(int(args.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        page_size = app.config.get('VALIDATION_PAGE_SIZE')
+        page_count = -(-errors[detail_hash]['count'] // page_size)
+        details = validate.get_error_page(
+            recipe, schema_url, severity_level, detail_hash, page, page_size, key=report_key
+        )
+    else:
+        detail_hash = None
 
     return flask.render_template(
         'validate-summary.html',
-        recipe=recipe, schema_url=schema_url, errors=errors, detail_hash=detail_hash, severity=severity_level
+        recipe=recipe, schema_url=schema_url, errors=errors, detail_hash=detail_hash, severity=severity_level,
+        details=details, page=page, page_count=page_count
+    )
+
+@app.route("/data/validate.json")
+@app.route("/data/<recipe_id>/validate.json")
+def show_validate_json(recipe_id=None):
+    """Stream validation results as newline-delimited JSON.
+    Each error goes out as soon as validation finds it, and a summary
+    record comes last (see L{hxl_proxy.validate.gen_validation_records}).
+    Takes the same schema_url and severity parameters as the HTML page.
+    """
+    recipe = util.get_recipe(recipe_id)
+    if not recipe or not recipe['args'].get('url'):
+        return flask.redirect('/data/source', 303)
+
+    args = flask.request.args
+    schema_url = args.get('schema_url') or recipe['args'].get('schema_url')
+    severity_level = args.get('severity', 'info')
+
+    if util.skip_cache_p():
+        caching.invalidate_urls(filters.get_source_urls(recipe['args']) + ([schema_url] if schema_url else []))
+
+    def gen_lines():
+        for record in validate.gen_validation_records(filters.setup_filters(recipe), schema_url, severity_level):
+            yield json.dumps(record) + '\n'
+
+    return flask.Response(
+        flask.stream_with_context(gen_lines()),
+        mimetype='application/x-ndjson',
+        headers={'Access-Control-Allow-Origin': '*'}
     )
 
 @app.route("/data/<recipe_id>.<format>")
@@ -292,38 +418,178 @@ def show_validate(recipe_id=None):
 @app.route("/data.<format>")
 @app.route("/data")
 @app.route("/data/<recipe_id>") # must come last, or it will steal earlier patterns
-@cache.cached(key_prefix=util.make_cache_key, unless=util.skip_cache_p)
 def show_data(recipe_id=None, format="html", stub=None):
+    """Show the output of a recipe as HTML, or stream it as CSV or JSON."""
 
-    def get_result (recipe_id, format):
-        recipe = util.get_recipe(recipe_id, auth=False)
-        if not recipe or not recipe['args'].get('url'):
-            return flask.redirect('/data/source', 303)
-
-        source = filters.setup_filters(recipe)
-        show_headers = (recipe['args'].get('strip-headers') != 'on')
-
-        if format == 'html':
-            return flask.render_template('data-view.html', source=source, recipe=recipe, show_headers=show_headers)
-        elif format == 'json':
-            response = flask.Response(list(source.gen_json(show_headers=show_headers)), mimetype='application/json')
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            if recipe.get('stub'):
-                response.headers['Content-Disposition'] = 'attachment; filename={}.json'.format(recipe['stub'])
+    cache_key = util.make_cache_key()
+
+    # force= skips the lookup, but still saves the fresh result under the same key
+    if not util.skip_cache_p():
+        # a stale entry comes back at once, while a background thread rebuilds it
+        response = caching.get_response(cache_key, revalidate=_make_revalidator(recipe_id, format, cache_key))
+        if response is not None:
             return response
-        else:
-            response = flask.Response(list(source.gen_csv(show_headers=show_headers)), mimetype='text/csv')
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            if recipe.get('stub'):
-                response.headers['Content-Disposition'] = 'attachment; filename={}.csv'.format(recipe['stub'])
+
+    recipe = util.get_recipe(recipe_id, auth=False)
+    if not recipe or not recipe['args'].get('url'):
+        return flask.redirect('/data/source', 303)
+
+    # a materialised recipe's downloads come straight from its snapshot, if it has one for this version
+    if recipe.get('materialise') and not recipe.get('overridden') and not util.skip_cache_p():
+        path = snapshots.get_snapshot(recipe, format)
+        if path is not None:
+            return _send_snapshot(recipe, path, format)
+        if format in snapshots.FORMATS:
+            snapshots.request_refresh(recipe['recipe_id'])
+
+    # only one request at a time runs the pipeline for the same output; the others wait for its result
+    flight = caching.start_flight(cache_key)
+    if flight is None and not util.skip_cache_p():
+        caching.wait_for_flight(cache_key)
+        response = caching.get_response(cache_key)
+        if response is not None:
             return response
 
-    result = get_result(recipe_id, format)
+    try:
+        response = _make_data_response(recipe, format, cache_key, flight)
+    except:
+        caching.finish_flight(cache_key, flight)
+        raise
+    if not response.is_streamed:
+        # otherwise, the stream finishes the flight when it ends
+        caching.finish_flight(cache_key, flight)
+    return response
+
+def _make_data_response(recipe, format, cache_key, flight=None):
+    """Run a recipe for show_data(), caching the result.
+    @param flight: (optional) the token from L{caching.start_flight}, for a streaming response to finish.
+    @return: a Flask response (streaming for CSV and JSON).
+    """
+
+    # a forced refresh means the upstream data changed, for every recipe that uses it
+    urls = filters.get_source_urls(recipe['args'])
     if util.skip_cache_p():
-        # Want to store the new value, but can't get the key to work
-        # Clearing the whole cache for now (heavy-handed)
-        cache.set(show_data.make_cache_key(), result)
-    return result
+        caching.invalidate_urls(urls)
+    dependencies = caching.get_dependencies(recipe.get('recipe_id'), urls)
+
+    source = filters.setup_filters(recipe)
+    upstream = caching.get_upstream_validators(urls)
+    show_headers = (recipe['args'].get('strip-headers') != 'on')
+
+    if format == 'html':
+        return caching.cache_response(
+            cache_key,
+            flask.render_template('data-view.html', source=source, recipe=recipe, show_headers=show_headers),
+            dependencies=dependencies,
+            upstream=upstream
+        )
+
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    if format == 'json':
+        mimetype = 'application/json'
+        chunks = source.gen_json(show_headers=show_headers)
+    else:
+        format = 'csv'
+        mimetype = 'text/csv'
+        chunks = source.gen_csv(show_headers=show_headers)
+    if recipe.get('stub'):
+        headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(recipe['stub'], format)
+
+    # force-trigger any exception from the source before we start streaming
+    source.columns
+
+    return caching.stream_response(cache_key, chunks, mimetype, headers, dependencies, upstream, flight)
+
+def _make_revalidator(recipe_id, format, cache_key):
+    """Make a function to rebuild a stale show_data() entry in a background thread."""
+    @flask.copy_current_request_context
+    def revalidate():
+        recipe = util.get_recipe(recipe_id, auth=False)
+        if not recipe or not recipe['args'].get('url'):
+            return
+        response = _make_data_response(recipe, format, cache_key)
+        # read the whole stream (if it is one), so that it goes into the cache
+        for chunk in response.response:
+            pass
+        response.close()
+    return revalidate
+
+def _send_snapshot(recipe, path, format):
+    """Send a recipe's snapshot file, with the same headers as the live output."""
+    response = flask.send_file(path, mimetype=snapshots.FORMATS[format], conditional=True)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    if recipe.get('stub'):
+        response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(recipe['stub'], format)
+    return response
+
+@app.route("/data/<recipe_id>/export", methods=['POST'])
+@app.route("/data/export", methods=['POST'])
+def do_data_export(recipe_id=None):
+    """Queue a background export of a recipe's output, for recipes too big to stream from /data.
+    Answers 202 Accepted, with the job's status (see L{show_export_status}).
+    """
+    if not app.config.get('EXPORT_DIR'):
+        raise werkzeug.exceptions.NotFound("Exports are not enabled on this server.")
+    format = flask.request.args.get('format', 'csv')
+    if format not in exports.FORMATS:
+        raise werkzeug.exceptions.BadRequest("Unsupported export format: " + format)
+
+    recipe = util.get_recipe(recipe_id, auth=False)
+    if not recipe or not recipe['args'].get('url'):
+        return flask.redirect('/data/source', 303)
+
+    job = exports.submit(recipe, format)
+    response = _make_export_status(job, status=202)
+    response.headers['Location'] = flask.url_for('show_export_status', job_id=job['job_id'])
+    return response
+
+@app.route("/exports/<job_id>.json")
+def show_export_status(job_id):
+    """Report an export job's status, and the rows processed and bytes written so far, as JSON."""
+    return _make_export_status(_get_export_job(job_id))
+
+@app.route("/exports/<job_id>/download")
+def show_export_download(job_id):
+    """Send the file from a finished export job."""
+    job = _get_export_job(job_id)
+    path = exports.get_file(job)
+    if path is None:
+        raise werkzeug.exceptions.Conflict("Export job {} is {}.".format(job_id, job['status']))
+    response = flask.send_file(path, mimetype=exports.FORMATS[job['format']], conditional=True)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(
+        job.get('stub') or 'data', job['format']
+    )
+    return response
+
+def _get_export_job(job_id):
+    job = exports.get_job(job_id)
+    if job is None:
+        raise werkzeug.exceptions.NotFound("No export job " + job_id)
+    return job
+
+def _make_export_status(job, status=200):
+    """Make a JSON response with an export job's status."""
+    data = {
+        'job_id': job['job_id'],
+        'recipe_id': job.get('recipe_id'),
+        'format': job['format'],
+        'status': job['status'],
+        'rows': job['rows'],
+        'bytes': job['bytes'],
+        'error': job.get('error'),
+        'created': job['date_created'],
+        'modified': job['date_modified'],
+        'status_url': flask.url_for('show_export_status', job_id=job['job_id'], _external=True)
+    }
+    if job['status'] == 'done':
+        data['download_url'] = flask.url_for('show_export_download', job_id=job['job_id'], _external=True)
+    headers = {'Access-Control-Allow-Origin': '*'}
+    if job['status'] in ('queued', 'running'):
+        headers['Retry-After'] = '2'
+    return flask.Response(json.dumps(data), status=status, mimetype='application/json', headers=headers)
 
 @app.route("/actions/login", methods=['POST'])
 def do_data_login():
@@ -360,6 +626,9 @@ def do_data_save():
         recipe['cloneable'] = (flask.request.form['cloneable'] == 'on')
     if 'stub' in flask.request.form:
         recipe['stub'] = flask.request.form['stub']
+    if 'materialise' in flask.request.form:
+        # the settings form sends 'off' from a hidden field, then 'on' from the checkbox if it's checked
+        recipe['materialise'] = ('on' in flask.request.form.getlist('materialise'))
 
     # merge args
     recipe['args'] = {}
@@ -380,6 +649,10 @@ def do_data_save():
             else:
                 raise werkzeug.exceptions.BadRequest("Passwords don't match")
         dao.recipes.update(recipe)
+        # evict only the output built from the old version of this recipe
+        caching.invalidate_recipe(recipe_id)
+        if recipe.get('materialise'):
+            snapshots.request_refresh(recipe_id)
     else:
         # Creating a new recipe.
         if password == password_repeat:
@@ -392,9 +665,8 @@ def do_data_save():
         dao.recipes.create(recipe)
         # FIXME other auth information is in __init__.py
         flask.session['passhash'] = recipe['passhash']
-
-    # TODO be more specific about what we clear
-    cache.clear()
+        if recipe.get('materialise'):
+            snapshots.request_refresh(recipe_id)
 
     return flask.redirect(util.make_data_url(recipe), 303)
 
@@ -1,10 +1,11 @@
 """Database access functions.
 
 This module contains all database dependencies for the HXL Proxy. It
-uses three classes as submodules: L{db} for low-level access, L{user}
-for managing user records, and L{recipe} for managing recipe
-records. L{user} and L{recipe} both have the standard CRUD (create,
-read, update, and delete) functions.  Example:
+uses four classes as submodules: L{db} for low-level access, L{user}
+for managing user records, L{recipe} for managing recipe records, and
+L{exports} for background export jobs. L{user}, L{recipe}, and
+L{exports} all have the standard CRUD (create, read, update, and
+delete) functions.  Example:
 
   from hxl_proxy import dao
 
@@ -44,19 +45,20 @@ class db:
     def connect():
         """Get a database connection 
 
-        Will reuse the same connection throughout a request
-        context. Uses the C{DB_FILE} Flask config option for the
+        Will reuse the same connection throughout a request (or
+        application) context. Uses the C{DB_FILE} Flask config option for the
         location of SQLite3 file.
 
         @return: a SQLite3 database connection
         """
-        if flask.has_request_context(): #FIXME - this is an ugly dependency
+        # background threads (see hxl_proxy.snapshots) get their own connection in an app context
+        if flask.has_app_context(): #FIXME - this is an ugly dependency
             database = getattr(flask.g, '_database', None)
         else:
             database = db._database
         if database is None:
             database = sqlite3.connect(db.DB_FILE)
-            if flask.has_request_context():
+            if flask.has_app_context():
                 flask.g._database = database
             else:
                 db._database = database
@@ -213,10 +215,11 @@ class recipes:
         """
         return db.execute_statement(
             "insert into Recipes"
-            " (recipe_id, passhash, name, description, cloneable, stub, args, date_created, date_modified)"
-            " values (?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))",
+            " (recipe_id, passhash, name, description, cloneable, stub, materialise, args, date_created, date_modified)"
+            " values (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))",
             (recipe.get('recipe_id'), recipe.get('passhash'), recipe.get('name'), recipe.get('description'),
-             recipe.get('cloneable'), recipe.get('stub'), json.dumps(recipe.get('args', {})),),
+             recipe.get('cloneable'), recipe.get('stub'), bool(recipe.get('materialise')),
+             json.dumps(recipe.get('args', {})),),
             commit=commit
         )
 
@@ -234,6 +237,16 @@ class recipes:
             recipe['args'] = json.loads(recipe.get('args'))
         return recipe
 
+    @staticmethod
+    def list_materialised():
+        """List the recipes that keep snapshots of their output (see L{hxl_proxy.snapshots}).
+        @return: a list of dicts of recipe properties.
+        """
+        recipes = db.fetchall('select * from Recipes where materialise order by recipe_id')
+        for recipe in recipes:
+            recipe['args'] = json.loads(recipe.get('args'))
+        return recipes
+
     @staticmethod
     def update(recipe, commit=True):
         """Update an existing recipe record.
@@ -243,11 +256,12 @@ class recipes:
         """
         return db.execute_statement(
             "update Recipes"
-            " set passhash=?, name=?, description=?, cloneable=?, stub=?, args=?, "
+            " set passhash=?, name=?, description=?, cloneable=?, stub=?, materialise=?, args=?, "
             " date_modified=datetime('now')"
             " where recipe_id=?",
             (recipe.get('passhash'), recipe.get('name'), recipe.get('description'), recipe.get('cloneable'),
-             recipe.get('stub'), json.dumps(recipe.get('args', {})), recipe.get('recipe_id'), ),
+             recipe.get('stub'), bool(recipe.get('materialise')), json.dumps(recipe.get('args', {})),
+             recipe.get('recipe_id'), ),
             commit=commit
         )
 
@@ -263,3 +277,113 @@ class recipes:
             (recipe_id,),
             commit=commit
         )
+
+
+class exports:
+    """Database records for background export jobs (see L{hxl_proxy.exports})"""
+
+    @staticmethod
+    def create(job, commit=True):
+        """Add a new export job record and optionally commit.
+        @param job: a dict of properties for a job.
+        @param commit: if True, autocommit after adding the job record (default: True).
+        @return: a SQLite3 cursor object.
+        """
+        return db.execute_statement(
+            "insert into ExportJobs"
+            " (job_id, recipe_id, format, stub, args, status, rows, bytes, error, date_created, date_modified)"
+            " values (?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))",
+            (job.get('job_id'), job.get('recipe_id'), job.get('format'), job.get('stub'),
+             json.dumps(job.get('args', {})), job.get('status'), job.get('rows', 0), job.get('bytes', 0),
+             job.get('error'),),
+            commit=commit
+        )
+
+    @staticmethod
+    def read(job_id):
+        """Look up an export job record by id.
+        @param job_id: the job's unique identifier in the database.
+        @return: a dict of job properties, or None if the record doesn't exist.
+        """
+        job = db.fetchone(
+            'select * from ExportJobs where job_id=?',
+            (job_id,)
+        )
+        if job:
+            job['args'] = json.loads(job.get('args'))
+        return job
+
+    @staticmethod
+    def update(job, commit=True):
+        """Update the progress of an existing export job record.
+        @param job: a dict of job properties, including the C{job_id}.
+        @param commit: if True, autocommit after updating the job record (default: True).
+        @return: a SQLite3 cursor object.
+        """
+        return db.execute_statement(
+            "update ExportJobs"
+            " set status=?, rows=?, bytes=?, error=?, date_modified=datetime('now')"
+            " where job_id=?",
+            (job.get('status'), job.get('rows', 0), job.get('bytes', 0), job.get('error'), job.get('job_id'),),
+            commit=commit
+        )
+
+    @staticmethod
+    def touch(job_ids, commit=True):
+        """Record that the worker process running some export jobs is still alive.
+        @param job_ids: a list of job ids.
+        @param commit: if True, autocommit after updating the job records (default: True).
+        @return: a SQLite3 cursor object.
+        """
+        return db.execute_statement(
+            "update ExportJobs set date_modified=datetime('now')"
+            " where job_id in ({})".format(', '.join('?' * len(job_ids))),
+            tuple(job_ids),
+            commit=commit
+        )
+
+    @staticmethod
+    def fail_stalled(seconds, error, job_id=None, commit=True):
+        """Mark queued or running export jobs as failed if they haven't changed for a while.
+        @param seconds: how long a live job can go without changing.
+        @param error: the error message to record.
+        @param job_id: (optional) check only this job (default: all jobs).
+        @param commit: if True, autocommit after updating the job records (default: True).
+        @return: a SQLite3 cursor object.
+        """
+        statement = (
+            "update ExportJobs set status='failed', error=?, date_modified=datetime('now')"
+            " where status in ('queued', 'running') and date_modified < datetime('now', ?)"
+        )
+        params = (error, '-{} seconds'.format(int(seconds)),)
+        if job_id is not None:
+            statement += " and job_id=?"
+            params += (job_id,)
+        return db.execute_statement(statement, params, commit=commit)
+
+    @staticmethod
+    def list_expired(seconds):
+        """List the export jobs that haven't changed for a while.
+        @param seconds: how long a job can go without changing.
+        @return: a list of dicts of job properties.
+        """
+        jobs = db.fetchall(
+            "select * from ExportJobs where date_modified < datetime('now', ?) order by date_modified",
+            ('-{} seconds'.format(int(seconds)),)
+        )
+        for job in jobs:
+            job['args'] = json.loads(job.get('args'))
+        return jobs
+
+    @staticmethod
+    def delete(job_id, commit=True):
+        """Delete an existing export job record and optionally commit.
+        @param job_id: the job's unique identifier in the database.
+        @param commit: if True, autocommit after deleting the job record (default: True).
+        @return: a SQLite3 cursor object.
+        """
+        return db.execute_statement(
+            "delete from ExportJobs where job_id=?",
+            (job_id,),
+            commit=commit
+        )
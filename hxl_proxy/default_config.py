@@ -1,5 +1,47 @@
 DEBUG=True
 DB_FILE='/tmp/hxl-proxy.db'
+CACHE_TYPE='hxl_proxy.cache_backends.sqlite'
+CACHE_SQLITE_FILE='/tmp/hxl-proxy-cache.db'
+CACHE_MAX_BYTES=256*1024*1024
+CACHE_DEFAULT_TIMEOUT=3600
+CACHE_MAX_ENTRY_SIZE=16*1024*1024
+CACHE_STALE_TIMEOUT=600
+CACHE_REVALIDATE_MAX_WORKERS=2
+COALESCE_TIMEOUT=60
+UPSTREAM_CHECK_INTERVAL=300
+UPSTREAM_TIMEOUT=30
+UPSTREAM_RETRIES=2
+UPSTREAM_BACKOFF=0.5
+UPSTREAM_POOL_SIZE=10
+FETCH_CACHE_DIR='/tmp/hxl-proxy-fetch'
+FETCH_CACHE_FRESHNESS=300
+FETCH_CACHE_MAX_ENTRY_SIZE=64*1024*1024
+FETCH_CACHE_MAX_BYTES=1024*1024*1024
+SNIFF_RANGE_BYTES=256*1024
+SIDE_CACHE_TTL=300
+SIDE_CACHE_MAX_ENTRIES=100
+SIDE_CACHE_MAX_ROWS=100000
+SIDE_FETCH_MAX_WORKERS=8
+SIDE_FETCH_MAX_PER_HOST=4
+PLAN_CACHE_MAX_ENTRIES=1000
+OPTIMISE_PIPELINES=False
+COLUMNAR_ENGINE=False
+SPILL_MAX_ROWS=0
+SPILL_DIR=None
+SNAPSHOT_DIR=None
+SNAPSHOT_CHECK_INTERVAL=60
+SNAPSHOT_MAX_AGE=3600
+EXPORT_DIR=None
+EXPORT_MAX_WORKERS=2
+EXPORT_RETENTION=86400
+SCHEMA_CACHE_TTL=3600
+SCHEMA_CACHE_MAX_ENTRIES=50
+VALIDATION_MAX_EXAMPLES=100
+VALIDATION_PAGE_SIZE=100
+VALIDATION_PROCESSES=0
+VALIDATION_CHUNK_SIZE=10000
+STATS_MAX_WORKERS=2
+STATS_MAX_DISTINCT=10000
 
 HID_CLIENT_ID = '<client id>'
 HID_CLIENT_SECRET = '<client secret>'
@@ -0,0 +1,211 @@
+"""
+Background export jobs for large recipes.
+
+A big recipe can take longer to run than the gateway in front of the
+HXL Proxy will wait for /data to answer. Instead, a client can
+L{submit} an export job: the job runs the same pipeline as /data (see
+L{hxl_proxy.filters.setup_filters}) in a small pool of background
+threads (at most C{EXPORT_MAX_WORKERS} at a time in each worker
+process), and writes the CSV or JSON output to a file in
+C{EXPORT_DIR}.
+
+Each job has a record in the ExportJobs table (see L{hxl_proxy.dao.exports}),
+with its status ('queued', 'running', 'done', or 'failed'), and the
+number of rows processed and bytes written so far, so any worker
+process can report its progress and serve the finished file. Jobs and
+their files disappear C{EXPORT_RETENTION} seconds after they last
+changed (see L{purge_expired}).
+
+The jobs themselves live only in the process that queued them, so a
+heartbeat thread in each process touches the records of its queued and
+running jobs every L{PROGRESS_INTERVAL} seconds. If the process dies
+or restarts, its jobs stop changing, and after L{STALL_TIMEOUT}
+seconds they count as failed.
+"""
+
+import concurrent.futures, os, tempfile, threading, time, uuid
+
+import hxl
+
+from hxl_proxy import app, dao, filters, snapshots
+
+FORMATS = snapshots.FORMATS
+"""Export formats and their MIME types (the same as for snapshots)."""
+
+# Seconds between progress updates (and heartbeats) in the database
+PROGRESS_INTERVAL = 1.0
+
+STALL_TIMEOUT = 5 * PROGRESS_INTERVAL
+"""Seconds after which a queued or running job that hasn't changed counts as failed."""
+
+STALL_ERROR = 'The export stopped unexpectedly (its worker process may have restarted).'
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config.get('EXPORT_MAX_WORKERS') or 1)
+
+# Ids of the jobs queued or running in this process
+_active = set()
+_active_lock = threading.Lock()
+
+_heartbeat = None
+_heartbeat_lock = threading.Lock()
+
+
+def submit(recipe, format):
+    """Queue an export job for a recipe's output.
+    The job runs the recipe's arguments as they are now, so later edits
+    to a saved recipe don't change an export that's already queued.
+    @param recipe: the recipe (from L{hxl_proxy.util.get_recipe}).
+    @param format: 'csv' or 'json'.
+    @return: the new job (see L{get_job}).
+    @exception ValueError: if the format isn't in L{FORMATS}.
+    """
+    if format not in FORMATS:
+        raise ValueError('Unsupported export format: {}'.format(format))
+    purge_expired()
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'recipe_id': recipe.get('recipe_id'),
+        'format': format,
+        'stub': recipe.get('stub'),
+        'args': dict(recipe['args']),
+        'status': 'queued'
+    }
+    dao.exports.create(job)
+    with _active_lock:
+        _active.add(job['job_id'])
+    _start_heartbeat()
+    _executor.submit(_run, job['job_id'])
+    return get_job(job['job_id'])
+
+def get_job(job_id):
+    """Look up an export job.
+    @param job_id: the id from L{submit}.
+    @return: a dict of job properties (see L{hxl_proxy.dao.exports}), or None if there's no such job (or it expired).
+    """
+    dao.exports.fail_stalled(STALL_TIMEOUT, STALL_ERROR, job_id)
+    return dao.exports.read(job_id)
+
+def get_file(job):
+    """Find the output file of a finished export job.
+    @param job: a job from L{get_job}.
+    @return: the path to the file, or None if the job isn't done (or its file is gone).
+    """
+    if job['status'] != 'done':
+        return None
+    path = _get_path(job)
+    return path if path is not None and os.path.exists(path) else None
+
+def purge_expired():
+    """Delete the jobs (and their files) that haven't changed for C{EXPORT_RETENTION} seconds.
+    Also marks stalled jobs as failed (see L{STALL_TIMEOUT}).
+    """
+    dao.exports.fail_stalled(STALL_TIMEOUT, STALL_ERROR)
+    retention = app.config.get('EXPORT_RETENTION')
+    if not retention:
+        return
+    for job in dao.exports.list_expired(retention):
+        path = _get_path(job)
+        if path is not None and os.path.exists(path):
+            os.unlink(path)
+        dao.exports.delete(job['job_id'])
+
+def _run(job_id):
+    """Run an export job, and record its progress (runs in a worker thread)."""
+    try:
+        with app.app_context():
+            job = dao.exports.read(job_id)
+            if job is None or job['status'] != 'queued':
+                # expired, or given up for dead
+                return
+            try:
+                job['status'] = 'running'
+                dao.exports.update(job)
+                _export(job)
+                job['status'] = 'done'
+            except Exception as e:
+                app.logger.warning('Export %s failed: %s', job_id, e)
+                job['status'] = 'failed'
+                job['error'] = str(e)
+            dao.exports.update(job)
+    finally:
+        with _active_lock:
+            _active.discard(job_id)
+
+def _start_heartbeat():
+    """Start the thread that keeps this process's jobs alive in the database, unless it's running."""
+    global _heartbeat
+    if _heartbeat is not None:
+        return
+    with _heartbeat_lock:
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_run_heartbeat, name='export-heartbeat', daemon=True)
+            _heartbeat.start()
+
+def _run_heartbeat():
+    while True:
+        time.sleep(PROGRESS_INTERVAL)
+        try:
+            _beat()
+        except Exception as e:
+            app.logger.warning('Export heartbeat failed: %s', e)
+
+def _beat():
+    """Touch the records of the jobs queued or running in this process."""
+    with _active_lock:
+        job_ids = list(_active)
+    if job_ids:
+        with app.app_context():
+            dao.exports.touch(job_ids)
+
+def _export(job):
+    """Write a job's output to its file in EXPORT_DIR, updating job['rows'] and job['bytes'] as it goes."""
+    directory = app.config.get('EXPORT_DIR')
+    os.makedirs(directory, exist_ok=True)
+    source = ProgressRecorder(filters.setup_filters({'args': job['args']}))
+    show_headers = (job['args'].get('strip-headers') != 'on')
+    if job['format'] == 'json':
+        chunks = source.gen_json(show_headers=show_headers)
+    else:
+        chunks = source.gen_csv(show_headers=show_headers)
+
+    # write to a temporary file, so the download never sees half an export
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + job['job_id'])
+    try:
+        with open(fd, 'wb') as output:
+            last_update = time.time()
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                output.write(data)
+                job['bytes'] += len(data)
+                job['rows'] = source.row_count
+                if time.time() - last_update >= PROGRESS_INTERVAL:
+                    dao.exports.update(job)
+                    last_update = time.time()
+            job['rows'] = source.row_count
+        os.replace(temp_path, _get_path(job))
+    except:
+        os.unlink(temp_path)
+        raise
+
+def _get_path(job):
+    directory = app.config.get('EXPORT_DIR')
+    return os.path.join(directory, '{}.{}'.format(job['job_id'], job['format'])) if directory else None
+
+
+class ProgressRecorder(hxl.Dataset):
+    """Pass through a dataset unchanged, counting the rows."""
+
+    def __init__(self, source):
+        self.source = source
+        self.row_count = 0
+
+    @property
+    def columns(self):
+        return self.source.columns
+
+    def __iter__(self):
+        for row in self.source:
+            self.row_count += 1
+            yield row
+
+# end
@@ -0,0 +1,522 @@
+"""
+Upstream data access for the HXL Proxy.
+
+Every read of a source dataset goes through this module (and from
+here, over the shared connections in L{hxl_proxy.upstream}), so that
+the proxy can remember the HTTP validators (ETag and Last-Modified) that
+upstream servers send with their data, and later ask those servers
+whether the data has changed without downloading it again.
+
+The raw bytes of each source also go into a small on-disk cache (the
+C{FETCH_CACHE_DIR} config option), so that several page views of the
+same recipe download the source only once. An entry younger than
+C{FETCH_CACHE_FRESHNESS} seconds is used as-is; an older one is
+revalidated with a conditional GET, and downloaded again only if the
+upstream server says that it changed.
+
+Auxiliary datasets (for merges, appends, and replacement maps) are
+usually small lookup tables, so L{get_side_data} also keeps the parsed
+rows in memory for C{SIDE_CACHE_TTL} seconds (unless there are more
+than C{SIDE_CACHE_MAX_ROWS} of them, in which case they stream).
+
+A recipe can read many auxiliary datasets (e.g. a dozen monthly
+reports to append), so L{prefetch_side_data} downloads them all at
+once in a small thread pool before the pipeline starts, with at most
+C{SIDE_FETCH_MAX_PER_HOST} downloads from any one server.
+
+The tagger needs only the first few rows of a source, so L{sniff_rows}
+asks for just the first C{SNIFF_RANGE_BYTES} bytes with an HTTP Range
+request, and remembers the rows for each URL and sheet.
+"""
+
+import concurrent.futures, hashlib, io, itertools, json, os, tempfile, threading, time, urllib.parse
+
+import hxl
+import requests
+
+from hxl_proxy import app, memo, upstream
+
+
+MAX_VALIDATORS = 10000
+"""Maximum number of URLs to remember validators for."""
+
+CHECK_TIMEOUT = 10
+"""Timeout in seconds for asking an upstream server whether its data changed."""
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+_side_data = memo.MemoCache(app.config.get('SIDE_CACHE_MAX_ENTRIES'), app.config.get('SIDE_CACHE_TTL'))
+
+# Marks an auxiliary dataset in _side_data as too big to keep in memory
+_TOO_BIG = object()
+
+# Thread pool for prefetching auxiliary datasets, and a semaphore for each host
+_prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config.get('SIDE_FETCH_MAX_WORKERS') or 1)
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+# First rows of sources for the tagger, keyed by (url, sheet_index, max_rows)
+_sniffs = memo.MemoCache(app.config.get('SIDE_CACHE_MAX_ENTRIES'), app.config.get('FETCH_CACHE_FRESHNESS'))
+
+
+def make_input(url, sheet_index=None):
+    """Open a source URL as raw HXL input.
+    @param url: the URL of the source dataset.
+    @param sheet_index: (optional) the 0-based sheet to read from a workbook.
+    @return: a hxl.io input object, suitable for hxl.data() or a Tagger.
+    """
+    return hxl.io.make_input(open_stream(url), sheet_index=sheet_index)
+
+def open_dataset(url):
+    """Open a source URL as a HXL dataset (e.g. for a merge or append).
+    The dataset comes from the in-memory copy if there is one (see
+    L{get_side_data}); otherwise, it streams from the source.
+    """
+    return open_side_data(url)[1]
+
+def open_side_data(url):
+    """Open an auxiliary dataset, reading it into memory if it's small enough (see L{get_side_data}).
+    A dataset that turns out to be too big streams on from where the
+    check stopped, over the same download.
+    @param url: the URL of the auxiliary dataset.
+    @return: a tuple of the in-memory rows (shared between requests, so
+    don't change them), or None if the dataset is too big; and a dataset
+    to read (with its own copies of the rows).
+    """
+    data = _side_data.get(url)
+    if data is _TOO_BIG:
+        return None, hxl.data(make_input(url))
+    if data is None:
+        data, stream, remaining = _read_side_data(url)
+        if data is None:
+            return None, hxl.data(hxl.io.ArrayInput(remaining))
+    # copy each row as it's read, so that no filter can change the shared ones
+    return data, hxl.data(hxl.io.ArrayInput(list(row) for row in data))
+
+def get_side_data(url):
+    """Read an auxiliary dataset as raw rows, using the in-memory copy if possible.
+    Only datasets with up to C{SIDE_CACHE_MAX_ROWS} rows are kept in
+    memory; for bigger ones, this stops parsing as soon as it passes the
+    limit (and remembers that, so that later reads stream straight
+    away), and returns None, so that the caller can stream the dataset
+    instead. The rest of the download still goes into the fetch cache,
+    so the caller's stream doesn't have to download it again. The
+    returned object is shared between requests, so callers must not change it.
+    @param url: the URL of the auxiliary dataset.
+    @return: a tuple of rows (a header row, a hashtag row, then the data), suitable for hxl.data(), or None.
+    """
+    data = _side_data.get(url)
+    if data is None:
+        data, stream, remaining = _read_side_data(url)
+        if data is None:
+            try:
+                if isinstance(stream, _CachingStream):
+                    # finish the download, so that the fetch cache keeps a copy
+                    for block in iter(lambda: stream.read(65536), b''):
+                        pass
+            finally:
+                stream.close()
+    return None if data is _TOO_BIG else data
+
+def prefetch_side_data(urls):
+    """Read several auxiliary datasets concurrently, so that the filters find them ready.
+    Returns when all of them are done. Small datasets end up in memory (see
+    L{get_side_data}); bigger ones stream when the filter opens them. Errors
+    are ignored here: the filter that needs the dataset will report them.
+    @param urls: a list of URLs of auxiliary datasets.
+    """
+    urls = [url for url in set(urls) if _side_data.get(url) is None]
+    if len(urls) < 2:
+        # nothing to gain from a thread
+        return
+    concurrent.futures.wait([_prefetch_executor.submit(_prefetch, url) for url in urls])
+
+def sniff_rows(url, sheet_index=None, max_rows=25):
+    """Read the first few raw rows of a source, without downloading all of it if possible.
+    CSV sources come from an HTTP Range request for the first
+    C{SNIFF_RANGE_BYTES} bytes (if the server supports it), or else from
+    a download that stops after max_rows. Excel workbooks can't be read
+    from a prefix, so they go through L{open_stream}, which at least
+    leaves a copy in the fetch cache for the next page. The rows stay in
+    memory for C{FETCH_CACHE_FRESHNESS} seconds.
+    @param url: the URL of the source dataset.
+    @param sheet_index: (optional) the 0-based sheet to read from a workbook.
+    @param max_rows: the maximum number of rows to read.
+    @return: a tuple of rows (lists of strings). Shared between requests, so don't change it.
+    """
+    return _sniffs.get_or_create((url, sheet_index, max_rows), lambda: _read_rows(url, sheet_index, max_rows))
+
+def open_stream(url):
+    """Open the raw byte stream for a source URL, using the fetch cache if possible.
+    @param url: the URL of the source dataset.
+    @return: a readable binary stream.
+    """
+    cache_dir = app.config.get('FETCH_CACHE_DIR')
+    if not cache_dir:
+        stream = upstream.open_url(url)
+        _save_validators(url, getattr(stream, 'headers', None))
+        return stream
+
+    data_path, meta_path = _get_paths(cache_dir, url)
+    meta = _read_meta(meta_path)
+    if meta is not None and os.path.exists(data_path):
+        freshness = app.config.get('FETCH_CACHE_FRESHNESS', 0)
+        if time.time() - meta['fetched'] < freshness:
+            _remember_validators(url, meta['validators'])
+            return open(data_path, 'rb')
+        response = _conditional_get(url, meta['validators'])
+        if response is not None and response.status_code == 304:
+            # still good: restart the freshness window
+            response.close()
+            meta['fetched'] = time.time()
+            _write_meta(meta_path, meta)
+            os.utime(data_path)
+            _remember_validators(url, meta['validators'])
+            return open(data_path, 'rb')
+        elif response is not None and response.status_code == 200:
+            response.raw.decode_content = True
+            _save_validators(url, response.headers)
+            return _CachingStream(response.raw, url, data_path, meta_path, get_validators(url))
+        elif response is not None:
+            response.close()
+
+    stream = upstream.open_url(url)
+    _save_validators(url, getattr(stream, 'headers', None))
+    return _CachingStream(stream, url, data_path, meta_path, get_validators(url))
+
+def get_fingerprint(url):
+    """Get a digest of a source's current content.
+    Uses the digest saved with a fresh copy in the fetch cache if there
+    is one; otherwise reads the source (leaving a copy in the fetch
+    cache for whatever reads it next).
+    @param url: the URL of the source dataset.
+    @return: a SHA-256 hex digest of the raw bytes.
+    """
+    cache_dir = app.config.get('FETCH_CACHE_DIR')
+    if cache_dir and _has_fresh_copy(url):
+        meta = _read_meta(_get_paths(cache_dir, url)[1])
+        if meta and meta.get('sha256'):
+            _remember_validators(url, meta['validators'])
+            return meta['sha256']
+    digest = hashlib.sha256()
+    stream = open_stream(url)
+    try:
+        for block in iter(lambda: stream.read(65536), b''):
+            digest.update(block)
+    finally:
+        stream.close()
+    return digest.hexdigest()
+
+def forget(urls):
+    """Drop source URLs from the fetch cache and the in-memory side data, so that the next read downloads them again.
+    @param urls: a list of source URLs.
+    """
+    urls = set(urls)
+    _side_data.forget(lambda url: url in urls)
+    _sniffs.forget(lambda key: key[0] in urls)
+    cache_dir = app.config.get('FETCH_CACHE_DIR')
+    if not cache_dir:
+        return
+    for url in urls:
+        for path in _get_paths(cache_dir, url):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def get_validators(url):
+    """Get the validators that the upstream server sent the last time we opened a URL.
+    @param url: the URL of the source dataset.
+    @return: a dict with 'etag' and/or 'last_modified' (empty if the server sent neither).
+    """
+    with _validators_lock:
+        return dict(_validators.get(url, {}))
+
+def is_modified(url, validators):
+    """Ask the upstream server whether a URL has changed since we saw these validators.
+    If the server can't tell us (no validators, or a network error), assume
+    modified only when we have nothing to compare against.
+    @param url: the URL of the source dataset.
+    @param validators: a dict from L{get_validators}.
+    @return: True if the data has (or may have) changed.
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    if not headers:
+        return True
+    try:
+        response = upstream.request('HEAD', hxl.io.munge_url(url), headers=headers, allow_redirects=True, timeout=CHECK_TIMEOUT)
+    except requests.RequestException:
+        # upstream unreachable; keep using what we have
+        return False
+    if response.status_code == 304:
+        return False
+    elif response.status_code != 200:
+        return True
+    elif validators.get('etag'):
+        return response.headers.get('ETag') != validators['etag']
+    else:
+        return response.headers.get('Last-Modified') != validators['last_modified']
+
+def _prefetch(url):
+    """Read an auxiliary dataset, waiting for a turn if its host is already busy (runs in a worker thread)."""
+    with _get_host_semaphore(url):
+        try:
+            get_side_data(url)
+        except Exception as e:
+            app.logger.debug('Failed to prefetch %s: %s', url, e)
+
+def _read_side_data(url):
+    """Read an auxiliary dataset into memory, unless it has more than C{SIDE_CACHE_MAX_ROWS} rows.
+    Either way, remembers the result in _side_data.
+    @return: a tuple of the rows (or None if there were too many), and
+    if there were too many, the open stream and an iterator over all
+    the rows (including those already read), or else None and None.
+    """
+    max_rows = app.config.get('SIDE_CACHE_MAX_ROWS')
+    stream = open_stream(url)
+    try:
+        source = hxl.data(hxl.io.make_input(stream))
+        columns = source.columns
+        rows = [[column.header or '' for column in columns], [column.display_tag for column in columns]]
+        source_rows = iter(source)
+        for row in source_rows:
+            if max_rows and len(rows) - 2 >= max_rows:
+                _side_data.set(url, _TOO_BIG)
+                remaining = itertools.chain(rows, [row.values], (row.values for row in source_rows))
+                return None, stream, remaining
+            rows.append(row.values)
+    except:
+        stream.close()
+        raise
+    stream.close()
+    data = tuple(rows)
+    _side_data.set(url, data)
+    return data, None, None
+
+def _get_host_semaphore(url):
+    host = urllib.parse.urlparse(hxl.io.munge_url(url)).netloc.lower()
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(app.config.get('SIDE_FETCH_MAX_PER_HOST') or 1)
+            _host_semaphores[host] = semaphore
+        return semaphore
+
+def _read_rows(url, sheet_index, max_rows):
+    """Read up to max_rows raw rows from the start of a source."""
+    stream = _open_prefix(url)
+    if stream is None:
+        stream = open_stream(url)
+    try:
+        rows = []
+        for row in hxl.io.make_input(stream, sheet_index=sheet_index):
+            if len(rows) >= max_rows:
+                break
+            rows.append(row)
+        return tuple(rows)
+    finally:
+        stream.close()
+
+def _open_prefix(url):
+    """Open the start of a CSV source with an HTTP Range request.
+    @return: a readable binary stream ending on a line break, or None if
+    the source is already in the fetch cache, is a workbook, or the request failed.
+    """
+    max_bytes = app.config.get('SNIFF_RANGE_BYTES')
+    if not max_bytes or _has_fresh_copy(url):
+        return None
+    try:
+        response = upstream.request(
+            'GET',
+            hxl.io.munge_url(url),
+            headers={'Range': 'bytes=0-{}'.format(max_bytes - 1), 'Accept-Encoding': 'identity'},
+            stream=True,
+            timeout=CHECK_TIMEOUT
+        )
+    except requests.RequestException:
+        return None
+    if response.status_code == 200:
+        # the server ignored the Range header; read only as far as we need
+        stream = io.BufferedReader(response.raw)
+        if stream.peek(4)[:4] not in hxl.io.EXCEL_SIGS:
+            return stream
+    elif response.status_code == 206:
+        data = response.raw.read(max_bytes)
+        if data[:4] not in hxl.io.EXCEL_SIGS:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) <= len(data):
+                return io.BytesIO(data)
+            # drop the partial last line
+            end = data.rfind(b'\n')
+            if end >= 0:
+                return io.BytesIO(data[:end+1])
+    response.close()
+    return None
+
+def _has_fresh_copy(url):
+    """Check if the fetch cache has a copy of a source that's still inside the freshness window."""
+    cache_dir = app.config.get('FETCH_CACHE_DIR')
+    if not cache_dir:
+        return False
+    data_path, meta_path = _get_paths(cache_dir, url)
+    meta = _read_meta(meta_path)
+    return (
+        meta is not None and os.path.exists(data_path) and
+        time.time() - meta['fetched'] < app.config.get('FETCH_CACHE_FRESHNESS', 0)
+    )
+
+def _conditional_get(url, validators):
+    """Revalidate a cached source with a conditional GET.
+    @return: a streaming requests response, or None if we have no validators or the request failed.
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    if not headers:
+        return None
+    try:
+        return upstream.request('GET', hxl.io.munge_url(url), headers=headers, stream=True, timeout=CHECK_TIMEOUT)
+    except requests.RequestException:
+        return None
+
+def _save_validators(url, headers):
+    """Remember the ETag and Last-Modified headers from an upstream response."""
+    validators = {}
+    if headers is not None:
+        if headers.get('ETag'):
+            validators['etag'] = headers.get('ETag')
+        if headers.get('Last-Modified'):
+            validators['last_modified'] = headers.get('Last-Modified')
+    _remember_validators(url, validators)
+
+def _remember_validators(url, validators):
+    with _validators_lock:
+        if validators:
+            if url not in _validators and len(_validators) >= MAX_VALIDATORS:
+                _validators.clear()
+            _validators[url] = validators
+        else:
+            _validators.pop(url, None)
+
+def _get_paths(cache_dir, url):
+    """Get the data and metadata filenames for a URL in the fetch cache."""
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.data'), os.path.join(cache_dir, name + '.json')
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r') as input:
+            return json.load(input)
+    except (OSError, ValueError):
+        return None
+
+def _write_meta(meta_path, meta):
+    _write_atomically(meta_path, json.dumps(meta).encode('utf-8'))
+
+def _write_atomically(path, data):
+    """Write a file under a temporary name, then rename it, so readers never see a partial file."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as output:
+        output.write(data)
+    os.replace(temp_path, path)
+
+def _prune(cache_dir, max_bytes):
+    """Remove the least-recently-fetched sources until the fetch cache is under max_bytes."""
+    entries = []
+    total = 0
+    for filename in os.listdir(cache_dir):
+        if filename.endswith('.data'):
+            path = os.path.join(cache_dir, filename)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+            total += info.st_size
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for victim in (path, path[:-len('.data')] + '.json'):
+            try:
+                os.remove(victim)
+            except OSError:
+                pass
+        total -= size
+
+
+class _CachingStream(io.RawIOBase):
+    """Read from an upstream stream, saving a copy in the fetch cache.
+    The copy is saved only if the stream is read to the end and is no
+    bigger than C{FETCH_CACHE_MAX_ENTRY_SIZE}.
+    """
+
+    def __init__(self, stream, url, data_path, meta_path, validators):
+        self.stream = stream
+        self.data_path = data_path
+        self.meta_path = meta_path
+        self.meta = {'url': url, 'validators': validators}
+        self.max_size = app.config.get('FETCH_CACHE_MAX_ENTRY_SIZE')
+        self.size = 0
+        self.digest = hashlib.sha256()
+        try:
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(data_path))
+            self.output = os.fdopen(fd, 'wb')
+        except OSError:
+            # can't write to the cache; just pass the data through
+            self.output = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        if self.output is not None:
+            if data:
+                self.size += len(data)
+                if self.max_size and self.size > self.max_size:
+                    self._discard()
+                else:
+                    self.output.write(data)
+                    self.digest.update(data)
+            else:
+                self._save()
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._discard()
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+        super(_CachingStream, self).close()
+
+    def _save(self):
+        """Move the finished copy into place."""
+        self.output.close()
+        self.output = None
+        self.meta['fetched'] = time.time()
+        self.meta['sha256'] = self.digest.hexdigest()
+        try:
+            os.replace(self.temp_path, self.data_path)
+            _write_meta(self.meta_path, self.meta)
+        except OSError:
+            return
+        max_bytes = app.config.get('FETCH_CACHE_MAX_BYTES')
+        if max_bytes:
+            _prune(os.path.dirname(self.data_path), max_bytes)
+
+    def _discard(self):
+        """Give up on saving a copy (stream too big, or closed early)."""
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+            os.remove(self.temp_path)
+
+# end
@@ -5,15 +5,57 @@ The main entry point is setup_filters()
 The GET parameters have numbers appended, e.g. "rename-oldtag7". This
 module uses the numbers to group the parameters, then to construct the
 hxl.filter objects from them and build a pipeline.
+
+Parsing happens only once per recipe: get_plan() compiles the arguments
+into an immutable PipelinePlan (parsed tag patterns and columns, the
+list of filter steps, and the side-input URLs), and keeps it in memory.
+build_pipeline() then turns a plan into a fresh chain of hxl.Dataset
+filters for each request, after downloading any auxiliary datasets in
+parallel (see hxl_proxy.fetch.prefetch_side_data()). If the
+OPTIMISE_PIPELINES config option is set, the plan's steps also go
+through hxl_proxy.optimiser first. The sort, count, and dedup steps
+use the filters in hxl_proxy.spill if SPILL_MAX_ROWS is set, or else
+the ones in hxl_proxy.columnar if COLUMNAR_ENGINE is set (and numpy is
+installed).
 """
 
+import collections, copy, hashlib, json, re, types
+
 import hxl
 import hxl.filters # why do we have to import this???
 from hxl.converters import Tagger
 
+from hxl_proxy import app, columnar, fetch, memo, optimiser, spill
+
 # Maximum number of filters to check
 MAX_FILTER_COUNT = 99
 
+# Alternative names that setup_filters() accepts for some filters
+FILTER_ALIASES = {
+    'column': 'cut',
+    'rows': 'select'
+}
+
+# Parameter names that belong to a numbered filter, e.g. "count-tags03" or "select-query02-01"
+FILTER_PARAM_PATTERN = re.compile(r'^(.+?)(\d\d)(-\d\d)?$')
+
+# Parameter names for the tagger, e.g. "tagger-01-header"
+TAGGER_PARAM_PATTERN = re.compile(r'^tagger-(\d+)-(header|tag)$')
+
+# Compiled plans, keyed by a digest of the arguments that they depend on
+_plans = memo.MemoCache(app.config.get('PLAN_CACHE_MAX_ENTRIES'), None)
+
+# Merge indexes and replacement lists built from auxiliary datasets,
+# so that a cached lookup table isn't indexed again on every request.
+# Each entry remembers the side data it came from (see fetch.get_side_data).
+_side_indexes = memo.MemoCache(app.config.get('SIDE_CACHE_MAX_ENTRIES'), app.config.get('SIDE_CACHE_TTL'))
+
+PipelinePlan = collections.namedtuple('PipelinePlan', ['url', 'sheet_index', 'tagger_specs', 'steps', 'source_urls'])
+"""A compiled filter pipeline (see compile_plan()). Shared between requests, so never modify one."""
+
+PipelineStep = collections.namedtuple('PipelineStep', ['filter', 'params'])
+"""One filter in a PipelinePlan: the filter name, and its parsed parameters (a read-only dict)."""
+
 def setup_filters(recipe):
     """
     Open a stream to a data source URL, and create a filter pipeline based on the arguments.
@@ -25,89 +67,194 @@ def setup_filters(recipe):
     if not recipe or not recipe['args'].get('url'):
         return None
 
-    # Basic input source
-    source = hxl.data(make_tagged_input(recipe['args']))
+    return build_pipeline(get_plan(recipe['args']))
 
-    # Create the filter pipeline from the source
+def get_plan(args):
+    """
+    Get the compiled plan for a set of recipe arguments, compiling it only if it isn't already in memory.
+    Equivalent recipes (see normalise_args()) share the same plan.
+    @param args the recipe arguments
+    @return a PipelinePlan
+    """
+    args = normalise_args(args)
+    optimise = bool(app.config.get('OPTIMISE_PIPELINES'))
+    key = _make_plan_key(args, optimise)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = compile_plan(args, optimise)
+        _plans.set(key, plan)
+    return plan
+
+def compile_plan(args, optimise=False):
+    """
+    Parse recipe arguments into a PipelinePlan.
+    @param args the recipe arguments
+    @param optimise if True, reorder, fuse, and drop steps (see hxl_proxy.optimiser)
+    @return a new PipelinePlan
+    @exception Exception if the recipe uses an unknown filter
+    """
+    args = normalise_args(args)
+    steps = []
     for index in range(1, MAX_FILTER_COUNT):
-        filter = recipe['args'].get('filter%02d' % index)
-        if filter == 'add':
-            source = add_add_filter(source, recipe['args'], index)
-        elif filter == 'clean':
-            source = add_clean_filter(source, recipe['args'], index)
-        elif filter == 'count':
-            source = add_count_filter(source, recipe['args'], index)
-        elif filter == 'column' or filter == 'cut':
-            source = add_column_filter(source, recipe['args'], index)
-        elif filter == 'dedup':
-            source = add_dedup_filter(source, recipe['args'], index)
-        elif filter == 'merge':
-            source = add_merge_filter(source, recipe['args'], index)
-        elif filter == 'rename':
-            source = add_rename_filter(source, recipe['args'], index)
-        elif filter == 'rows' or filter == 'select':
-            source = add_row_filter(source, recipe['args'], index)
-        elif filter == 'sort':
-            source = add_sort_filter(source, recipe['args'], index)
-        elif filter == 'append':
-            source = add_append_filter(source, recipe['args'], index)
-        elif filter == 'replace':
-            source = add_replace_filter(source, recipe['args'], index)
-        elif filter == 'replace-map':
-            source = add_replace_map_filter(source, recipe['args'], index)
-        elif filter:
+        filter = args.get('filter%02d' % index)
+        if not filter:
+            # normalise_args() numbers the filters consecutively
+            break
+        elif filter not in FILTER_FUNCTIONS:
             raise Exception("Unknown filter type '{}'".format(filter))
+        steps.append(PipelineStep(filter, _freeze(FILTER_FUNCTIONS[filter][0](args, index))))
+    if optimise:
+        steps = optimiser.optimise(steps)
+
+    source_urls = [args.get('url')] + _get_side_urls(steps)
 
+    return PipelinePlan(
+        url=args.get('url'),
+        sheet_index=int(args.get('sheet')) if args.get('sheet') else None,
+        tagger_specs=_parse_tagger_specs(args),
+        steps=tuple(steps),
+        source_urls=tuple(url for url in source_urls if url)
+    )
+
+def build_pipeline(plan, wrap=None):
+    """
+    Open the data source for a plan, and chain its filters.
+    @param plan a PipelinePlan (see get_plan())
+    @param wrap (optional) a function wrap(source, step) that returns a
+    dataset to use in place of each stage's output, e.g. to watch the
+    rows go past; step is None for the input stage.
+    @return a HXL DataSource representing the full pipeline.
+    """
+    # download the auxiliary datasets side by side, rather than one filter at a time
+    fetch.prefetch_side_data(_get_side_urls(plan.steps))
+    source = hxl.data(_make_tagged_input(plan))
+    if wrap:
+        source = wrap(source, None)
+    for step in plan.steps:
+        source = FILTER_FUNCTIONS[step.filter][1](source, step.params)
+        if wrap:
+            source = wrap(source, step)
     return source
 
+def normalise_args(args):
+    """
+    Make a canonical copy of recipe arguments, for comparing recipes.
+    Drops empty values, and parameters for filter numbers that have
+    no filter; renumbers the remaining filters consecutively (keeping
+    their order); and replaces filter aliases with their main names.
+    Two recipes with the same normalised arguments produce the same
+    pipeline.
+    @param args the recipe arguments
+    @return a new dict of arguments
+    """
+    indices = {}
+    for index in range(1, MAX_FILTER_COUNT):
+        if args.get('filter%02d' % index):
+            indices['%02d' % index] = '%02d' % (len(indices) + 1)
+    result = {}
+    for name in args:
+        value = args.get(name)
+        if not value:
+            continue
+        match = FILTER_PARAM_PATTERN.match(name)
+        if match:
+            index = indices.get(match.group(2))
+            if index is None:
+                # not used by setup_filters()
+                continue
+            if match.group(1) == 'filter':
+                value = FILTER_ALIASES.get(value, value)
+            name = match.group(1) + index + (match.group(3) or '')
+        result[name] = value
+    return result
+
+def get_plan_key(args):
+    """
+    Make a digest of the recipe arguments that affect a pipeline's output.
+    Equivalent recipes (see normalise_args()) get the same digest.
+    @param args the recipe arguments
+    @return a hex string
+    """
+    return _make_plan_key(normalise_args(args), False)
+
+def get_source_urls(args):
+    """
+    List the upstream URLs that a filter pipeline reads from.
+    Includes the main data URL, plus any datasets used by the append,
+    merge, and replace-map filters.
+    @param args the recipe arguments
+    @return a list of URLs, in pipeline order
+    """
+    return list(get_plan(args).source_urls)
+
 def make_tagged_input(args):
     """Create the raw input, optionally using the Tagger filter."""
-    url = args.get('url')
-    sheet_index = int(args.get('sheet')) if args.get('sheet') else None
-    input = hxl.io.make_input(url, sheet_index=sheet_index)
+    return _make_tagged_input(get_plan(args))
 
-    # Intercept tagging as a special data input
-    specs = []
-    for n in range(1, 101):
-        header = args.get('tagger-%02d-header' % n)
-        tag = _parse_tagspec(args.get('tagger-%02d-tag' % n))
-        if header and tag:
-            specs.append((header, tag))
-    if len(specs) > 0:
-        input = Tagger(input, specs)
+#
+# Filters: each one has a parse function, which reads its parameters
+# from the recipe arguments, and an apply function, which adds it to
+# the end of a pipeline. The add_*_filter() functions do both at once.
+#
 
-    return input
+def parse_add_filter(args, index):
+    tagspec = _parse_tagspec(args.get('add-tag%02d' % index))
+    header = args.get('add-header%02d' % index)
+    return {
+        'column': hxl.Column.parse(tagspec, header=header),
+        'value': args.get('add-value%02d' % index),
+        'before': (args.get('add-before%02d' % index) == 'on')
+    }
+
+def apply_add_filter(source, params):
+    # the filter may keep the column object, so don't share the plan's copy
+    values = [(copy.deepcopy(params['column']), params['value'])]
+    return source.add_columns(specs=values, before=params['before'])
 
 def add_add_filter(source, args, index):
     """Add the hxladd filter to the end of the chain."""
-    tagspec = _parse_tagspec(args.get('add-tag%02d' % index))
-    header = args.get('add-header%02d' % index)
-    value = args.get('add-value%02d' % index)
-    before = (args.get('add-before%02d' % index) == 'on')
-    values = [(hxl.Column.parse(tagspec, header=header), value)]
-    return source.add_columns(specs=values, before=before)
+    return apply_add_filter(source, parse_add_filter(args, index))
 
-def add_append_filter(source, args, index):
-    """Add the hxlappend filter to the end of the chain."""
-    exclude_columns = args.get('append-exclude-columns%02d' % index, False)
+def parse_append_filter(args, index):
+    urls = []
     for subindex in range(1, 100):
         dataset_url = args.get('append-dataset%02d-%02d' % (index, subindex))
         if dataset_url:
-            source = source.append(hxl.data(dataset_url), not exclude_columns)
+            urls.append(dataset_url)
+    return {
+        'urls': tuple(urls),
+        'add_columns': not args.get('append-exclude-columns%02d' % index, False)
+    }
+
+def apply_append_filter(source, params):
+    for dataset_url in params['urls']:
+        source = source.append(fetch.open_dataset(dataset_url), params['add_columns'])
     return source
 
+def add_append_filter(source, args, index):
+    """Add the hxlappend filter to the end of the chain."""
+    return apply_append_filter(source, parse_append_filter(args, index))
+
+def parse_clean_filter(args, index):
+    return {
+        'whitespace': hxl.TagPattern.parse_list(args.get('clean-whitespace-tags%02d' % index, '')),
+        'upper': hxl.TagPattern.parse_list(args.get('clean-toupper-tags%02d' % index, '')),
+        'lower': hxl.TagPattern.parse_list(args.get('clean-tolower-tags%02d' % index, '')),
+        'date': hxl.TagPattern.parse_list(args.get('clean-date-tags%02d' % index, '')),
+        'number': hxl.TagPattern.parse_list(args.get('clean-number-tags%02d' % index, ''))
+    }
+
+def apply_clean_filter(source, params):
+    return source.clean_data(
+        whitespace=list(params['whitespace']), upper=list(params['upper']), lower=list(params['lower']),
+        date=list(params['date']), number=list(params['number'])
+    )
+
 def add_clean_filter(source, args, index):
     """Add the hxlclean filter to the end of the pipeline."""
-    whitespace_tags = hxl.TagPattern.parse_list(args.get('clean-whitespace-tags%02d' % index, ''))
-    upper_tags = hxl.TagPattern.parse_list(args.get('clean-toupper-tags%02d' % index, ''))
-    lower_tags = hxl.TagPattern.parse_list(args.get('clean-tolower-tags%02d' % index, ''))
-    date_tags = hxl.TagPattern.parse_list(args.get('clean-date-tags%02d' % index, ''))
-    number_tags = hxl.TagPattern.parse_list(args.get('clean-number-tags%02d' % index, ''))
-    return source.clean_data(whitespace=whitespace_tags, upper=upper_tags, lower=lower_tags, date=date_tags, number=number_tags)
+    return apply_clean_filter(source, parse_clean_filter(args, index))
 
-def add_count_filter(source, args, index):
-    """Add the hxlcount filter to the end of the pipeline."""
-    tags = hxl.TagPattern.parse_list(args.get('count-tags%02d' % index, ''))
+def parse_count_filter(args, index):
     count_spec = args.get('count-spec%02d' % index, None)
     if not count_spec:
         count_spec = 'Count#meta+count'
@@ -116,70 +263,297 @@ def add_count_filter(source, args, index):
         aggregate_pattern = hxl.TagPattern.parse(aggregate_pattern)
     else:
         aggregate_pattern = None
-    return source.count(patterns=tags, aggregate_pattern=aggregate_pattern, count_spec=count_spec)
+    return {
+        'tags': hxl.TagPattern.parse_list(args.get('count-tags%02d' % index, '')),
+        'aggregate_pattern': aggregate_pattern,
+        'count_spec': count_spec
+    }
+
+def apply_count_filter(source, params):
+    if app.config.get('SPILL_MAX_ROWS'):
+        return spill.SpillingCountFilter(
+            source, list(params['tags']), aggregate_pattern=params['aggregate_pattern'], count_spec=params['count_spec'],
+            **_get_spill_options()
+        )
+    elif _use_columnar():
+        return columnar.ColumnarCountFilter(
+            source, list(params['tags']), aggregate_pattern=params['aggregate_pattern'], count_spec=params['count_spec']
+        )
+    return source.count(
+        patterns=list(params['tags']), aggregate_pattern=params['aggregate_pattern'], count_spec=params['count_spec']
+    )
+
+def add_count_filter(source, args, index):
+    """Add the hxlcount filter to the end of the pipeline."""
+    return apply_count_filter(source, parse_count_filter(args, index))
+
+def parse_column_filter(args, index):
+    return {
+        'include_tags': hxl.TagPattern.parse_list(args.get('cut-include-tags%02d' % index, [])),
+        'exclude_tags': hxl.TagPattern.parse_list(args.get('cut-exclude-tags%02d' % index, []))
+    }
+
+def apply_column_filter(source, params):
+    if params['include_tags']:
+        source = source.with_columns(list(params['include_tags']))
+    if params['exclude_tags']:
+        source = source.without_columns(list(params['exclude_tags']))
+    return source
 
 def add_column_filter(source, args, index):
     """Add the hxlcut filter to the end of the pipeline."""
-    include_tags = hxl.TagPattern.parse_list(args.get('cut-include-tags%02d' % index, []))
-    exclude_tags = hxl.TagPattern.parse_list(args.get('cut-exclude-tags%02d' % index, []))
-    if include_tags:
-        source = source.with_columns(include_tags)
-    if exclude_tags:
-        source = source.without_columns(exclude_tags)
-    return source
+    return apply_column_filter(source, parse_column_filter(args, index))
+
+def parse_dedup_filter(args, index):
+    return {
+        'tags': hxl.TagPattern.parse_list(args.get('dedup-tags%02d' % index, []))
+    }
+
+def apply_dedup_filter(source, params):
+    if app.config.get('SPILL_MAX_ROWS'):
+        return spill.SpillingDedupFilter(source, list(params['tags']), **_get_spill_options())
+    elif _use_columnar():
+        return columnar.ColumnarDedupFilter(source, list(params['tags']))
+    return source.dedup(list(params['tags']))
 
 def add_dedup_filter(source, args, index):
-    return source.dedup(args.get('dedup-tags%02d' % index, []))
+    return apply_dedup_filter(source, parse_dedup_filter(args, index))
+
+def parse_merge_filter(args, index):
+    return {
+        'tags': hxl.TagPattern.parse_list(args.get('merge-tags%02d' % index, [])),
+        'keys': hxl.TagPattern.parse_list(args.get('merge-keys%02d' % index, [])),
+        'replace': (args.get('merge-replace%02d' % index) == 'on'),
+        'overwrite': (args.get('merge-overwrite%02d' % index) == 'on'),
+        'url': args.get('merge-url%02d' % index)
+    }
+
+def apply_merge_filter(source, params):
+    url = params['url']
+    keys = list(params['keys'])
+    tags = list(params['tags'])
+    side_data, dataset = fetch.open_side_data(url)
+    if side_data is None:
+        # too big to keep in memory, so the filter reads it the usual way
+        return source.merge_data(
+            dataset, keys=keys, tags=tags, replace=params['replace'], overwrite=params['overwrite']
+        )
+    merge_filter = source.merge_data(
+        hxl.data(side_data), keys=keys, tags=tags, replace=params['replace'], overwrite=params['overwrite']
+    )
+    index_key = ('merge', url, tuple(str(key) for key in keys), tuple(str(tag) for tag in tags))
+    index = _get_side_index(index_key, side_data, lambda: _make_merge_index(merge_filter))
+    merge_filter.merge_map = _MergeMap(index, merge_filter.merge_tags)
+    return merge_filter
 
 def add_merge_filter(source, args, index):
     """Add the hxlmerge filter to the end of the pipeline."""
-    tags = hxl.TagPattern.parse_list(args.get('merge-tags%02d' % index, []))
-    keys = hxl.TagPattern.parse_list(args.get('merge-keys%02d' % index, []))
-    replace = (args.get('merge-replace%02d' % index) == 'on')
-    overwrite = (args.get('merge-overwrite%02d' % index) == 'on')
-    url = args.get('merge-url%02d' % index)
-    merge_source = hxl.data(url)
-    return source.merge_data(merge_source, keys=keys, tags=tags, replace=replace, overwrite=overwrite)
+    return apply_merge_filter(source, parse_merge_filter(args, index))
 
-def add_rename_filter(source, args, index):
-    """Add the hxlrename filter to the end of the pipeline."""
-    oldtag = hxl.TagPattern.parse(args.get('rename-oldtag%02d' % index))
+def parse_rename_filter(args, index):
     tagspec = _parse_tagspec(args.get('rename-newtag%02d' % index))
     header = args.get('rename-header%02d' % index)
-    column = hxl.Column.parse(tagspec, header=header)
-    return source.rename_columns([(oldtag, column)])
+    oldtag = hxl.TagPattern.parse(args.get('rename-oldtag%02d' % index))
+    # a list, so that the optimiser can fuse consecutive renames into one filter
+    return {
+        'specs': [(oldtag, hxl.Column.parse(tagspec, header=header))]
+    }
+
+def apply_rename_filter(source, params):
+    return source.rename_columns([(oldtag, copy.deepcopy(column)) for oldtag, column in params['specs']])
+
+def add_rename_filter(source, args, index):
+    """Add the hxlrename filter to the end of the pipeline."""
+    return apply_rename_filter(source, parse_rename_filter(args, index))
+
+def parse_replace_filter(args, index):
+    return {
+        'original': args.get('replace-pattern%02d' % index),
+        'replacement': args.get('replace-value%02d' % index),
+        'tags': args.get('replace-tags%02d' % index),
+        'use_regex': args.get('replace-regex%02d' % index)
+    }
+
+def apply_replace_filter(source, params):
+    return source.replace_data(params['original'], params['replacement'], params['tags'], params['use_regex'])
 
 def add_replace_filter(source, args, index):
     """Add the hxlreplace filter to the end of the pipeline."""
-    original = args.get('replace-pattern%02d' % index)
-    replacement = args.get('replace-value%02d' % index)
-    tags = args.get('replace-tags%02d' % index)
-    use_regex = args.get('replace-regex%02d' % index)
-    return source.replace_data(original, replacement, tags, use_regex)
+    return apply_replace_filter(source, parse_replace_filter(args, index))
+
+def parse_replace_map_filter(args, index):
+    return {
+        'url': args.get('replace-map-url%02d' % index)
+    }
+
+def apply_replace_map_filter(source, params):
+    url = params['url']
+    side_data, dataset = fetch.open_side_data(url)
+    if side_data is None:
+        replacements = hxl.filters.ReplaceDataFilter.Replacement.parse_map(dataset)
+    else:
+        replacements = _get_side_index(
+            ('replace-map', url), side_data,
+            lambda: hxl.filters.ReplaceDataFilter.Replacement.parse_map(hxl.data(side_data))
+        )
+    return hxl.filters.ReplaceDataFilter(source, replacements)
 
 def add_replace_map_filter(source, args, index):
     """Add the hxlreplace filter to the end of the pipeline."""
-    url = args.get('replace-map-url%02d' % index)
-    return source.replace_data_map(hxl.data(url))
+    return apply_replace_map_filter(source, parse_replace_map_filter(args, index))
 
-def add_row_filter(source, args, index):
-    """Add the hxlselect filter to the end of the pipeline."""
+def parse_row_filter(args, index):
     queries = []
     for subindex in range(1, 6):
         query = args.get('select-query%02d-%02d' % (index, subindex))
         if query:
             queries.append(query)
-    reverse = (args.get('select-reverse%02d' % index) == 'on')
-    if reverse:
-        return source.without_rows(queries)
+    # keep the queries as strings: a parsed RowQuery caches column indices as it runs
+    return {
+        'queries': tuple(queries),
+        'reverse': (args.get('select-reverse%02d' % index) == 'on')
+    }
+
+def apply_row_filter(source, params):
+    if params['reverse']:
+        return source.without_rows(list(params['queries']))
     else:
-        return source.with_rows(queries)
+        return source.with_rows(list(params['queries']))
+
+def add_row_filter(source, args, index):
+    """Add the hxlselect filter to the end of the pipeline."""
+    return apply_row_filter(source, parse_row_filter(args, index))
+
+def parse_sort_filter(args, index):
+    return {
+        'tags': hxl.TagPattern.parse_list(args.get('sort-tags%02d' % index, '')),
+        'reverse': (args.get('sort-reverse%02d' % index) == 'on')
+    }
+
+def apply_sort_filter(source, params):
+    if app.config.get('SPILL_MAX_ROWS'):
+        return spill.SpillingSortFilter(source, list(params['tags']), params['reverse'], **_get_spill_options())
+    elif _use_columnar():
+        return columnar.ColumnarSortFilter(source, list(params['tags']), params['reverse'])
+    return source.sort(list(params['tags']), params['reverse'])
 
 def add_sort_filter(source, args, index):
     """Add the hxlsort filter to the end of the pipeline."""
-    tags = hxl.TagPattern.parse_list(args.get('sort-tags%02d' % index, ''))
-    reverse = (args.get('sort-reverse%02d' % index) == 'on')
-    return source.sort(tags, reverse)
+    return apply_sort_filter(source, parse_sort_filter(args, index))
+
+# Parse and apply functions for each filter name (after normalise_args() replaces the aliases)
+FILTER_FUNCTIONS = {
+    'add': (parse_add_filter, apply_add_filter),
+    'append': (parse_append_filter, apply_append_filter),
+    'clean': (parse_clean_filter, apply_clean_filter),
+    'count': (parse_count_filter, apply_count_filter),
+    'cut': (parse_column_filter, apply_column_filter),
+    'dedup': (parse_dedup_filter, apply_dedup_filter),
+    'merge': (parse_merge_filter, apply_merge_filter),
+    'rename': (parse_rename_filter, apply_rename_filter),
+    'replace': (parse_replace_filter, apply_replace_filter),
+    'replace-map': (parse_replace_map_filter, apply_replace_map_filter),
+    'select': (parse_row_filter, apply_row_filter),
+    'sort': (parse_sort_filter, apply_sort_filter),
+}
+
+def _make_tagged_input(plan):
+    """Open the raw input for a plan, optionally using the Tagger filter."""
+    input = fetch.make_input(plan.url, sheet_index=plan.sheet_index)
+
+    # Intercept tagging as a special data input
+    if plan.tagger_specs:
+        input = Tagger(input, list(plan.tagger_specs))
+
+    return input
+
+def _get_side_urls(steps):
+    """List the auxiliary dataset URLs that the append, merge, and replace-map steps read."""
+    urls = []
+    for step in steps:
+        if step.filter == 'append':
+            urls += step.params['urls']
+        elif step.filter in ('merge', 'replace-map'):
+            urls.append(step.params['url'])
+    return [url for url in urls if url]
+
+def _parse_tagger_specs(args):
+    """Collect the (header, tag) pairs for the Tagger, in order."""
+    numbers = set()
+    for name in args:
+        match = TAGGER_PARAM_PATTERN.match(name)
+        if match and 1 <= int(match.group(1)) <= 100:
+            numbers.add(int(match.group(1)))
+    specs = []
+    for n in sorted(numbers):
+        header = args.get('tagger-%02d-header' % n)
+        tag = _parse_tagspec(args.get('tagger-%02d-tag' % n))
+        if header and tag:
+            specs.append((header, tag))
+    return tuple(specs)
+
+def _make_plan_key(args, optimise):
+    """Digest of the (normalised) arguments that compile_plan() reads."""
+    items = sorted(
+        (name, value) for name, value in args.items()
+        if name in ('url', 'sheet') or FILTER_PARAM_PATTERN.match(name) or TAGGER_PARAM_PATTERN.match(name)
+    )
+    s = json.dumps([optimise, items], separators=(',', ':'))
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+def _freeze(params):
+    """Make filter parameters read-only, so that a shared plan can't change."""
+    return types.MappingProxyType({
+        name: tuple(value) if isinstance(value, list) else value for name, value in params.items()
+    })
+
+def _get_side_index(key, side_data, function):
+    """Get a memoised structure built from an auxiliary dataset, or build it with function().
+    An entry built from an older copy of the side data doesn't count.
+    """
+    entry = _side_indexes.get(key)
+    if entry is None or entry[0] is not side_data:
+        entry = (side_data, function())
+        _side_indexes.set(key, entry)
+    return entry[1]
+
+def _make_merge_index(merge_filter):
+    """Index a merge filter's side data by key, independently of the filter's own tag patterns.
+    libhxl's merge map uses the filter's TagPattern objects as keys, and
+    those hash by identity, so a map can't be shared with another filter
+    as it is; this one holds the merge values in the order of the merge tags.
+    @return: a dict of tuples of values, keyed by the merge key.
+    """
+    return {
+        key: tuple(values.get(pattern, '') for pattern in merge_filter.merge_tags)
+        for key, values in merge_filter._read_merge().items()
+    }
+
+class _MergeMap(object):
+    """Read-only view of a shared merge index, in the form that hxl.filters.MergeDataFilter expects.
+    Looking up a key gives a dict of its merge values, keyed by this filter's own tag patterns.
+    """
+
+    def __init__(self, index, patterns):
+        self.index = index
+        self.patterns = patterns
+
+    def get(self, key, default=None):
+        values = self.index.get(key)
+        if values is None:
+            return default
+        return dict(zip(self.patterns, values))
+
+def _use_columnar():
+    """Check whether to use the filters in hxl_proxy.columnar (they need numpy)."""
+    return app.config.get('COLUMNAR_ENGINE') and columnar.is_available()
+
+def _get_spill_options():
+    """Get the memory budget and temporary directory for the filters in hxl_proxy.spill."""
+    return {
+        'max_rows': app.config.get('SPILL_MAX_ROWS'),
+        'directory': app.config.get('SPILL_DIR')
+    }
 
 def _parse_tagspec(s):
     if not s:
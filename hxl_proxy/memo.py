@@ -0,0 +1,73 @@
+"""
+In-process memoisation for the HXL Proxy.
+
+Unlike the Flask-Cache object (see L{hxl_proxy.cache}), which holds
+pickled response bodies shared between processes, a L{MemoCache}
+holds live Python objects (parsed datasets, lookup tables, compiled
+schemas) inside one worker process. Entries expire after a fixed
+time-to-live, and the least-recently-used ones go first once the
+cache is full.
+"""
+
+import collections, threading, time
+
+
+class MemoCache(object):
+    """Thread-safe dict with a TTL and a maximum number of entries."""
+
+    def __init__(self, max_entries=100, ttl=300):
+        """
+        @param max_entries: the maximum number of entries to keep (None for no limit).
+        @param ttl: seconds before an entry expires (None or 0 for never).
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Look up a live entry, and mark it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if self.ttl and time.time() - entry[0] >= self.ttl:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """Add or replace an entry, evicting the least-recently-used ones if necessary."""
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while self.max_entries and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, key, function):
+        """Look up an entry, or call function() to create and save it.
+        The function runs outside the lock, so two threads may both create
+        the same value; the last one wins, which is harmless for memoised data.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = function()
+            self.set(key, value)
+        return value
+
+    def forget(self, predicate):
+        """Remove every entry whose key matches predicate(key)."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+# end
@@ -0,0 +1,163 @@
+"""
+Optimise the steps of a compiled filter pipeline.
+
+Recipes apply their filters in whatever order the user added them, so
+a recipe may sort every row and column of a dataset, and only then
+select a few rows or cut most of the columns. optimise() rewrites the
+list of steps from hxl_proxy.filters.compile_plan() so that the output
+stays exactly the same, but less data goes through the expensive
+filters:
+
+  - a row select moves ahead of a sort (sorting is stable, so the
+    surviving rows keep their order), and ahead of a column cut that
+    keeps every column the select looks at;
+  - a column cut moves ahead of a sort or dedup that uses only columns
+    the cut keeps (never ahead of a sort or dedup on all columns);
+  - consecutive cuts fuse into one, as long as at most one of them
+    has an include list;
+  - consecutive renames fuse into one, as long as no later rename
+    would match a column that an earlier one produced;
+  - cuts with no tags, reversed selects with no queries, and
+    appends with no datasets disappear.
+
+Nothing moves across a count, merge, add, rename, replace, or clean
+step, since those change the columns or values that later steps see.
+
+The steps are hxl_proxy.filters.PipelineStep tuples, whose params are
+read-only dicts; this module always makes new ones rather than
+changing them.
+"""
+
+import types
+
+import hxl
+
+
+def optimise(steps):
+    """Optimise a list of pipeline steps.
+    @param steps: a list of PipelineStep tuples (not modified).
+    @return: a new list of PipelineStep tuples producing the same output.
+    """
+    steps = [step for step in steps if not _is_noop(step)]
+    steps = _reorder(steps)
+    return _fuse(steps)
+
+def _is_noop(step):
+    """Check if a step would pass its input through unchanged."""
+    params = step.params
+    if step.filter == 'cut':
+        return not params['include_tags'] and not params['exclude_tags']
+    elif step.filter == 'select':
+        # with_rows() with no queries removes every row, so only the reverse is a no-op
+        return not params['queries'] and params['reverse']
+    elif step.filter == 'append':
+        return not params['urls']
+    else:
+        return False
+
+def _reorder(steps):
+    """Move selects and cuts as early as they can safely go."""
+    steps = list(steps)
+    moved = True
+    while moved:
+        moved = False
+        for i in range(1, len(steps)):
+            if _can_move_before(steps[i], steps[i-1]):
+                steps[i-1], steps[i] = steps[i], steps[i-1]
+                moved = True
+    return steps
+
+def _can_move_before(step, previous):
+    """Check if step produces the same result when it runs before previous."""
+    if step.filter == 'select':
+        if previous.filter == 'sort':
+            return True
+        elif previous.filter == 'cut':
+            # the select must still see every column it would have seen after the cut
+            patterns = [_parse_query_pattern(query) for query in step.params['queries']]
+            return None not in patterns and _keeps_all(previous.params, patterns)
+    elif step.filter == 'cut':
+        if previous.filter in ('sort', 'dedup'):
+            # sort or dedup on all columns would change if columns went first
+            patterns = previous.params['tags']
+            return bool(patterns) and _keeps_all(step.params, patterns)
+    return False
+
+def _fuse(steps):
+    """Merge consecutive cuts and consecutive renames into single steps."""
+    result = []
+    for step in steps:
+        previous = result[-1] if result else None
+        if previous is not None and previous.filter == 'cut' and step.filter == 'cut':
+            fused = _fuse_cuts(previous.params, step.params)
+            if fused is not None:
+                result[-1] = previous._replace(params=fused)
+                continue
+        elif previous is not None and previous.filter == 'rename' and step.filter == 'rename':
+            fused = _fuse_renames(previous.params, step.params)
+            if fused is not None:
+                result[-1] = previous._replace(params=fused)
+                continue
+        result.append(step)
+    return result
+
+def _fuse_cuts(first, second):
+    """Combine two cuts into one, or return None if they can't be combined.
+    A cut keeps a column if it matches an include pattern (or there are
+    none) and matches no exclude pattern, so two cuts in a row keep the
+    columns that both keep: that's one cut, unless both have include lists.
+    """
+    if first['include_tags'] and second['include_tags']:
+        return None
+    return types.MappingProxyType({
+        'include_tags': first['include_tags'] or second['include_tags'],
+        'exclude_tags': tuple(first['exclude_tags']) + tuple(second['exclude_tags'])
+    })
+
+def _fuse_renames(first, second):
+    """Combine two renames into one, or return None if they can't be combined.
+    A rename uses the first spec that matches each column, so a later
+    spec can join the list only if it wouldn't have matched any column
+    that the earlier specs produced.
+    """
+    for pattern, column in second['specs']:
+        for old_pattern, new_column in first['specs']:
+            if pattern.match(new_column):
+                return None
+    return types.MappingProxyType({
+        'specs': tuple(first['specs']) + tuple(second['specs'])
+    })
+
+def _keeps_all(cut_params, patterns):
+    """Check that a cut keeps every column that matches any of the patterns."""
+    for pattern in patterns:
+        if cut_params['include_tags'] and not any(_covers(include, pattern) for include in cut_params['include_tags']):
+            return False
+        if not all(_disjoint(exclude, pattern) for exclude in cut_params['exclude_tags']):
+            return False
+    return True
+
+def _covers(general, specific):
+    """Check that every column matching the specific pattern also matches the general one."""
+    return (
+        general.tag == specific.tag and
+        set(general.include_attributes or []) <= set(specific.include_attributes or []) and
+        set(general.exclude_attributes or []) <= set(specific.exclude_attributes or [])
+    )
+
+def _disjoint(pattern1, pattern2):
+    """Check that no column can match both patterns."""
+    return (
+        pattern1.tag != pattern2.tag or
+        bool(set(pattern1.include_attributes or []) & set(pattern2.exclude_attributes or [])) or
+        bool(set(pattern1.exclude_attributes or []) & set(pattern2.include_attributes or []))
+    )
+
+def _parse_query_pattern(query):
+    """Get the tag pattern from a select query string, or None if it won't parse."""
+    try:
+        return hxl.model.RowQuery.parse(query).pattern
+    except Exception:
+        return None
+
+# end
@@ -4,13 +4,21 @@ import hxl
 
 
 class PreviewFilter(hxl.Dataset):
-    """Show only up to the first n rows of a dataset."""
+    """Show only up to the first n rows of a dataset.
+
+    The filter stops reading as soon as it knows whether there are more
+    than n rows, so a preview of a large dataset doesn't download and
+    filter the whole thing. As a result, total_rows is known only when
+    the dataset is short enough to fit in the preview; otherwise it's
+    None, and the caller has to get the count elsewhere (see the
+    /data/rowcount.json endpoint).
+    """
 
     def __init__(self, source, max_rows=10):
         self.source = source
         self.max_rows = max_rows
         self.has_more_rows = False
-        self.total_rows = 0
+        self.total_rows = None
 
 
     @property
@@ -28,18 +36,21 @@ class PreviewFilter(hxl.Dataset):
             self._row_counter = 0
 
         def __next__(self):
-            row = next(self.iterator)
-
             if self._row_counter >= self.outer.max_rows:
-                self.outer.has_more_rows = True
-                self.outer.total_rows +=1
-                while next(self.iterator):
-                    self.outer.total_rows += 1
+                # read one more row, just to see if it's there
+                try:
+                    next(self.iterator)
+                    self.outer.has_more_rows = True
+                except StopIteration:
+                    self.outer.total_rows = self._row_counter
                 raise StopIteration()
-            else:
-                self._row_counter += 1
-                self.outer.total_rows += 1
-                return row
+            try:
+                row = next(self.iterator)
+            except StopIteration:
+                self.outer.total_rows = self._row_counter
+                raise
+            self._row_counter += 1
+            return row
 
         next = __next__
 
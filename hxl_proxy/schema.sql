@@ -1,5 +1,6 @@
 pragma foreign_keys='on';
 
+drop table if exists ExportJobs;
 drop table if exists Recipes;
 drop table if exists Users;
 
@@ -19,7 +20,22 @@ create table Recipes (
        description text,
        cloneable boolean default true,
        stub varchar(64),
+       materialise boolean default false,
        args text not null,
        date_created datetime not null,
        date_modified datetime not null
 );
+
+create table ExportJobs (
+       job_id char(32) primary key,
+       recipe_id char(6),
+       format varchar(8) not null,
+       stub varchar(64),
+       args text not null,
+       status varchar(16) not null,
+       rows integer default 0,
+       bytes integer default 0,
+       error text,
+       date_created datetime not null,
+       date_modified datetime not null
+);
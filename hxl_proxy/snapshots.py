@@ -0,0 +1,246 @@
+"""
+Materialised snapshots of saved recipes.
+
+A saved recipe with the I{materialise} setting gets its CSV and JSON
+output written to files under C{SNAPSHOT_DIR}, and /data sends
+those files instead of running the pipeline, so that a popular recipe
+never makes a reader wait for a recompute. A snapshot belongs to one
+version of a recipe (see L{make_fingerprint}); after an edit, readers
+get the live output until the new snapshot is ready.
+
+A background thread in each worker process wakes up every
+C{SNAPSHOT_CHECK_INTERVAL} seconds, and refreshes the snapshot of any
+materialised recipe that doesn't have one yet, whose snapshot is older
+than C{SNAPSHOT_MAX_AGE} seconds, or whose upstream sources say they
+have changed (see L{hxl_proxy.fetch.is_modified}). A lock file makes
+sure that only one process refreshes a recipe at a time, and new files
+replace the old ones atomically, so a reader never sees half a snapshot.
+
+A refresh runs the pipeline (and reads the upstream data) only once,
+writing every format from the same pass.
+
+Each recipe's directory holds data.csv, data.json, and meta.json
+(the recipe fingerprint, the creation time, and the upstream validators).
+"""
+
+import concurrent.futures, fcntl, hashlib, itertools, json, os, tempfile, threading, time
+
+import hxl
+
+from hxl_proxy import app, caching, dao, fetch, filters
+
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json'
+}
+"""Snapshot formats and their MIME types."""
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+# Recipe ids with a refresh queued or running in this process
+_pending = set()
+_pending_lock = threading.Lock()
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_snapshot(recipe, format):
+    """Find the snapshot of a saved recipe's output, if there's one for its current version.
+    The snapshot may be older than C{SNAPSHOT_MAX_AGE}: it's still better
+    than making the reader wait, and the scheduler will replace it soon.
+    @param recipe: a saved recipe (from L{hxl_proxy.dao.recipes}).
+    @param format: 'csv' or 'json'.
+    @return: the path to the snapshot file, or None if there isn't one.
+    """
+    if not recipe.get('materialise') or format not in FORMATS:
+        return None
+    directory = _get_directory(recipe['recipe_id'])
+    if directory is None:
+        return None
+    meta = _read_meta(directory)
+    if meta is None or meta.get('fingerprint') != make_fingerprint(recipe):
+        return None
+    path = os.path.join(directory, 'data.' + format)
+    return path if os.path.exists(path) else None
+
+def needs_refresh(recipe):
+    """Check if a materialised recipe's snapshot is missing, out of date, or too old.
+    May ask the upstream servers whether the source data has changed.
+    @param recipe: a saved recipe.
+    @return: True if the snapshot needs refreshing.
+    """
+    meta = _read_meta(_get_directory(recipe['recipe_id']))
+    if meta is None or meta.get('fingerprint') != make_fingerprint(recipe):
+        return True
+    max_age = app.config.get('SNAPSHOT_MAX_AGE')
+    if max_age and time.time() - meta['created'] >= max_age:
+        return True
+    for url, validators in meta['upstream'].items():
+        if validators and fetch.is_modified(url, validators):
+            return True
+    return False
+
+def refresh(recipe):
+    """Run a recipe now, and replace its snapshot with the output.
+    @param recipe: a saved recipe.
+    @return: True if the snapshot was refreshed, or False if another process is already refreshing it.
+    """
+    directory = _get_directory(recipe['recipe_id'])
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        urls = filters.get_source_urls(recipe['args'])
+        show_headers = (recipe['args'].get('strip-headers') != 'on')
+        # one pass through the pipeline feeds every format
+        source = filters.setup_filters(recipe)
+        copies = itertools.tee(source, len(FORMATS))
+        outputs = {}
+        for format, rows in zip(FORMATS, copies):
+            dataset = _RowsDataset(source, rows)
+            if format == 'json':
+                outputs['data.' + format] = dataset.gen_json(show_headers=show_headers)
+            else:
+                outputs['data.' + format] = dataset.gen_csv(show_headers=show_headers)
+        _write_files(directory, outputs)
+        meta = {
+            'fingerprint': make_fingerprint(recipe),
+            'created': time.time(),
+            'upstream': caching.get_upstream_validators(urls)
+        }
+        _write_file(directory, 'meta.json', [json.dumps(meta)])
+        return True
+
+def request_refresh(recipe_id):
+    """Refresh a recipe's snapshot in the background, unless that's already queued in this process."""
+    if not app.config.get('SNAPSHOT_DIR'):
+        return
+    with _pending_lock:
+        if recipe_id in _pending:
+            return
+        _pending.add(recipe_id)
+    _executor.submit(_run_refresh, recipe_id)
+
+def check_all():
+    """Queue a refresh for every materialised recipe that needs one (see L{needs_refresh})."""
+    with app.app_context():
+        for recipe in dao.recipes.list_materialised():
+            try:
+                stale = needs_refresh(recipe)
+            except Exception as e:
+                app.logger.warning('Cannot check snapshot for %s: %s', recipe['recipe_id'], e)
+                continue
+            if stale:
+                request_refresh(recipe['recipe_id'])
+
+def start_scheduler():
+    """Start the background thread that keeps snapshots fresh, unless it's running or switched off.
+    Cheap enough to call before every request.
+    """
+    global _scheduler
+    if _scheduler is not None or not app.config.get('SNAPSHOT_DIR') or not app.config.get('SNAPSHOT_CHECK_INTERVAL'):
+        return
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = threading.Thread(target=_run_scheduler, name='snapshot-scheduler', daemon=True)
+            _scheduler.start()
+
+def make_fingerprint(recipe):
+    """Identify the version of a recipe that a snapshot belongs to.
+    Covers only the arguments that change the output, so editing a recipe's
+    name or description doesn't throw its snapshot away.
+    """
+    args = recipe['args']
+    s = json.dumps([filters.get_plan_key(args), args.get('strip-headers')])
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+def _run_scheduler():
+    while app.config.get('SNAPSHOT_CHECK_INTERVAL'):
+        time.sleep(app.config.get('SNAPSHOT_CHECK_INTERVAL'))
+        try:
+            check_all()
+        except Exception as e:
+            app.logger.warning('Snapshot check failed: %s', e)
+
+def _run_refresh(recipe_id):
+    """Reload a recipe and refresh its snapshot (runs in a worker thread)."""
+    try:
+        with app.app_context():
+            recipe = dao.recipes.read(recipe_id)
+            if recipe and recipe.get('materialise') and recipe['args'].get('url'):
+                refresh(recipe)
+    except Exception as e:
+        app.logger.warning('Snapshot failed for %s: %s', recipe_id, e)
+    finally:
+        with _pending_lock:
+            _pending.discard(recipe_id)
+
+def _get_directory(recipe_id):
+    root = app.config.get('SNAPSHOT_DIR')
+    return os.path.join(root, recipe_id) if root else None
+
+def _read_meta(directory):
+    if directory is None:
+        return None
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as input:
+            return json.load(input)
+    except (IOError, ValueError):
+        return None
+
+def _write_file(directory, filename, chunks):
+    """Write string chunks to a file, replacing any older version in one step."""
+    _write_files(directory, {filename: chunks})
+
+def _write_files(directory, outputs):
+    """Write several files at once, reading their chunk iterators in step, then replace the older versions.
+    Iterators that share one pass through a pipeline (see itertools.tee) stay
+    close together this way, so the rows between them don't pile up in memory.
+    @param outputs: a dict of filenames and iterators over their string chunks.
+    """
+    temp_paths = {}
+    try:
+        files = {}
+        for filename in outputs:
+            fd, temp_paths[filename] = tempfile.mkstemp(dir=directory, prefix='.' + filename)
+            files[filename] = open(fd, 'w', encoding='utf-8')
+        try:
+            iterators = [(files[filename], iter(chunks)) for filename, chunks in outputs.items()]
+            while iterators:
+                for item in list(iterators):
+                    output, chunks = item
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        iterators.remove(item)
+                    else:
+                        output.write(chunk)
+        finally:
+            for output in files.values():
+                output.close()
+        for filename, temp_path in temp_paths.items():
+            os.replace(temp_path, os.path.join(directory, filename))
+    except:
+        for temp_path in temp_paths.values():
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        raise
+
+
+class _RowsDataset(hxl.Dataset):
+    """A dataset with the same columns as another, but rows from somewhere else (e.g. a copy from itertools.tee)."""
+
+    def __init__(self, source, rows):
+        self.source = source
+        self.rows = rows
+
+    @property
+    def columns(self):
+        return self.source.columns
+
+    def __iter__(self):
+        return iter(self.rows)
+
+# end
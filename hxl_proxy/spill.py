@@ -0,0 +1,288 @@
+"""
+Sort, count, and dedup filters that spill to disk.
+
+libhxl's sort filter holds every row of the dataset in memory, and its
+count and dedup filters hold every distinct key, so one very large
+upload can use up a worker's memory. The filters in this module keep
+at most C{max_rows} records in memory at a time (the C{SPILL_MAX_ROWS}
+config option) and write the rest to temporary files in C{SPILL_DIR}:
+
+  - sort writes sorted runs of rows, then merges them;
+  - count writes partial aggregates (a count, sum, minimum, and maximum
+    for each key seen so far), then merges the partials for each key;
+  - dedup streams rows the usual way until it has seen C{max_rows}
+    distinct keys, then sorts the rest of the rows by key to find the
+    first occurrence of each, and sorts those back into their original order.
+
+Runs merge at most L{FAN_IN} at a time (in several passes if needed),
+reading back batches of C{max_rows // FAN_IN} records, so a merge
+holds about C{max_rows} records in memory however big the input, and
+the number of open temporary files grows only with the logarithm of
+the input size. The temporary files disappear as soon as the output
+has been read.
+Datasets that fit in the budget never touch the disk, and the output
+is the same as libhxl's, except that count's sums (and so its averages)
+may differ in the last decimal place, since the partial sums add up in
+a different order.
+
+hxl_proxy.filters uses these classes when SPILL_MAX_ROWS is set.
+"""
+
+import heapq, itertools, operator, pickle, tempfile
+
+import hxl
+import hxl.filters
+
+# The most runs to merge at once. Each run being merged holds one batch
+# of max_rows // FAN_IN records in memory, and an open temporary file.
+FAN_IN = 16
+
+
+class SpillingSortFilter(hxl.filters.SortFilter):
+    """Same as hxl.filters.SortFilter, but keeping at most max_rows rows in memory."""
+
+    def __init__(self, source, tags=[], reverse=False, max_rows=None, directory=None):
+        """
+        @param source: the upstream dataset.
+        @param tags: a list of tag patterns to sort by (default: all columns).
+        @param reverse: if True, sort in descending order.
+        @param max_rows: (optional) the most rows to hold in memory (default: no limit).
+        @param directory: (optional) the directory for temporary files (default: the system temporary directory).
+        """
+        super(SpillingSortFilter, self).__init__(source, tags, reverse)
+        self.max_rows = max_rows
+        self.directory = directory
+
+    def __iter__(self):
+        indices = self._make_indices()
+        records = ((self._make_key(indices, row.values), row.values) for row in self.source)
+        for row_number, (key, values) in enumerate(sort_records(records, self.reverse, self.max_rows, self.directory)):
+            yield hxl.model.Row(self.columns, values, row_number)
+
+
+class SpillingCountFilter(hxl.filters.CountFilter):
+    """Same as hxl.filters.CountFilter, but keeping at most max_rows partial aggregates in memory."""
+
+    def __init__(self, source, patterns, aggregate_pattern=None, count_spec='Count#meta+count', queries=[],
+                 max_rows=None, directory=None):
+        """
+        See hxl.filters.CountFilter for the other arguments.
+        @param max_rows: (optional) the most keys to hold in memory (default: no limit).
+        @param directory: (optional) the directory for temporary files (default: the system temporary directory).
+        """
+        super(SpillingCountFilter, self).__init__(source, patterns, aggregate_pattern, count_spec, queries)
+        self.max_rows = max_rows
+        self.directory = directory
+
+    def __iter__(self):
+        partials = sort_records(self._gen_partials(), False, self.max_rows, self.directory)
+        row_number = 0
+        for key, group in itertools.groupby(partials, key=operator.itemgetter(0)):
+            yield hxl.model.Row(self.columns, self._make_values(key, [partial for key, partial in group]), row_number)
+            row_number += 1
+
+    def _gen_partials(self):
+        """Aggregate rows by key, yielding (key, partial) pairs whenever there are too many keys to hold.
+        Each partial is a list of the count, the sum, the position (from 1) of
+        the last row with a number, the minimum, and the maximum.
+        """
+        partials = {}
+        for row in self.source:
+            if not hxl.model.RowQuery.match_list(row, self.queries):
+                continue
+            key = tuple(str(row.get(pattern, default='')) for pattern in self.patterns)
+            if not key:
+                continue
+            partial = partials.get(key)
+            if partial is None:
+                if self.max_rows and len(partials) >= self.max_rows:
+                    yield from partials.items()
+                    partials = {}
+                partial = partials[key] = [0, 0.0, 0, None, None]
+            partial[0] += 1
+            if self.aggregate_pattern is not None:
+                number = _parse_number(row.get(self.aggregate_pattern, default=''))
+                if number is not None:
+                    partial[1] += number
+                    partial[2] = partial[0]
+                    if partial[3] is None or number < partial[3]:
+                        partial[3] = number
+                    if partial[4] is None or number > partial[4]:
+                        partial[4] = number
+        yield from partials.items()
+
+    def _make_values(self, key, partials):
+        """Combine the partial aggregates for one key (in row order) into a row of output."""
+        count = 0
+        total = 0.0
+        last = 0
+        minimum = maximum = None
+        for partial_count, partial_sum, partial_last, partial_min, partial_max in partials:
+            if partial_last:
+                total += partial_sum
+                last = count + partial_last
+                if minimum is None or partial_min < minimum:
+                    minimum = partial_min
+                if maximum is None or partial_max > maximum:
+                    maximum = partial_max
+            count += partial_count
+        values = list(key) + [count]
+        if self.aggregate_pattern is not None:
+            if last:
+                # like CountFilter, average over the rows up to the last one with a number
+                values += [total, total / last, minimum, maximum]
+            else:
+                values += ['', '', '', '']
+        return values
+
+
+class SpillingDedupFilter(hxl.filters.DeduplicationFilter):
+    """Same as hxl.filters.DeduplicationFilter, but remembering at most max_rows keys in memory."""
+
+    def __init__(self, source, patterns=None, queries=[], max_rows=None, directory=None):
+        """
+        See hxl.filters.DeduplicationFilter for the other arguments.
+        @param max_rows: (optional) the most keys to hold in memory (default: no limit).
+        @param directory: (optional) the directory for temporary files (default: the system temporary directory).
+        """
+        super(SpillingDedupFilter, self).__init__(source, patterns, queries)
+        self.max_rows = max_rows
+        self.directory = directory
+
+    def __iter__(self):
+        seen = set()
+        row_number = 0
+        rows = iter(self.source)
+        # stream the usual way while the keys fit in memory
+        for row in rows:
+            if not hxl.model.RowQuery.match_list(row, self.queries):
+                yield hxl.model.Row(self.columns, row.values, row_number)
+                row_number += 1
+                continue
+            key = self._make_key(row)
+            if key in seen:
+                continue
+            if self.max_rows and len(seen) >= self.max_rows:
+                remaining = itertools.chain([row], rows)
+                break
+            seen.add(key)
+            yield hxl.model.Row(self.columns, list(row.values), row_number)
+            row_number += 1
+        else:
+            return
+
+        # then find the first occurrence of each new key on disk, and put the survivors back in order
+        for values in self._dedup_remaining(remaining, seen):
+            yield hxl.model.Row(self.columns, values, row_number)
+            row_number += 1
+
+    def _dedup_remaining(self, rows, seen):
+        """Deduplicate the rest of the rows against each other and the keys already seen.
+        @return: an iterator over the surviving rows' values, in their original order.
+        """
+        def gen_records():
+            for position, row in enumerate(rows):
+                if not hxl.model.RowQuery.match_list(row, self.queries):
+                    # sorts before any real key, and is never a duplicate
+                    yield ((0, position), (position, row.values))
+                else:
+                    key = self._make_key(row)
+                    if key not in seen:
+                        yield ((1, key), (position, row.values))
+        by_key = sort_records(gen_records(), False, self.max_rows, self.directory)
+        firsts = (
+            (position, values)
+            for key, group in itertools.groupby(by_key, key=operator.itemgetter(0))
+            for (ignored, (position, values)) in itertools.islice(group, 1)
+        )
+        for position, values in sort_records(firsts, False, self.max_rows, self.directory):
+            yield values
+
+
+def sort_records(records, reverse=False, max_rows=None, directory=None):
+    """Stable sort of (key, value) pairs by key, spilling to disk when there are too many.
+    Equal keys keep their original order, as with sorted() (even when reversed).
+    @param records: an iterator over (key, value) pairs; both must be picklable.
+    @param reverse: if True, sort in descending order.
+    @param max_rows: (optional) the most pairs to hold in memory at once (default: no limit).
+    @param directory: (optional) the directory for temporary files (default: the system temporary directory).
+    @return: an iterator over the pairs, in sorted order.
+    """
+    key = operator.itemgetter(0)
+    batch_size = max(1, max_rows // FAN_IN) if max_rows else None
+    runs = [] # (level, run file) pairs, in input order
+
+    def merge(inputs):
+        # heapq.merge takes equal keys from earlier inputs first, so the sort stays stable
+        return heapq.merge(*inputs, key=key, reverse=reverse)
+
+    def merge_last_runs(level):
+        """Merge the last FAN_IN runs into one run (they're consecutive, so the sort stays stable)."""
+        merging = runs[-FAN_IN:]
+        del runs[-FAN_IN:]
+        try:
+            runs.append((level, _write_run(merge([_read_run(run) for _, run in merging]), batch_size, directory)))
+        finally:
+            for _, run in merging:
+                run.close()
+
+    try:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if max_rows and len(chunk) >= max_rows:
+                chunk.sort(key=key, reverse=reverse)
+                runs.append((0, _write_run(chunk, batch_size, directory)))
+                chunk = []
+                # merge FAN_IN runs of a level into one of the next, like carrying in addition
+                while len(runs) >= FAN_IN and len(set(level for level, _ in runs[-FAN_IN:])) == 1:
+                    merge_last_runs(runs[-1][0] + 1)
+        chunk.sort(key=key, reverse=reverse)
+        if not runs:
+            yield from chunk
+        else:
+            # write out the last chunk too, so that the merge holds only one batch per run
+            if chunk:
+                runs.append((0, _write_run(chunk, batch_size, directory)))
+                chunk = None
+            while len(runs) > FAN_IN:
+                merge_last_runs(runs[-1][0])
+            yield from merge([_read_run(run) for _, run in runs])
+    finally:
+        for _, run in runs:
+            run.close()
+
+def _write_run(records, batch_size, directory):
+    """Write sorted records to an anonymous temporary file, in batches."""
+    run = tempfile.TemporaryFile(dir=directory)
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            pickle.dump(batch, run, pickle.HIGHEST_PROTOCOL)
+            batch = []
+    if batch:
+        pickle.dump(batch, run, pickle.HIGHEST_PROTOCOL)
+    run.flush()
+    return run
+
+def _read_run(run):
+    """Read the records back from a run file, a batch at a time."""
+    run.seek(0)
+    while True:
+        try:
+            batch = pickle.load(run)
+        except EOFError:
+            return
+        yield from batch
+
+def _parse_number(value):
+    """Parse a value as a number, the way CountFilter does, or return None."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+# end
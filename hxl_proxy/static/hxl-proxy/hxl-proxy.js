@@ -210,145 +210,92 @@ hxl_proxy.ui.form = function() {
 
 /**
  * Set up a page containing a chart.
- * External dependencies: Google Charts, JQuery, HXL
- * @param params.data_url URL to a CSV HXL dataset
+ * The server aggregates the data in advance (see hxl_proxy/chart.py),
+ * so the page needs only the label/value pairs.
+ * External dependencies: Google Charts, JQuery
+ * @param params.chart_data pre-aggregated chart data (title, label_pattern, value_pattern, rows)
+ * @param params.chart_url URL to the same data as JSON, if params.chart_data is missing
  * @param params.type currently "pie", "bar", or "column" (defaults to "pie")
- * @param params.count_pattern HXL tag pattern to count.
- * @param params.filter_rule HXL rule for filtering.
- * @param params.label_pattern HXL tag pattern for the column containing labels (defaults to first column)
- * @param params.value_pattern HXL tag pattern for the column containing values (defaults to a numbery column, if present)
  */
 hxl_proxy.ui.chart = function(params) {
 
     // Callback that creates and populates a data table,
-    // instantiates the pie chart, passes in the data and
+    // instantiates the chart, passes in the data and
     // draws it.
-    function drawChart() {
-
-        function get_label_pattern(hxl) {
-            if (params.label_pattern && hxl.hasColumn(params.label_pattern)) {
-                return params.label_pattern;
-            } else {
-                // FIXME - just defaulting to first tag for now
-                return hxl.columns[0].tag;
-            }
-        }
+    function drawChart(chartData) {
 
-        function get_value_pattern(data) {
-            if (params.value_pattern && data.hasColumn(params.value_pattern)) {
-                return params.value_pattern;
-            } else {
-                var pattern = hxl.classes.Pattern.parse('#meta+count');
-                for (i in data.columns) {
-                    if (pattern.match(data.columns[i]) || data.isNumbery(data.columns[i].displayTag)) {
-                        return data.columns[i].displayTag;
-                    }
-                }
-            }
+        if (!chartData.value_pattern && chartData.rows.length == 0) {
             alert("Can't guess numeric column for charting.");
             throw "Can't guess numeric column for charting.";
         }
 
-        $.get(params.data_url, function(csvString) {
-            var rawData = $.csv.toArrays(csvString, {onParseValue: $.csv.hooks.castToScalar});
-            var hxlData = hxl.wrap(rawData);
-
-            if (params.filter_pattern) {
-                // If we have a filter pattern, apply it first
-                if (params.filter_value) {
-                    // If there's a value, use it to filter
-                    hxlData = hxlData.withRows(params.filter_pattern + '=' + params.filter_value);
-                } else if (!params.count_pattern && params.label_pattern) {
-                    // If there's no value and we're not counting rows, sum up the results
-                    hxlData = hxlData.count(params.label_pattern, get_value_pattern(hxlData));
-                    for (var i in hxlData.columns) {
-                        column = hxlData.columns[i]
-                        if (column.attributes.indexOf('sum') != -1) {
-                            params.value_pattern = column.displayTag;
-                            break;
-                        }
-                    }
+        var data = google.visualization.arrayToDataTable(
+            [[String(chartData.label_pattern), String(chartData.value_pattern || '#meta+count')]].concat(
+                chartData.rows.map(function (row) { return [String(row[0]), row[1]]; })
+            )
+        );
+
+        if (params.type == 'bar') {
+            options = {
+                title: chartData.title,
+                width: '100%',
+                height: chartData.rows.length * 40,
+                chartArea: {
+                    top: 50
+                },
+                legend: {
+                    position: 'none'
                 }
             }
-            if (params.count_pattern) {
-                hxlData = hxlData.count(params.count_pattern);
+            var chart = new google.visualization.BarChart(document.getElementById('chart_div'));
+        } else if (params.type == 'column') {
+            options = {
+                title: chartData.title,
+                width: chartData.rows.length * 60,
+                chartArea: {
+                    top: 50,
+                    left: 50
+                },
+                legend: {
+                    position: 'none'
+                }
             }
-            var label_pattern = get_label_pattern(hxlData);
-            var value_pattern = get_value_pattern(hxlData);
-            var value_column = hxlData.getMatchingColumns(value_pattern)[0];
-            var title = '';
-            if (value_column.header) {
-                title = value_column.header + ' (' + value_column.displayTag + ')';
-            } else {
-                title = value_column.displayTag;
+            var chart = new google.visualization.ColumnChart(document.getElementById('chart_div'));
+        } else {
+            if (params.type && params.type != 'pie') {
+                alert("Unknown chart type: " + params.type + "\nPlease use 'bar', 'column', or 'pie'");
             }
-
-            var chartData = [[label_pattern, value_pattern]];
-            var iterator = hxlData.iterator();
-            while (row = iterator.next()) {
-                var label = String(row.get(label_pattern));
-                var value = row.get(value_pattern);
-                if (!isNaN(value)) {
-                    chartData.push([label, 0 + value]);
+            options = {
+                title: chartData.title,
+                width: '100%',
+                height: '100%',
+                chartArea: {
+                    top: 50,
+                    left: 50,
                 }
             }
+            var chart = new google.visualization.PieChart(document.getElementById('chart_div'));
+        }
 
-            var data = google.visualization.arrayToDataTable(chartData);
-
-            if (params.type == 'bar') {
-                options = {
-                    title: title,
-                    width: '100%',
-                    height: hxlData.getRows().length * 40,
-                    chartArea: {
-                        top: 50
-                    },
-                    legend: {
-                        position: 'none'
-                    }
-                }
-                var chart = new google.visualization.BarChart(document.getElementById('chart_div'));
-            } else if (params.type == 'column') {
-                options = {
-                    title: title,
-                    width: hxlData.getRows().length * 60,
-                    chartArea: {
-                        top: 50,
-                        left: 50
-                    },
-                    legend: {
-                        position: 'none'
-                    }
-                }
-                var chart = new google.visualization.ColumnChart(document.getElementById('chart_div'));
-            } else {
-                if (params.type && params.type != 'pie') {
-                    alert("Unknown chart type: " + params.type + "\nPlease use 'bar', 'column', or 'pie'");
-                }
-                options = {
-                    title: title,
-                    width: '100%',
-                    height: '100%',
-                    chartArea: {
-                        top: 50,
-                        left: 50,
-                    }
-                }
-                var chart = new google.visualization.PieChart(document.getElementById('chart_div'));
-            }
+        chart.draw(data, options);
+    }
 
-            chart.draw(data, options);
-        }).fail(function () {
-            alert("Failed to load dataset " + params.data_url);
-            throw "Failed to load dataset " + params.data_url;
-        });
+    function loadChart() {
+        if (params.chart_data) {
+            drawChart(params.chart_data);
+        } else {
+            $.getJSON(params.chart_url, drawChart).fail(function () {
+                alert("Failed to load chart data " + params.chart_url);
+                throw "Failed to load chart data " + params.chart_url;
+            });
+        }
     }
 
     // Load the Visualization API and the piechart package.
     google.load('visualization', '1.0', {'packages':['corechart']});
 
     // Set a callback to run when the Google Visualization API is loaded.
-    google.setOnLoadCallback(drawChart);
+    google.setOnLoadCallback(loadChart);
 
 };
 
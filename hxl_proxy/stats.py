@@ -0,0 +1,180 @@
+"""
+Background statistics for recipe stages.
+
+The recipe editor's preview reads only the first few rows (see
+L{hxl_proxy.preview}), so anything that needs the whole dataset has to
+come from somewhere else. L{make_stats} watches the rows go past after
+every stage of a recipe's pipeline (the input, then each filter), in a
+single pass, and collects the row count and, for each column, the number
+of distinct values and the minimum and maximum.
+
+L{submit} runs that pass in a small pool of background threads, and
+saves the result in the response cache (see L{hxl_proxy.caching}),
+along with the recipe version and the upstream validators, so it stays
+valid until the recipe or its source data changes. The
+/data/stats.json endpoint answers 202 Accepted until the job is done.
+"""
+
+import concurrent.futures, json, threading
+
+import hxl
+
+from hxl_proxy import app, caching, filters, util
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config.get('STATS_MAX_WORKERS') or 1)
+
+# Running jobs (and failed jobs that nobody has asked about yet), keyed by cache key
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def make_stats(plan, max_distinct=None):
+    """Compute statistics for every stage of a pipeline, in one pass.
+    @param plan: a PipelinePlan (see L{hxl_proxy.filters.get_plan}).
+    @param max_distinct: (optional) stop counting distinct values in a column after this many.
+    @return: a dict with the key 'stages': a list with a dict for each stage,
+    with the keys 'filter' ('input' for the source itself), 'rows', and 'columns'
+    (see L{ColumnStats.to_dict}).
+    """
+    if max_distinct is None:
+        max_distinct = app.config.get('STATS_MAX_DISTINCT')
+    recorders = []
+    def wrap(source, step):
+        recorder = StatsRecorder(source, step.filter if step else 'input', max_distinct)
+        recorders.append(recorder)
+        return recorder
+    for row in filters.build_pipeline(plan, wrap=wrap):
+        pass
+    return {
+        'stages': [recorder.to_dict() for recorder in recorders]
+    }
+
+def submit(key, recipe, dependencies):
+    """Start computing the statistics for a recipe in the background, unless that's already happening.
+    The job saves its result in the cache under key when it's done.
+    @param key: the cache key for the result (see L{hxl_proxy.util.make_cache_key}).
+    @param recipe: the recipe (uses only recipe['args']).
+    @param dependencies: versions from L{hxl_proxy.caching.get_dependencies}, taken before starting.
+    @return: a Future whose result is the JSON body, or whose exception is the reason the job failed.
+    """
+    with _jobs_lock:
+        job = _jobs.get(key)
+        if job is None:
+            job = _executor.submit(_run, key, dict(recipe['args']), dependencies)
+            _jobs[key] = job
+            job.add_done_callback(lambda job: _finish(key, job))
+        elif job.done():
+            # a failed job: report it once, then let the next request try again
+            del _jobs[key]
+        return job
+
+def _run(key, args, dependencies):
+    """Compute the statistics and save them in the cache (runs in a worker thread)."""
+    with app.app_context():
+        plan = filters.get_plan(args)
+        body = json.dumps(make_stats(plan))
+        caching.store_response(
+            key,
+            body,
+            'application/json',
+            headers={'Access-Control-Allow-Origin': '*'},
+            dependencies=dependencies,
+            upstream=caching.get_upstream_validators(plan.source_urls)
+        )
+        return body
+
+def _finish(key, job):
+    """Forget a successful job (its result is in the cache now)."""
+    if job.exception() is None:
+        with _jobs_lock:
+            if _jobs.get(key) is job:
+                del _jobs[key]
+        return
+    app.logger.warning('Statistics failed for %s: %s', key, job.exception())
+
+
+class StatsRecorder(hxl.Dataset):
+    """Pass through a dataset unchanged, collecting statistics about the rows."""
+
+    def __init__(self, source, filter_name, max_distinct=None):
+        self.source = source
+        self.filter_name = filter_name
+        self.max_distinct = max_distinct
+        self.row_count = 0
+        self.column_stats = None
+
+    @property
+    def columns(self):
+        return self.source.columns
+
+    def __iter__(self):
+        self.column_stats = [ColumnStats(column, self.max_distinct) for column in self.columns]
+        for row in self.source:
+            self.row_count += 1
+            for index, value in enumerate(row.values[:len(self.column_stats)]):
+                self.column_stats[index].add(value)
+            yield row
+
+    def to_dict(self):
+        return {
+            'filter': self.filter_name,
+            'rows': self.row_count,
+            'columns': [stats.to_dict() for stats in (self.column_stats or [])]
+        }
+
+
+class ColumnStats(object):
+    """Distinct count and range for the values in one column."""
+
+    def __init__(self, column, max_distinct=None):
+        self.column = column
+        self.max_distinct = max_distinct
+        self.distinct = set()
+        self.capped = False
+        self.all_numbers = True
+        self.min_number = self.max_number = None
+        self.min_string = self.max_string = None
+
+    def add(self, value):
+        value = str(value).strip() if value is not None else ''
+        if not value:
+            return
+        if not self.capped:
+            key = hxl.common.normalise_string(value)
+            if key not in self.distinct:
+                if self.max_distinct and len(self.distinct) >= self.max_distinct:
+                    # stop counting, so a column of unique IDs can't fill memory
+                    self.capped = True
+                else:
+                    self.distinct.add(key)
+        if self.min_string is None or value < self.min_string:
+            self.min_string = value
+        if self.max_string is None or value > self.max_string:
+            self.max_string = value
+        if self.all_numbers:
+            number = util.to_number(value)
+            if number is None:
+                self.all_numbers = False
+            else:
+                if self.min_number is None or number < self.min_number:
+                    self.min_number = number
+                if self.max_number is None or number > self.max_number:
+                    self.max_number = number
+
+    def to_dict(self):
+        """
+        @return: a dict with the keys 'tag', 'header', 'distinct' (a lower bound if
+        'distinct_capped' is True), and 'min' and 'max' (compared as numbers if
+        every non-empty value is a number, or else as strings; None if there are no values).
+        """
+        numeric = self.all_numbers and self.min_number is not None
+        return {
+            'tag': self.column.display_tag,
+            'header': self.column.header,
+            'distinct': len(self.distinct),
+            'distinct_capped': self.capped,
+            'min': self.min_number if numeric else self.min_string,
+            'max': self.max_number if numeric else self.max_string
+        }
+
+# end
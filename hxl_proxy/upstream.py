@@ -0,0 +1,84 @@
+"""
+Shared HTTP connections to upstream servers.
+
+Every request that the HXL Proxy makes to another server (source
+datasets, checks for changes, Humanitarian.ID logins) goes through one
+requests.Session in each worker process. Repeated requests to the same
+host then reuse a kept-alive connection, instead of paying for a new
+TCP and TLS handshake every time, which matters most for the small
+datasets that most recipes read.
+
+The session keeps up to C{UPSTREAM_POOL_SIZE} idle connections for each
+host, retries failed connections and 502/503/504 answers to idempotent
+requests C{UPSTREAM_RETRIES} times with exponential backoff (starting at
+C{UPSTREAM_BACKOFF} seconds), and gives every request a timeout of
+C{UPSTREAM_TIMEOUT} seconds unless the caller chooses one.
+"""
+
+import re, threading
+
+import hxl
+import requests, requests.adapters
+from urllib3.util.retry import Retry
+
+from hxl_proxy import app
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Get the shared session, creating it the first time."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _make_session()
+        return _session
+
+def request(method, url, **kwargs):
+    """Send a request through the shared session.
+    Takes the same arguments as requests.request(), but adds the default timeout.
+    @return: a requests response object.
+    @exception requests.RequestException: if the request fails after all retries.
+    """
+    kwargs.setdefault('timeout', app.config.get('UPSTREAM_TIMEOUT'))
+    return get_session().request(method, url, **kwargs)
+
+def open_url(url, allow_local=False):
+    """Open a source URL as a raw byte stream (a replacement for hxl.io.make_stream).
+    The stream has the response headers in its I{headers} property. Its
+    connection goes back to the pool once the stream has been read to the end.
+    @param url: the URL to open (Google Sheets and similar URLs get rewritten, as in libhxl).
+    @param allow_local: if True, also allow local filenames.
+    @return: a readable binary stream.
+    @exception IOError: if the server doesn't answer 200 OK.
+    """
+    url = hxl.io.munge_url(url)
+    if not re.match(r'^https?://', url):
+        # e.g. FTP, which requests doesn't handle
+        return hxl.io.make_stream(url, allow_local=allow_local)
+    try:
+        response = request('GET', url, stream=True)
+    except requests.RequestException as e:
+        raise IOError('Failed to open {}: {}'.format(url, e))
+    if response.status_code != 200:
+        response.close()
+        raise IOError('Received HTTP response code {}'.format(response.status_code))
+    response.raw.decode_content = True
+    return response.raw
+
+def _make_session():
+    retries = Retry(
+        total=app.config.get('UPSTREAM_RETRIES', 0),
+        backoff_factor=app.config.get('UPSTREAM_BACKOFF', 0),
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False
+    )
+    pool_size = app.config.get('UPSTREAM_POOL_SIZE') or 10
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# end
@@ -4,12 +4,11 @@ Utility functions for hxl_proxy
 Started 2015-02-18 by David Megginson
 """
 
-import six, hashlib, time, random, base64
+import six, hashlib, math, time, random, base64
 import re
 import urllib
 import datetime
-import pickle
-import re
+import json
 
 from werkzeug.exceptions import BadRequest, Unauthorized, Forbidden, NotFound
 
@@ -23,7 +22,10 @@ from hxl_proxy import app
 CACHE_KEY_EXCLUDES = ['force']
 
 def make_cache_key (path = None, args_in=None):
-    """Make a key for a caching request, based on the full path."""
+    """Make a fixed-length key for caching a request, based on the path and normalised arguments.
+    Requests for equivalent recipes (e.g. with parameters in a different order, empty
+    parameters, or different filter numbering) get the same key.
+    """
     if path is None:
         path = request.path
     if args_in is None:
@@ -31,8 +33,10 @@ def make_cache_key (path = None, args_in=None):
     args_out = {}
     for name in args_in:
         if name not in CACHE_KEY_EXCLUDES:
-            args_out[name] = args_in[name]
-    return path + pickle.dumps(args_out).decode('latin1')
+            args_out[name] = args_in.get(name)
+    args_out = hxl_proxy.filters.normalise_args(args_out)
+    canonical = json.dumps([path, sorted(args_out.items())], separators=(',', ':'))
+    return 'data:' + hashlib.sha256(canonical.encode('utf-8')).hexdigest()
 
 def skip_cache_p ():
     """Test if we should skip the cache."""
@@ -42,6 +46,20 @@ def strnorm (s):
     """Normalise a string"""
     return hxl.common.normalise_string(s)
 
+def to_number(value):
+    """Parse a cell value as a number, or return None.
+    Whole numbers come back as ints, so that they print without a '.0'.
+    """
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        return None
+    if not math.isfinite(number):
+        return None
+    if number.is_integer():
+        return int(number)
+    return number
+
 def stream_template(template_name, **context):
     """From the flask docs - stream a long template result."""
     app.update_template_context(context)
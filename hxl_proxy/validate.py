@@ -1,10 +1,45 @@
 """
 Validation support
+
+Validating a dataset means a full pass through the data, so the
+reports are cached (see L{get_errors}), keyed by the recipe's pipeline,
+the schema URL, and the severity level. Like the other cached output
+(see L{hxl_proxy.caching}), a report keeps the versions of its source
+and schema URLs and their upstream validators, so it stays good until
+the data or the schema changes (or someone forces a refresh), without
+reading either of them to check. (A URL whose server sends no
+validators has a digest of its content in the key instead; see
+L{make_report_key}.) Drilling into the details for one rule reads the
+stored report instead of validating again. A report keeps an exact
+count of the errors for each rule, but only the first few as examples
+(see L{do_validate}), so its size doesn't depend on the size of the
+data; L{get_error_page} gets the rest a page at a time.
+
+Parsing a schema compiles all of its rules (tag patterns, regular
+expressions, lists of allowed values), and a few shared schemas cover
+most validations, so each worker process keeps the compiled schemas in
+memory (see L{get_schema}), and binds only the callback for each request.
+
+If C{VALIDATION_PROCESSES} is more than 1, L{do_validate} splits the rows
+into chunks of C{VALIDATION_CHUNK_SIZE} and validates them in that many
+worker processes. (The streamed JSON output stays in one process, so
+that it can send each error as it happens.)
 """
 
+import atexit
 import hashlib
 import base64
+import collections
+import concurrent.futures
+import copy
+import json
+import multiprocessing
+import threading
+import time
 import hxl
+import hxl.validation
+
+from hxl_proxy import app, caching, fetch, filters, memo
 
 SEVERITY_LEVELS = {
     'info': 1,
@@ -12,22 +47,129 @@ SEVERITY_LEVELS = {
     'error': 3
 }
 
+# Compiled schemas (see _CompiledSchema), keyed by URL
+_schemas = memo.MemoCache(app.config.get('SCHEMA_CACHE_MAX_ENTRIES'), app.config.get('SCHEMA_CACHE_TTL'))
+
+# A compiled schema, with the upstream validators from when it was read, and when it was last known to be current
+_CompiledSchema = collections.namedtuple('_CompiledSchema', ['schema', 'validators', 'checked'])
+
+# Worker processes for parallel validation (see VALIDATION_PROCESSES)
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
 def make_rule_hash(rule):
     """Make a good-enough hash for a rule."""
     s = "\r".join([str(rule.severity), str(rule.description), str(rule.tag_pattern)])
     return base64.urlsafe_b64encode(hashlib.md5(s.encode('utf-8')).digest())[:8].decode('ascii')
 
-def do_validate(source, schema_url=None, severity_level=None):
-    """Validate a source, and return a list of errors."""
+def get_errors(recipe, schema_url=None, severity_level=None, key=None):
+    """Validate a recipe's output, reusing the stored report if the data and schema haven't changed.
+    @param recipe: the recipe (uses only recipe['args']).
+    @param schema_url: (optional) the URL of a HXL schema (defaults to the libhxl default schema).
+    @param severity_level: (optional) the minimum severity to report ('info', 'warning', or 'error').
+    @param key: (optional) the report's cache key, if the caller already has it (see L{make_report_key}).
+    @return: the same as L{do_validate}.
+    """
+    if key is None:
+        key = make_report_key(recipe['args'], schema_url, severity_level)
+    return _get_cached(
+        key, _get_urls(recipe['args'], schema_url),
+        lambda: do_validate(filters.setup_filters(recipe), schema_url, severity_level)
+    )
+
+def get_error_page(recipe, schema_url, severity_level, rule_hash, page=1, page_size=None, key=None):
+    """Get one page of the errors for a single rule.
+    The report keeps only the first few examples of each rule's errors,
+    so a page beyond those comes from validating again, keeping only that
+    page's errors (and stopping as soon as it's full); the page then goes
+    into the cache alongside the report.
+    @param recipe: the recipe (uses only recipe['args']).
+    @param schema_url: the URL of the HXL schema, or None for the default schema.
+    @param severity_level: the minimum severity of the report.
+    @param rule_hash: the rule to list errors for (see L{make_rule_hash}).
+    @param page: the 1-based page number.
+    @param page_size: (optional) the number of errors on a page (defaults to C{VALIDATION_PAGE_SIZE}).
+    @param key: (optional) the report's cache key, if the caller already has it (see L{make_report_key}).
+    @return: a list of error records (see L{_make_error_record}).
+    """
+    if page_size is None:
+        page_size = app.config.get('VALIDATION_PAGE_SIZE')
+    start = (page - 1) * page_size
+    if key is None:
+        key = make_report_key(recipe['args'], schema_url, severity_level)
+    errors = get_errors(recipe, schema_url, severity_level, key=key) or {}
+    summary = errors.get(rule_hash)
+    if summary is None or start >= summary['count']:
+        return []
+    end = min(start + page_size, summary['count'])
+    if end <= len(summary['examples']):
+        return summary['examples'][start:end]
+
+    def make_page():
+        records = []
+        seen = [0]
+        def callback(error):
+            if make_rule_hash(error.rule) == rule_hash:
+                if start <= seen[0]:
+                    records.append(_make_error_record(error))
+                    if len(records) >= page_size:
+                        raise _PageFull()
+                seen[0] += 1
+        try:
+            get_schema(schema_url, callback).validate(filters.setup_filters(recipe).row_counter())
+        except _PageFull:
+            pass
+        return records
+    page_key = '{}:{}:{}:{}'.format(key, rule_hash, page, page_size)
+    return _get_cached(page_key, _get_urls(recipe['args'], schema_url), make_page)
+
+def make_report_key(args, schema_url=None, severity_level=None):
+    """Make the cache key for a validation report.
+    For sources (and schemas) whose servers send an ETag or
+    Last-Modified header, the key doesn't read anything: whether they
+    changed gets checked against the stored report's validators
+    instead. Those validators are the only way to notice an upstream
+    change before the report goes stale, so for a URL without them, the
+    key includes a digest of its content (see
+    L{hxl_proxy.fetch.get_fingerprint}, which reads the fetch cache's
+    copy while it's fresh, and downloads the URL otherwise).
+    """
+    fingerprints = {}
+    for url in _get_urls(args, schema_url):
+        if not fetch.get_validators(url):
+            fingerprint = fetch.get_fingerprint(url)
+            # reading it may have turned up validators after all
+            if not fetch.get_validators(url):
+                fingerprints[url] = fingerprint
+    s = json.dumps([filters.get_plan_key(args), schema_url, severity_level, fingerprints], sort_keys=True)
+    return 'validation:' + hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+def do_validate(source, schema_url=None, severity_level=None, max_examples=None):
+    """Validate a source, and summarise the errors for each rule.
+    Memory use doesn't grow with the number of errors: each rule keeps
+    an exact count, but only its first few errors as examples (see
+    L{get_error_page} for the rest).
+    @param source: the HXL dataset to validate.
+    @param schema_url: (optional) the URL of a HXL schema (defaults to the libhxl default schema).
+    @param severity_level: (optional) the minimum severity to report.
+    @param max_examples: (optional) the number of errors to keep for each rule (defaults to C{VALIDATION_MAX_EXAMPLES}).
+    @return: False if the source has no data rows; otherwise, a dict keyed by rule hash
+    (see L{make_rule_hash}), where each value is a dict with the keys 'rule' (the
+    rule's severity, description, and tag_pattern), 'count' (the number of
+    errors), and 'examples' (a list of error records; see L{_make_error_record}).
+    Everything is plain dicts, so that the result can go into the cache.
+    """
+    if max_examples is None:
+        max_examples = app.config.get('VALIDATION_MAX_EXAMPLES')
     min_severity = SEVERITY_LEVELS.get(severity_level, -1)
+    processes = app.config.get('VALIDATION_PROCESSES')
+    if processes and processes > 1:
+        return _validate_in_processes(source, schema_url, min_severity, max_examples, processes)
     errors = {}
     def callback(error):
         if SEVERITY_LEVELS.get(error.rule.severity, 0) >= min_severity:
-            rule_hash = make_rule_hash(error.rule)
-            if errors.get(rule_hash) is None:
-                errors[rule_hash] = []
-            errors[rule_hash].append(error)
-    schema = hxl.schema(schema_url, callback)
+            _add_error(errors, error, max_examples)
+    schema = get_schema(schema_url, callback)
     counter = source.row_counter()
     result = schema.validate(counter)
     if counter.row_count == 0:
@@ -35,5 +177,226 @@ def do_validate(source, schema_url=None, severity_level=None):
     else:
         return errors
 
+def gen_validation_records(source, schema_url=None, severity_level=None):
+    """Validate a source row by row, yielding each error as soon as it turns up.
+    Nothing is kept but a count for each rule, so a client can stop
+    reading at any time, and memory use doesn't grow with the data.
+    @param source: the HXL dataset to validate.
+    @param schema_url: (optional) the URL of a HXL schema (defaults to the libhxl default schema).
+    @param severity_level: (optional) the minimum severity to report.
+    @return: an iterator over dicts: one with 'type': 'error' for each error (an
+    error record from L{_make_error_record}, plus 'rule_hash', 'severity',
+    'description', and 'tag_pattern'), then a last one with 'type': 'summary',
+    'rows', 'errors' (the total), 'valid', and 'rules' (a dict with the rule
+    and error count for each rule hash).
+    """
+    min_severity = SEVERITY_LEVELS.get(severity_level, -1)
+    pending = []
+    rules = {}
+    def callback(error):
+        if SEVERITY_LEVELS.get(error.rule.severity, 0) >= min_severity:
+            rule_hash = make_rule_hash(error.rule)
+            summary = rules.get(rule_hash)
+            if summary is None:
+                summary = dict(_make_rule_record(error.rule), count=0)
+                rules[rule_hash] = summary
+            summary['count'] += 1
+            record = dict(_make_error_record(error), type='error', rule_hash=rule_hash)
+            record.update(_make_rule_record(error.rule))
+            pending.append(record)
+    schema = get_schema(schema_url, callback)
+    counter = source.row_counter()
+    schema.validate_columns(counter.columns)
+    yield from _drain(pending)
+    for row in counter:
+        schema.validate_row(row)
+        yield from _drain(pending)
+    yield {
+        'type': 'summary',
+        'rows': counter.row_count,
+        'errors': sum(summary['count'] for summary in rules.values()),
+        'valid': counter.row_count > 0 and not rules,
+        'rules': rules
+    }
+
+def _drain(pending):
+    """Empty a list, returning what was in it."""
+    records = pending[:]
+    del pending[:]
+    return records
+
+def get_schema(schema_url, callback):
+    """Get a schema ready to validate, compiling it only if it isn't already in memory.
+    A compiled schema is good for C{FETCH_CACHE_FRESHNESS} seconds; after
+    that, the next validation asks the upstream server whether the schema
+    changed (a HEAD request with the validators from when it was read; see
+    L{hxl_proxy.fetch.is_modified}), and reads and compiles it again only
+    if it did, or if the server sent no validators to ask with.
+    @param schema_url: the URL of a HXL schema, or None for the libhxl default schema.
+    @param callback: the function to receive each HXLValidationException.
+    @return: a new hxl.validation.Schema, sharing its compiled rules with other requests.
+    """
+    if schema_url:
+        compiled = _get_compiled_schema(schema_url)
+    else:
+        compiled = _schemas.get_or_create(None, lambda: hxl.schema(None))
+    # Schema.validate() swaps the callback into each rule as it goes, so
+    # every request needs its own (shallow) copies of the rules
+    return hxl.validation.Schema([copy.copy(rule) for rule in compiled.rules], callback)
+
+def _get_compiled_schema(schema_url):
+    """Get a compiled schema from memory if it's still good, or else read and compile it (see L{get_schema})."""
+    now = time.time()
+    entry = _schemas.get(schema_url)
+    if entry is not None:
+        if now - entry.checked < app.config.get('FETCH_CACHE_FRESHNESS', 0):
+            return entry.schema
+        if entry.validators and not fetch.is_modified(schema_url, entry.validators):
+            _schemas.set(schema_url, entry._replace(checked=now))
+            return entry.schema
+    schema = hxl.schema(hxl.data(fetch.make_input(schema_url)))
+    _schemas.set(schema_url, _CompiledSchema(schema, fetch.get_validators(schema_url), now))
+    return schema
+
+def _add_error(errors, error, max_examples):
+    """Count an error in a summary (see L{do_validate}), keeping it if there's room for another example."""
+    rule_hash = make_rule_hash(error.rule)
+    summary = errors.get(rule_hash)
+    if summary is None:
+        summary = {'rule': _make_rule_record(error.rule), 'count': 0, 'examples': []}
+        errors[rule_hash] = summary
+    summary['count'] += 1
+    if max_examples is None or len(summary['examples']) < max_examples:
+        summary['examples'].append(_make_error_record(error))
+
+def _merge_errors(errors, partial, max_examples):
+    """Add the summary for one chunk of rows to the summary for the rows before it."""
+    for rule_hash, part in partial.items():
+        summary = errors.get(rule_hash)
+        if summary is None:
+            summary = {'rule': part['rule'], 'count': 0, 'examples': []}
+            errors[rule_hash] = summary
+        summary['count'] += part['count']
+        if max_examples is None:
+            summary['examples'] += part['examples']
+        else:
+            summary['examples'] += part['examples'][:max_examples - len(summary['examples'])]
+
+def _validate_in_processes(source, schema_url, min_severity, max_examples, processes):
+    """Validate chunks of rows side by side in a process pool, and merge their summaries.
+    The column checks need all the columns at once, so they run here
+    first; every other rule in a HXL schema looks at one row at a time.
+    Only a few chunks are in flight at once, so memory use stays flat.
+    @return: the same as L{do_validate}.
+    """
+    errors = {}
+    def callback(error):
+        if SEVERITY_LEVELS.get(error.rule.severity, 0) >= min_severity:
+            _add_error(errors, error, max_examples)
+    schema = get_schema(schema_url, callback)
+    columns = source.columns
+    schema.validate_columns(columns)
+    # the workers get the rules without a callback, and skip the ones that can't apply
+    rules = [rule for rule in schema.rules if rule not in schema.impossible_rules]
+
+    executor = _get_process_pool(processes)
+    chunk_size = app.config.get('VALIDATION_CHUNK_SIZE') or 10000
+    in_flight = collections.deque()
+    row_count = 0
+    for chunk in _gen_chunks(source, chunk_size):
+        in_flight.append(executor.submit(
+            _validate_chunk, rules, list(columns), chunk, row_count, min_severity, max_examples
+        ))
+        row_count += len(chunk)
+        if len(in_flight) >= processes * 2:
+            _merge_errors(errors, in_flight.popleft().result(), max_examples)
+    while in_flight:
+        _merge_errors(errors, in_flight.popleft().result(), max_examples)
+
+    if row_count == 0:
+        return False
+    else:
+        return errors
+
+def _validate_chunk(rules, columns, rows, first_row_number, min_severity, max_examples):
+    """Validate a list of rows (runs in a worker process).
+    @return: a summary of the errors, in the same format as L{do_validate}.
+    """
+    errors = {}
+    def callback(error):
+        if SEVERITY_LEVELS.get(error.rule.severity, 0) >= min_severity:
+            _add_error(errors, error, max_examples)
+    schema = hxl.validation.Schema(rules, callback)
+    for i, values in enumerate(rows):
+        schema.validate_row(hxl.model.Row(columns, values, first_row_number + i))
+    return errors
+
+def _gen_chunks(source, chunk_size):
+    """Split the rows of a dataset into lists of raw values."""
+    chunk = []
+    for row in source:
+        chunk.append(row.values)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _get_process_pool(processes):
+    """Get the process pool for validation, starting it the first time."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn, not fork: forking a threaded web server can copy locks in the wrong state
+            _process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn')
+            )
+            atexit.register(_process_pool.shutdown)
+        return _process_pool
+
+def _get_urls(args, schema_url):
+    """List the upstream URLs that a validation report depends on."""
+    return filters.get_source_urls(args) + ([schema_url] if schema_url else [])
+
+def _get_cached(key, urls, make_result):
+    """Get a report (or a page of one) from the cache, or make it and save it as JSON.
+    Takes the URL versions before making it, and the upstream validators after, the same way /data does.
+    @param key: the cache key.
+    @param urls: the upstream URLs that the result depends on (see L{_get_urls}).
+    @param make_result: a function to make the result (something JSON-serialisable).
+    """
+    body = caching.get_body(key)
+    if body is not None:
+        return json.loads(body)
+    dependencies = caching.get_dependencies(None, urls)
+    result = make_result()
+    caching.store_response(
+        key, json.dumps(result), 'application/json',
+        dependencies=dependencies, upstream=caching.get_upstream_validators(urls)
+    )
+    return result
+
+def _make_error_record(error):
+    """Copy the location and details of a HXLValidationException into a plain dict.
+    Keeps just the row number and the column's hashtag, rather than the row and column objects.
+    """
+    return {
+        'message': error.message,
+        'value': error.value,
+        'row_number': error.row.row_number if error.row is not None else None,
+        'column': error.column.display_tag if error.column is not None else None
+    }
+
+def _make_rule_record(rule):
+    return {
+        'severity': rule.severity,
+        'description': rule.description,
+        'tag_pattern': str(rule.tag_pattern) if rule.tag_pattern else None
+    }
+
+
+class _PageFull(Exception):
+    """Raised from a validation callback to stop early."""
+    pass
 
 # end
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""
+Bring an existing HXL Proxy database up to date with hxl_proxy/schema.sql
+(without erasing anything). Safe to run more than once.
+"""
+
+import sys, sqlite3
+
+#
+# Usage
+#
+if len(sys.argv) != 2:
+    print("Usage: upgrade-db <sqlite3 file>")
+    exit(2)
+
+sqlite3_file = sys.argv[1]
+
+
+def get_columns(cursor, table):
+    """List the names of a table's columns (empty if there's no such table)."""
+    return [row[1] for row in cursor.execute('pragma table_info({})'.format(table))]
+
+
+connection = sqlite3.connect(sqlite3_file);
+cursor = connection.cursor()
+
+#
+# Recipes.materialise (snapshots of saved recipes)
+#
+if 'materialise' not in get_columns(cursor, 'Recipes'):
+    print("Adding Recipes.materialise")
+    cursor.execute('alter table Recipes add column materialise boolean default false')
+
+#
+# ExportJobs (background exports)
+#
+if not get_columns(cursor, 'ExportJobs'):
+    print("Adding ExportJobs")
+    cursor.execute(
+        "create table ExportJobs ("
+        " job_id char(32) primary key,"
+        " recipe_id char(6),"
+        " format varchar(8) not null,"
+        " stub varchar(64),"
+        " args text not null,"
+        " status varchar(16) not null,"
+        " rows integer default 0,"
+        " bytes integer default 0,"
+        " error text,"
+        " date_created datetime not null,"
+        " date_modified datetime not null"
+        ")"
+    )
+
+connection.commit()
+connection.close()
+
+# end
@@ -19,7 +19,10 @@ setuptools.setup(
     url='https://github.com/HXLStandard/hxl-proxy',
     include_package_data = True,
     zip_safe = False,
-    install_requires=['flask-cache>=0.13', 'libhxl>=2.6', 'ckanapi>=3.5', 'flask>=0.10'],
+    install_requires=['flask-cache>=0.13', 'libhxl>=2.6', 'ckanapi>=3.5', 'flask>=0.10', 'requests>=2.4'],
+    extras_require={
+        'columnar': ['numpy>=1.13'] # vectorised sort, count, and dedup (see COLUMNAR_ENGINE)
+    },
     test_suite = "tests",
     tests_require = ['mock']
 )
@@ -33,9 +33,9 @@ def resolve_path(filename):
     return os.path.join(os.path.dirname(__file__), filename)
 
 # Target function to replace for mocking URL access.
-URL_MOCK_TARGET = 'hxl.io.make_stream'
+URL_MOCK_TARGET = 'hxl_proxy.upstream.open_url'
 
-# Mock object to replace hxl.io.make_stream
+# Mock object to replace hxl_proxy.upstream.open_url
 URL_MOCK_OBJECT = unittest.mock.Mock()
 URL_MOCK_OBJECT.side_effect = mock_open_url
 
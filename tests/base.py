@@ -8,6 +8,7 @@ License: Public Domain
 
 import unittest
 import os
+import shutil
 import tempfile
 
 import hxl_proxy
@@ -30,12 +31,15 @@ class BaseControllerTest(unittest.TestCase):
 
         hxl_proxy.dao.db.create_db()
         hxl_proxy.dao.db.execute_file(TEST_DATA_FILE)
+        hxl_proxy.cache.clear()
+        hxl_proxy.app.config['FETCH_CACHE_DIR'] = tempfile.mkdtemp()
+        hxl_proxy.app.config['SNIFF_RANGE_BYTES'] = 0 # the mock covers only upstream.open_url
 
         self.recipe_id = 'AAAAA'
         self.client = hxl_proxy.app.test_client()
 
     def tearDown(self):
-        pass
+        shutil.rmtree(hxl_proxy.app.config['FETCH_CACHE_DIR'])
 
     def get(self, path, params=None, status=200):
         """
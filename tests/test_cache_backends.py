@@ -0,0 +1,124 @@
+"""
+Unit tests for hxl_proxy.cache_backends module
+
+License: Public Domain
+"""
+
+import unittest, os, sqlite3, tempfile
+from unittest.mock import patch
+
+from hxl_proxy.cache_backends import SQLiteCache
+
+
+class TestSQLiteCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.cache = SQLiteCache(self.path, max_bytes=1000, default_timeout=60)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_set_get(self):
+        self.assertTrue(self.cache.set('a', {'body': 'xxx'}))
+        self.assertEqual({'body': 'xxx'}, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_shared(self):
+        """A second cache object on the same file (e.g. another process) sees the same entries."""
+        self.cache.set('a', 'aaa')
+        other = SQLiteCache(self.path, max_bytes=1000)
+        self.assertEqual('aaa', other.get('a'))
+
+    def test_timeout(self):
+        self.cache.set('a', 'aaa', timeout=10)
+        self.cache.set('b', 'bbb', timeout=0) # never expires
+        with patch('time.time', return_value=self._now() + 20):
+            self.assertIsNone(self.cache.get('a'))
+            self.assertFalse(self.cache.has('a'))
+            self.assertEqual('bbb', self.cache.get('b'))
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('a', 'aaa'))
+        self.assertFalse(self.cache.add('a', 'bbb'))
+        self.assertEqual('aaa', self.cache.get('a'))
+
+    def test_delete_clear(self):
+        self.cache.set('a', 'aaa')
+        self.cache.set('b', 'bbb')
+        self.assertTrue(self.cache.delete('a'))
+        self.assertFalse(self.cache.delete('a'))
+        self.assertTrue(self.cache.has('b'))
+        self.cache.clear()
+        self.assertFalse(self.cache.has('b'))
+
+    def test_lru_eviction(self):
+        """Stay under max_bytes by dropping the least-recently-used entries."""
+        value = 'x' * 300
+        now = self._now()
+        step = SQLiteCache.ACCESS_INTERVAL
+        for i, key in enumerate(['a', 'b', 'c']):
+            with patch('time.time', return_value=now + i * step):
+                self.cache.set(key, value, timeout=0)
+        with patch('time.time', return_value=now + 3 * step):
+            self.cache.get('a') # 'b' is now the oldest
+        with patch('time.time', return_value=now + 4 * step):
+            self.cache.set('d', value, timeout=0)
+        self.assertTrue(self.cache.has('a'))
+        self.assertFalse(self.cache.has('b'))
+        self.assertTrue(self.cache.has('c'))
+        self.assertTrue(self.cache.has('d'))
+
+    def test_get_many(self):
+        self.cache.set('a', 'aaa')
+        self.cache.set('b', 'bbb', timeout=10)
+        with patch('time.time', return_value=self._now() + 20):
+            self.assertEqual(['aaa', None, None], self.cache.get_many('a', 'b', 'c'))
+        self.assertEqual({'a': 'aaa', 'b': None}, self.cache.get_dict('a', 'b'))
+
+    def test_access_interval(self):
+        """A hit records its access time only if the stored one is old enough."""
+        now = self._now()
+        with patch('time.time', return_value=now):
+            self.cache.set('a', 'aaa', timeout=0)
+        with patch('time.time', return_value=now + 1):
+            self.cache.get('a')
+        self.assertEqual(now, self._get_accessed('a'))
+        with patch('time.time', return_value=now + SQLiteCache.ACCESS_INTERVAL + 1):
+            self.cache.get('a')
+        self.assertEqual(now + SQLiteCache.ACCESS_INTERVAL + 1, self._get_accessed('a'))
+
+    def test_size_total(self):
+        """The running total of sizes follows inserts, replacements, and deletes."""
+        self.cache.set('a', 'x' * 100)
+        self.cache.set('b', 'x' * 200)
+        self.cache.set('a', 'x' * 50)
+        self.cache.add('b', 'x' * 10)
+        self.cache.delete('b')
+        self.assertEqual(self._query('select sum(size) from CacheEntries'), self._query('select total from CacheSize'))
+        self.cache.clear()
+        self.assertEqual(0, self._query('select total from CacheSize'))
+
+    def test_too_big(self):
+        self.assertFalse(self.cache.set('a', 'x' * 2000))
+        self.assertIsNone(self.cache.get('a'))
+
+    def _get_accessed(self, key):
+        return self._query('select accessed from CacheEntries where key=?', (key,))
+
+    def _query(self, sql, params=()):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql, params).fetchone()[0]
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _now():
+        import time
+        return time.time()
+
+# end
@@ -0,0 +1,219 @@
+"""
+Unit tests for hxl_proxy.caching module
+
+License: Public Domain
+"""
+
+import threading, unittest
+from unittest.mock import patch
+import hxl_proxy
+from hxl_proxy import caching
+
+URL = 'http://example.org/basic-dataset.csv'
+OTHER_URL = 'http://example.org/other-dataset.csv'
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        hxl_proxy.cache.clear()
+        self.context = hxl_proxy.app.test_request_context('/data.csv')
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_round_trip(self):
+        caching.store_response('key', 'a,b\n', 'text/csv', {'X-Test': 'yes'})
+        response = caching.get_response('key')
+        self.assertEqual(b'a,b\n', response.data)
+        self.assertEqual('text/csv', response.mimetype)
+        self.assertEqual('yes', response.headers['X-Test'])
+
+    def test_stream(self):
+        """The body is cached only after the stream is exhausted."""
+        response = caching.stream_response('key', iter(['a,b\n', '1,2\n']), 'text/csv')
+        self.assertIsNone(caching.get_response('key'))
+        self.assertEqual(b'a,b\n1,2\n', response.get_data())
+        self.assertEqual(b'a,b\n1,2\n', caching.get_response('key').data)
+
+    def test_stream_too_big(self):
+        hxl_proxy.app.config['CACHE_MAX_ENTRY_SIZE'] = 5
+        try:
+            response = caching.stream_response('key', iter(['a,b\n', '1,2\n']), 'text/csv')
+            self.assertEqual(b'a,b\n1,2\n', response.get_data())
+            self.assertIsNone(caching.get_response('key'))
+        finally:
+            hxl_proxy.app.config['CACHE_MAX_ENTRY_SIZE'] = 16*1024*1024
+
+    def test_invalidate_recipe(self):
+        caching.store_response('a', 'aaa', 'text/csv', dependencies=caching.get_dependencies('AAAAA', [URL]))
+        caching.store_response('b', 'bbb', 'text/csv', dependencies=caching.get_dependencies('BBBBB', [URL]))
+        caching.invalidate_recipe('AAAAA')
+        self.assertIsNone(caching.get_response('a'))
+        self.assertIsNotNone(caching.get_response('b'))
+
+    def test_invalidate_urls(self):
+        caching.store_response('a', 'aaa', 'text/csv', dependencies=caching.get_dependencies(None, [URL]))
+        caching.store_response('b', 'bbb', 'text/csv', dependencies=caching.get_dependencies(None, [OTHER_URL]))
+        caching.invalidate_urls([URL])
+        self.assertIsNone(caching.get_response('a'))
+        self.assertIsNotNone(caching.get_response('b'))
+
+    def test_evicted_version(self):
+        """If a version key disappears from the cache, its entries must not come back."""
+        caching.store_response('a', 'aaa', 'text/csv', dependencies=caching.get_dependencies('AAAAA'))
+        hxl_proxy.cache.delete('version:recipe:AAAAA')
+        caching.get_dependencies('AAAAA')
+        self.assertIsNone(caching.get_response('a'))
+
+    def test_etag(self):
+        """The ETag depends on the body when upstream sent no validators."""
+        caching.store_response('a', 'aaa', 'text/csv')
+        caching.store_response('b', 'aaa', 'text/csv')
+        etag = caching.get_response('a').get_etag()[0]
+        self.assertTrue(etag)
+        self.assertNotEqual(etag, caching.get_response('b').get_etag()[0])
+        caching.store_response('a', 'bbb', 'text/csv')
+        self.assertNotEqual(etag, caching.get_response('a').get_etag()[0])
+
+    def test_not_modified(self):
+        caching.store_response('a', 'aaa', 'text/csv')
+        etag = caching.get_response('a').get_etag()[0]
+        with hxl_proxy.app.test_request_context('/data.csv', headers={'If-None-Match': '"{}"'.format(etag)}):
+            response = caching.get_response('a')
+            self.assertEqual(304, response.status_code)
+
+    def test_upstream_etag(self):
+        """With upstream validators, the ETag is known before streaming starts."""
+        upstream = {URL: {'etag': '"xyz"'}}
+        response = caching.stream_response('a', iter(['aaa']), 'text/csv', upstream=upstream)
+        etag = response.get_etag()[0]
+        self.assertTrue(etag)
+        response.get_data()
+        self.assertEqual(etag, caching.get_response('a').get_etag()[0])
+
+    def test_upstream_modified(self):
+        """Check upstream validators once UPSTREAM_CHECK_INTERVAL has passed."""
+        caching.store_response('a', 'aaa', 'text/csv', upstream={URL: {'etag': '"xyz"'}})
+        with patch('hxl_proxy.fetch.is_modified', return_value=True) as is_modified:
+            self.assertIsNotNone(caching.get_response('a'))
+            self.assertFalse(is_modified.called)
+            hxl_proxy.cache.delete('checked:a')
+            self.assertIsNone(caching.get_response('a'))
+            is_modified.assert_called_once_with(URL, {'etag': '"xyz"'})
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+
+    def setUp(self):
+        hxl_proxy.cache.clear()
+        self.context = hxl_proxy.app.test_request_context('/data.csv')
+        self.context.push()
+        caching._flights.clear()
+        self.revalidated = threading.Event()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def revalidate(self):
+        caching.store_response('a', 'new', 'text/csv')
+        self.revalidated.set()
+
+    def make_stale(self, key):
+        entry = hxl_proxy.cache.get(key)
+        entry['fresh_until'] -= 3600
+        hxl_proxy.cache.set(key, entry)
+
+    def test_expired(self):
+        caching.store_response('a', 'old', 'text/csv')
+        self.make_stale('a')
+        self.assertIsNone(caching.get_response('a'))
+        self.assertIsNone(caching.get_body('a'))
+        response = caching.get_response('a', revalidate=self.revalidate)
+        self.assertEqual(b'old', response.data)
+        self.assertIn('Stale', response.headers['Warning'])
+        self.assertTrue(self.revalidated.wait(5))
+        caching.wait_for_flight('a')
+        response = caching.get_response('a', revalidate=self.revalidate)
+        self.assertEqual(b'new', response.data)
+        self.assertNotIn('Warning', response.headers)
+
+    def test_source_changed(self):
+        caching.store_response('a', 'old', 'text/csv', dependencies=caching.get_dependencies(None, [URL]))
+        caching.invalidate_urls([URL])
+        self.assertIsNone(caching.get_response('a'))
+        self.assertEqual(b'old', caching.get_response('a', revalidate=self.revalidate).data)
+        self.assertTrue(self.revalidated.wait(5))
+
+    def test_recipe_changed(self):
+        """A new version of the recipe is never served stale."""
+        caching.store_response('a', 'old', 'text/csv', dependencies=caching.get_dependencies('AAAAA'))
+        caching.invalidate_recipe('AAAAA')
+        self.assertIsNone(caching.get_response('a', revalidate=self.revalidate))
+        self.assertFalse(self.revalidated.is_set())
+
+    def test_switched_off(self):
+        caching.store_response('a', 'old', 'text/csv')
+        self.make_stale('a')
+        saved = hxl_proxy.app.config['CACHE_STALE_TIMEOUT']
+        try:
+            hxl_proxy.app.config['CACHE_STALE_TIMEOUT'] = 0
+            self.assertIsNone(caching.get_response('a', revalidate=self.revalidate))
+        finally:
+            hxl_proxy.app.config['CACHE_STALE_TIMEOUT'] = saved
+
+    def test_one_revalidation(self):
+        """Nothing starts revalidating a key that something is already computing."""
+        caching.store_response('a', 'old', 'text/csv')
+        self.make_stale('a')
+        flight = caching.start_flight('a')
+        try:
+            self.assertEqual(b'old', caching.get_response('a', revalidate=self.revalidate).data)
+            self.assertFalse(self.revalidated.wait(0.1))
+        finally:
+            caching.finish_flight('a', flight)
+
+
+class TestFlights(unittest.TestCase):
+
+    def setUp(self):
+        hxl_proxy.cache.clear()
+        caching._flights.clear()
+
+    def test_start(self):
+        flight = caching.start_flight('a')
+        self.assertIsNotNone(flight)
+        self.assertIsNone(caching.start_flight('a'))
+        self.assertIsNotNone(caching.start_flight('b'))
+        caching.finish_flight('a', flight)
+        caching.finish_flight('a', flight)
+        self.assertIsNotNone(caching.start_flight('a'))
+
+    def test_wait(self):
+        self.assertFalse(caching.wait_for_flight('a'))
+        flight = caching.start_flight('a')
+        timer = threading.Timer(0.05, caching.finish_flight, ['a', flight])
+        timer.start()
+        self.assertTrue(caching.wait_for_flight('a'))
+        self.assertIsNotNone(caching.start_flight('a'))
+
+    def test_abandoned(self):
+        saved = hxl_proxy.app.config['COALESCE_TIMEOUT']
+        try:
+            hxl_proxy.app.config['COALESCE_TIMEOUT'] = 0
+            caching.start_flight('a')
+            self.assertIsNotNone(caching.start_flight('a'))
+        finally:
+            hxl_proxy.app.config['COALESCE_TIMEOUT'] = saved
+
+    def test_stream(self):
+        """A streaming response finishes its flight when the stream ends."""
+        with hxl_proxy.app.test_request_context('/data.csv'):
+            flight = caching.start_flight('a')
+            response = caching.stream_response('a', iter(['a,b\n']), 'text/csv', flight=flight)
+            self.assertIsNone(caching.start_flight('a'))
+            response.get_data()
+            self.assertIsNotNone(caching.start_flight('a'))
+
+# end
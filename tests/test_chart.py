@@ -0,0 +1,65 @@
+"""
+Unit tests for hxl_proxy.chart module
+
+License: Public Domain
+"""
+
+import unittest
+from unittest.mock import patch
+
+import hxl
+from hxl_proxy.chart import make_chart_data
+
+DATA = [
+    ['#org', '#sector', '#country', '#affected'],
+    ['Org A', 'WASH', 'Country A', '200'],
+    ['Org B', 'Health', 'Country B', '50'],
+    ['Org C', 'Protection', 'Country A', '100'],
+    ['Org A', 'Health', 'Country A', '25']
+]
+
+
+class TestChartData(unittest.TestCase):
+
+    def setUp(self):
+        self.source = hxl.data(DATA)
+
+    def test_rows(self):
+        """Without a count or filter, chart each row, guessing the numeric column."""
+        chart_data = make_chart_data(self.source, label_tag=hxl.TagPattern.parse('org'))
+        self.assertEqual('#affected', chart_data['value_pattern'])
+        self.assertEqual([['Org A', 200], ['Org B', 50], ['Org C', 100], ['Org A', 25]], chart_data['rows'])
+
+    def test_rows_sample(self):
+        """The value column is guessed from the first rows, and the rest still get charted."""
+        with patch('hxl_proxy.chart.GUESS_SAMPLE_ROWS', 2):
+            chart_data = make_chart_data(self.source, label_tag=hxl.TagPattern.parse('org'))
+        self.assertEqual('#affected', chart_data['value_pattern'])
+        self.assertEqual([['Org A', 200], ['Org B', 50], ['Org C', 100], ['Org A', 25]], chart_data['rows'])
+
+    def test_count(self):
+        chart_data = make_chart_data(self.source, count_tag=hxl.TagPattern.parse('sector'))
+        self.assertEqual('#sector', chart_data['label_pattern'])
+        self.assertEqual([['Health', 2], ['Protection', 1], ['WASH', 1]], chart_data['rows'])
+
+    def test_filter_value(self):
+        chart_data = make_chart_data(
+            self.source,
+            count_tag=hxl.TagPattern.parse('sector'),
+            filter_tag=hxl.TagPattern.parse('country'),
+            filter_value='country b'
+        )
+        self.assertEqual([['Health', 1]], chart_data['rows'])
+        self.assertEqual(['Country A', 'Country B'], chart_data['filter_values'])
+
+    def test_filter_sum(self):
+        """With a filter column but no value, sum the values for each label."""
+        chart_data = make_chart_data(
+            self.source,
+            label_tag=hxl.TagPattern.parse('org'),
+            value_tag=hxl.TagPattern.parse('affected'),
+            filter_tag=hxl.TagPattern.parse('country')
+        )
+        self.assertEqual([['Org A', 225], ['Org B', 50], ['Org C', 100]], chart_data['rows'])
+
+# end
@@ -0,0 +1,117 @@
+"""
+Unit tests for hxl_proxy.columnar module
+
+License: Public Domain
+"""
+
+import unittest
+from unittest.mock import patch
+
+import hxl
+from hxl_proxy import app, columnar, filters
+
+DATA = [
+    ['Organisation', 'Sector', 'Province', 'Code', 'Date', 'Targeted', 'Reached'],
+    ['#org', '#sector', '#adm1', '#adm1+code', '#date', '#targeted', '#reached'],
+    ['Org C', 'WASH', 'Coast', 'X02', '2017-03-01', '300', '200'],
+    ['Org A', 'Health', ' coast', 'X02', 'Feb 1 2017', '100', '80'],
+    ['Org B', 'WASH', 'Hills', 'X01', '2017-01-15', '50', 'n/a'],
+    ['org a', 'WASH', 'Hills', 'X01', '', '300', '250'],
+    ['Org B', 'Education', 'Coast', 'X02', 'unknown', '75.5', ''],
+    ['Org A', 'Health', 'Coast', 'X02', '2017-02-01', '100', '90'],
+    ['Org D', '', 'Coast', '', '2017-01-15', '1e3', '10'],
+    ['Org A', 'Health', 'Coast', 'X02', '2017-02-01', '100', '90'],
+    ['Org E', 'WASH', 'Lake', 'X03', '', '', ''],
+]
+
+
+class TestColumnar(unittest.TestCase):
+
+    def assertSameRows(self, expected, actual):
+        """Check that two filters (each with its own source) produce the same columns and rows."""
+        self.assertEqual([column.display_tag for column in expected.columns], [column.display_tag for column in actual.columns])
+        self.assertEqual(expected.values, actual.values)
+
+    def test_dedup(self):
+        for tags in (['org'], ['org', 'adm1'], ['date'], ['nothing'], []):
+            self.assertSameRows(hxl.data(DATA).dedup(tags), columnar.ColumnarDedupFilter(hxl.data(DATA), tags))
+
+    def test_dedup_streams(self):
+        """Dedup returns the first rows before reading the rest."""
+        rows = iter(columnar.ColumnarDedupFilter(hxl.data(hxl.io.ArrayInput(iter(DATA))), ['org']))
+        self.assertEqual('Org C', next(rows).get('org'))
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_sort(self):
+        for tags in (['org'], ['adm1', 'targeted'], ['date'], ['reached', 'org'], ['nothing'], []):
+            for reverse in (False, True):
+                self.assertSameRows(
+                    hxl.data(DATA).sort(tags, reverse),
+                    columnar.ColumnarSortFilter(hxl.data(DATA), tags, reverse)
+                )
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_sort_stable(self):
+        result = columnar.ColumnarSortFilter(hxl.data(DATA), ['sector'], True).values
+        self.assertEqual(['Org C', 'Org B', 'org a', 'Org E'], [row[0] for row in result[:4]])
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_count(self):
+        for tags in (['adm1'], ['org', 'adm1'], ['sector', 'adm1+code'], ['nothing'], []):
+            self.assertSameRows(hxl.data(DATA).count(tags), columnar.ColumnarCountFilter(hxl.data(DATA), tags))
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_count_aggregates(self):
+        for tags in (['adm1'], ['org'], ['sector']):
+            for aggregate in ('targeted', 'reached', 'date'):
+                self.assertSameRows(
+                    hxl.data(DATA).count(tags, aggregate_pattern=aggregate, count_spec='Rows#meta+rows'),
+                    columnar.ColumnarCountFilter(hxl.data(DATA), tags, aggregate_pattern=aggregate, count_spec='Rows#meta+rows')
+                )
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_count_average(self):
+        # like libhxl, the average stops at the last row with a number
+        result = columnar.ColumnarCountFilter(hxl.data(DATA), ['sector'], aggregate_pattern='reached').values
+        self.assertEqual(['WASH', 4, 450.0, 150.0, 200.0, 250.0], result[-1])
+        self.assertEqual(['Education', 1, '', '', '', ''], result[1])
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_ranks(self):
+        column = columnar._KeyColumn()
+        for value in ['b', 'a', 'b', None]:
+            column.add(value)
+        self.assertEqual([1, 0, 1, -1], list(column.rank()))
+        self.assertEqual('a', column.get(1))
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_empty(self):
+        self.assertEqual([], columnar.ColumnarSortFilter(hxl.data(DATA[:2]), ['org']).values)
+        self.assertEqual([], columnar.ColumnarCountFilter(hxl.data(DATA[:2]), ['org'], aggregate_pattern='reached').values)
+        self.assertEqual([], columnar.ColumnarDedupFilter(hxl.data(DATA[:2])).values)
+
+
+class TestColumnarConfig(unittest.TestCase):
+
+    PARAMS = {'tags': hxl.TagPattern.parse_list('org'), 'reverse': False}
+
+    def setUp(self):
+        saved = app.config.get('COLUMNAR_ENGINE')
+        self.addCleanup(app.config.__setitem__, 'COLUMNAR_ENGINE', saved)
+
+    def test_disabled(self):
+        app.config['COLUMNAR_ENGINE'] = False
+        self.assertNotIsInstance(filters.apply_sort_filter(hxl.data(DATA), self.PARAMS), columnar.ColumnarSortFilter)
+
+    @unittest.skipIf(columnar.numpy is None, 'numpy is not installed')
+    def test_enabled(self):
+        app.config['COLUMNAR_ENGINE'] = True
+        self.assertIsInstance(filters.apply_sort_filter(hxl.data(DATA), self.PARAMS), columnar.ColumnarSortFilter)
+        self.assertIsInstance(filters.apply_dedup_filter(hxl.data(DATA), self.PARAMS), columnar.ColumnarDedupFilter)
+
+    def test_no_numpy(self):
+        """Without numpy, the pipeline uses the libhxl filters even if COLUMNAR_ENGINE is set."""
+        app.config['COLUMNAR_ENGINE'] = True
+        with patch.object(columnar, 'numpy', None):
+            self.assertNotIsInstance(filters.apply_sort_filter(hxl.data(DATA), self.PARAMS), columnar.ColumnarSortFilter)
+            self.assertNotIsInstance(filters.apply_dedup_filter(hxl.data(DATA), self.PARAMS), columnar.ColumnarDedupFilter)
@@ -151,6 +151,19 @@ class TestEditPage(BaseControllerTest):
         assert b'Add filters to your data recipe' in response.data
         self.assertBasicDataset(response)
 
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_one_pass(self):
+        """The editor gets its row count from the statistics job, instead of a second pass."""
+        # long enough that the preview stops early
+        response = self.get('/data/edit', {
+            'url': DATASET_URL,
+            'filter01': 'append',
+            'append-dataset01-01': DATASET_URL
+        })
+        assert b'Previewing the first' in response.data
+        assert b'stats.json' in response.data
+        assert b'rowcount.json' not in response.data
+
     def test_need_login(self):
         response = self.get('/data/{}/edit'.format(self.recipe_id), status=303)
         assert '/data/{}/login'.format(self.recipe_id) in response.headers['Location']
@@ -185,9 +198,133 @@ class TestDataPage(BaseControllerTest):
         assert b'Recipe #1' in response.data
         self.assertBasicDataset(response)
 
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_csv(self):
+        response = self.get('/data.csv', {
+            'url': DATASET_URL
+        })
+        self.assertEqual('text/csv', response.mimetype)
+        self.assertEqual('*', response.headers['Access-Control-Allow-Origin'])
+        self.assertBasicDataset(response)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_json(self):
+        import json
+        response = self.get('/data.json', {
+            'url': DATASET_URL
+        })
+        self.assertEqual('application/json', response.mimetype)
+        rows = json.loads(response.data.decode('utf-8'))
+        self.assertEqual('#org', rows[1][0])
+        self.assertBasicDataset(response)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_cached_csv(self):
+        """A finished CSV stream should be served from the cache the second time."""
+        first = self.get('/data.csv', {'url': DATASET_URL}).data
+        URL_MOCK_OBJECT.reset_mock()
+        second = self.get('/data.csv', {'url': DATASET_URL}).data
+        self.assertEqual(first, second)
+        self.assertFalse(URL_MOCK_OBJECT.called)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_force(self):
+        """force= should skip the cached copy."""
+        self.get('/data.csv', {'url': DATASET_URL}).data # stream it into the cache
+        URL_MOCK_OBJECT.reset_mock()
+        self.assertBasicDataset(self.get('/data.csv', {'url': DATASET_URL, 'force': 'on'}))
+        self.assertTrue(URL_MOCK_OBJECT.called)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_not_modified(self):
+        """A client that already has the current version gets a 304."""
+        self.get('/data.csv', {'url': DATASET_URL}).data # stream it into the cache
+        etag = self.get('/data.csv', {'url': DATASET_URL}).headers['ETag']
+        URL_MOCK_OBJECT.reset_mock()
+        response = self.client.get('/data.csv', query_string={'url': DATASET_URL}, headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertFalse(URL_MOCK_OBJECT.called)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_coalesce(self):
+        """A request for output that another request is already computing waits for its result."""
+        import threading
+        from hxl_proxy import app, caching, util
+        with app.test_request_context('/data.csv', query_string={'url': DATASET_URL}):
+            key = util.make_cache_key()
+        flight = caching.start_flight(key)
+        def finish():
+            caching.store_response(key, 'from the other request', 'text/csv')
+            caching.finish_flight(key, flight)
+        timer = threading.Timer(0.05, finish)
+        timer.start()
+        URL_MOCK_OBJECT.reset_mock()
+        response = self.get('/data.csv', {'url': DATASET_URL})
+        self.assertEqual(b'from the other request', response.data)
+        self.assertFalse(URL_MOCK_OBJECT.called)
+
     # TODO test that filters work
 
 
+class TestChartPage(BaseControllerTest):
+    """Test /data/chart and /data/chart.json"""
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_chart(self):
+        URL_MOCK_OBJECT.reset_mock()
+        response = self.get('/data/chart', {'url': DATASET_URL, 'count_tag': 'sector', 'filter_tag': 'country'})
+        assert b'chart_data' in response.data
+        assert b'<option value="Myanmar"' in response.data
+        # one pass through the data
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_chart_json(self):
+        import json
+        response = self.get('/data/chart.json', {'url': DATASET_URL, 'count_tag': 'sector'})
+        self.assertEqual('application/json', response.mimetype)
+        self.assertEqual('*', response.headers['Access-Control-Allow-Origin'])
+        chart_data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual('#sector', chart_data['label_pattern'])
+        self.assertEqual([['Education', 1], ['Health', 1], ['WASH', 1]], chart_data['rows'])
+
+
+class TestRowCount(BaseControllerTest):
+    """Test /data/rowcount.json"""
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_rowcount(self):
+        import json
+        response = self.get('/data/rowcount.json', {'url': DATASET_URL})
+        self.assertEqual('application/json', response.mimetype)
+        self.assertEqual({'rows': 3}, json.loads(response.data.decode('utf-8')))
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_rowcount_filtered(self):
+        import json
+        response = self.get('/data/rowcount.json', {
+            'url': DATASET_URL, 'filter01': 'select', 'select-query01-01': 'sector=WASH'
+        })
+        self.assertEqual({'rows': 1}, json.loads(response.data.decode('utf-8')))
+
+
+class TestStats(BaseControllerTest):
+    """Test /data/stats.json"""
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_stats(self):
+        import concurrent.futures, json
+        from hxl_proxy import stats
+        params = {'url': DATASET_URL, 'filter01': 'select', 'select-query01-01': 'sector=WASH'}
+        response = self.get('/data/stats.json', params, status=202)
+        self.assertEqual({'status': 'pending'}, json.loads(response.data.decode('utf-8')))
+        concurrent.futures.wait(list(stats._jobs.values()))
+        response = self.get('/data/stats.json', params)
+        result = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(['input', 'select'], [stage['filter'] for stage in result['stages']])
+        self.assertEqual([3, 1], [stage['rows'] for stage in result['stages']])
+
+
 class TestValidationPage(BaseControllerTest):
     """Test /data/validate and /data/{recipe_id}/validate"""
 
@@ -211,4 +348,61 @@ class TestValidationPage(BaseControllerTest):
         })
         assert b'Validation succeeded' in response.data
 
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_details(self):
+        """The details for a rule come from the stored report."""
+        from hxl_proxy import validate
+        params = {'url': DATASET_URL, 'schema_url': 'http://example.org/bad-schema.csv'}
+        response = self.get('/data/validate', params)
+        assert b'2 validation issue(s)' in response.data
+        errors = validate.get_errors({'args': params}, params['schema_url'], 'info')
+        rule_hash = [key for key in errors if errors[key]['examples'][0]['value'] == 'Myanmar'][0]
+        with patch('hxl_proxy.validate.do_validate') as do_validate:
+            response = self.get('/data/validate', dict(params, details=rule_hash))
+            self.assertFalse(do_validate.called)
+        assert b'Unknown country' in response.data
+        assert b'Myanmar' in response.data
+
+
+class TestValidationJSON(BaseControllerTest):
+    """Test /data/validate.json"""
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_stream(self):
+        import json
+        response = self.get('/data/validate.json', {
+            'url': DATASET_URL,
+            'schema_url': 'http://example.org/bad-schema.csv'
+        })
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        records = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual(['error', 'error', 'summary'], [record['type'] for record in records])
+        self.assertEqual(['Education', 'Myanmar'], [record['value'] for record in records[:2]])
+        self.assertEqual(1, records[0]['row_number'])
+        summary = records[-1]
+        self.assertEqual((3, 2, False), (summary['rows'], summary['errors'], summary['valid']))
+        self.assertEqual(2, len(summary['rules']))
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_severity(self):
+        import json
+        response = self.get('/data/validate.json', {
+            'url': DATASET_URL,
+            'schema_url': 'http://example.org/bad-schema.csv',
+            'severity': 'error'
+        })
+        records = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual(['Myanmar'], [record['value'] for record in records if record['type'] == 'error'])
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_valid(self):
+        import json
+        response = self.get('/data/validate.json', {
+            'url': DATASET_URL,
+            'schema_url': 'http://example.org/good-schema.csv'
+        })
+        records = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual(1, len(records))
+        self.assertTrue(records[0]['valid'])
+
 # end
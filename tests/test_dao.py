@@ -105,7 +105,64 @@ class TestRecipe(AbstractDBTest):
         self.assertEquiv(recipe, result)
         self.assertNotEqual(result['date_created'], result['date_modified'])
 
+    def test_list_materialised(self):
+        self.assertEqual([], dao.recipes.list_materialised())
+        recipe = dao.recipes.read('BBBBB')
+        recipe['materialise'] = True
+        dao.recipes.update(recipe)
+        self.assertEqual(['BBBBB'], [recipe['recipe_id'] for recipe in dao.recipes.list_materialised()])
+        self.assertEqual({}, dao.recipes.list_materialised()[0]['args'])
+
     def test_delete(self):
         assert dao.recipes.read('AAAAA') is not None
         dao.recipes.delete('AAAAA')
         assert dao.recipes.read('AAAAA') is None
+
+
+class TestExportJob(AbstractDBTest):
+    """Test export job DAO functionality"""
+
+    NEW_JOB = {
+        'job_id': '0123456789abcdef0123456789abcdef',
+        'recipe_id': 'AAAAA',
+        'format': 'csv',
+        'stub': 'recipe1',
+        'args': {'url': 'http://example.org/basic-dataset.csv'},
+        'status': 'queued'
+    }
+
+    def test_create(self):
+        dao.exports.create(self.NEW_JOB)
+        result = dao.exports.read(self.NEW_JOB['job_id'])
+        self.assertEquiv(self.NEW_JOB, result)
+        self.assertEqual(0, result['rows'])
+        self.assertEqual(result['date_created'], result['date_modified'])
+
+    def test_update(self):
+        dao.exports.create(self.NEW_JOB)
+        job = dict(self.NEW_JOB, status='running', rows=10, bytes=1000)
+        dao.exports.update(job)
+        self.assertEquiv(job, dao.exports.read(job['job_id']))
+
+    def test_list_expired(self):
+        dao.exports.create(self.NEW_JOB)
+        self.assertEqual([], dao.exports.list_expired(60))
+        dao.db.execute_statement("update ExportJobs set date_modified=datetime('now', '-2 minutes')", commit=True)
+        self.assertEqual([self.NEW_JOB['job_id']], [job['job_id'] for job in dao.exports.list_expired(60)])
+
+    def test_fail_stalled(self):
+        dao.exports.create(self.NEW_JOB)
+        dao.db.execute_statement("update ExportJobs set date_modified=datetime('now', '-2 minutes')", commit=True)
+        dao.exports.touch([self.NEW_JOB['job_id']])
+        dao.exports.fail_stalled(60, 'Stalled')
+        self.assertEqual('queued', dao.exports.read(self.NEW_JOB['job_id'])['status'])
+        dao.db.execute_statement("update ExportJobs set date_modified=datetime('now', '-2 minutes')", commit=True)
+        dao.exports.fail_stalled(60, 'Stalled', 'no-such-job')
+        self.assertEqual('queued', dao.exports.read(self.NEW_JOB['job_id'])['status'])
+        dao.exports.fail_stalled(60, 'Stalled', self.NEW_JOB['job_id'])
+        self.assertEquiv({'status': 'failed', 'error': 'Stalled'}, dao.exports.read(self.NEW_JOB['job_id']))
+
+    def test_delete(self):
+        dao.exports.create(self.NEW_JOB)
+        dao.exports.delete(self.NEW_JOB['job_id'])
+        assert dao.exports.read(self.NEW_JOB['job_id']) is None
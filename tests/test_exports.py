@@ -0,0 +1,134 @@
+"""
+Unit tests for hxl_proxy.exports module
+
+License: Public Domain
+"""
+
+import json, os, shutil, tempfile, threading, time
+from unittest.mock import patch
+
+import hxl_proxy
+from hxl_proxy import dao, exports
+
+from . import URL_MOCK_TARGET, URL_MOCK_OBJECT
+from .base import BaseControllerTest
+
+
+@patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+class TestExports(BaseControllerTest):
+
+    def setUp(self):
+        super().setUp()
+        hxl_proxy.app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        hxl_proxy.app.config['EXPORT_RETENTION'] = 3600
+
+    def tearDown(self):
+        shutil.rmtree(hxl_proxy.app.config['EXPORT_DIR'])
+        hxl_proxy.app.config['EXPORT_DIR'] = None
+        super().tearDown()
+
+    def wait_for(self, job_id):
+        """Poll the status endpoint until a job is finished."""
+        for i in range(100):
+            status = json.loads(self.get('/exports/{}.json'.format(job_id)).data.decode('utf-8'))
+            if status['status'] not in ('queued', 'running'):
+                return status
+            time.sleep(0.05)
+        self.fail('Export job {} did not finish'.format(job_id))
+
+    def test_export(self):
+        response = self.client.post('/data/{}/export'.format(self.recipe_id))
+        self.assertEqual(202, response.status_code)
+        job = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(self.recipe_id, job['recipe_id'])
+        self.assertTrue(response.headers['Location'].endswith('/exports/{}.json'.format(job['job_id'])))
+
+        status = self.wait_for(job['job_id'])
+        self.assertEqual('done', status['status'])
+        self.assertEqual(3, status['rows'])
+        self.assertTrue(status['bytes'] > 0)
+        self.assertTrue(status['download_url'].endswith('/exports/{}/download'.format(job['job_id'])))
+
+        response = self.get('/exports/{}/download'.format(job['job_id']))
+        self.assertBasicDataset(response)
+        self.assertEqual(status['bytes'], len(response.data))
+        self.assertEqual('text/csv', response.mimetype)
+        self.assertEqual('attachment; filename=recipe1.csv', response.headers['Content-Disposition'])
+
+    def test_export_json(self):
+        response = self.client.post('/data/export', query_string={
+            'url': 'http://example.org/basic-dataset.csv',
+            'format': 'json'
+        })
+        job_id = json.loads(response.data.decode('utf-8'))['job_id']
+        self.assertEqual('done', self.wait_for(job_id)['status'])
+        response = self.get('/exports/{}/download'.format(job_id))
+        self.assertEqual('application/json', response.mimetype)
+        self.assertEqual('#country', json.loads(response.data.decode('utf-8'))[1][2][:8])
+        self.assertEqual('attachment; filename=data.json', response.headers['Content-Disposition'])
+
+    def test_bad_format(self):
+        response = self.client.post('/data/{}/export'.format(self.recipe_id), query_string={'format': 'xls'})
+        self.assertEqual(400, response.status_code)
+
+    def test_failed(self):
+        response = self.client.post('/data/export', query_string={'url': 'http://example.org/no-such-file.csv'})
+        status = self.wait_for(json.loads(response.data.decode('utf-8'))['job_id'])
+        self.assertEqual('failed', status['status'])
+        self.assertTrue(status['error'])
+        self.get('/exports/{}/download'.format(status['job_id']), status=409)
+
+    def test_unknown_job(self):
+        self.get('/exports/{}.json'.format('0' * 32), status=404)
+        self.get('/exports/{}/download'.format('0' * 32), status=404)
+
+    def test_purge_expired(self):
+        job = exports.submit(dao.recipes.read(self.recipe_id), 'csv')
+        self.wait_for(job['job_id'])
+        path = exports.get_file(exports.get_job(job['job_id']))
+        self.assertTrue(os.path.exists(path))
+        dao.db.execute_statement(
+            "update ExportJobs set date_modified=datetime('now', '-2 hours') where job_id=?",
+            (job['job_id'],), commit=True
+        )
+        exports.purge_expired()
+        self.assertIsNone(exports.get_job(job['job_id']))
+        self.assertFalse(os.path.exists(path))
+
+    def test_stalled(self):
+        """A job that stopped changing while queued or running (e.g. its process died) counts as failed."""
+        job_id = '0' * 32
+        dao.exports.create({'job_id': job_id, 'format': 'csv', 'args': {}, 'status': 'running'})
+        self.assertEqual('running', json.loads(self.get('/exports/{}.json'.format(job_id)).data.decode('utf-8'))['status'])
+        dao.db.execute_statement(
+            "update ExportJobs set date_modified=datetime('now', '-1 minute') where job_id=?", (job_id,), commit=True
+        )
+        response = self.get('/exports/{}.json'.format(job_id))
+        status = json.loads(response.data.decode('utf-8'))
+        self.assertEqual('failed', status['status'])
+        self.assertEqual(exports.STALL_ERROR, status['error'])
+        self.assertNotIn('Retry-After', response.headers)
+
+    def test_heartbeat(self):
+        """The process running a job keeps it alive, however long a row takes."""
+        release = threading.Event()
+        with patch('hxl_proxy.exports._export', side_effect=lambda job: release.wait(5)):
+            job = exports.submit(dao.recipes.read(self.recipe_id), 'csv')
+            try:
+                dao.db.execute_statement(
+                    "update ExportJobs set date_modified=datetime('now', '-1 minute') where job_id=?",
+                    (job['job_id'],), commit=True
+                )
+                exports._beat()
+                self.assertIn(exports.get_job(job['job_id'])['status'], ('queued', 'running'))
+            finally:
+                release.set()
+            self.assertEqual('done', self.wait_for(job['job_id'])['status'])
+
+    def test_disabled(self):
+        hxl_proxy.app.config['EXPORT_DIR'], directory = None, hxl_proxy.app.config['EXPORT_DIR']
+        try:
+            response = self.client.post('/data/{}/export'.format(self.recipe_id))
+            self.assertEqual(404, response.status_code)
+        finally:
+            hxl_proxy.app.config['EXPORT_DIR'] = directory
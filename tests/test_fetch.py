@@ -0,0 +1,193 @@
+"""
+Unit tests for hxl_proxy.fetch module
+
+License: Public Domain
+"""
+
+import io, threading, time, unittest, shutil, tempfile
+from unittest.mock import patch, Mock
+import hxl_proxy
+from hxl_proxy import fetch
+
+from . import URL_MOCK_TARGET, URL_MOCK_OBJECT
+
+URL = 'http://example.org/basic-dataset.csv'
+
+
+class TestFetchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_config = dict(hxl_proxy.app.config)
+        hxl_proxy.app.config['FETCH_CACHE_DIR'] = tempfile.mkdtemp()
+        hxl_proxy.app.config['FETCH_CACHE_FRESHNESS'] = 300
+        URL_MOCK_OBJECT.reset_mock()
+
+    def tearDown(self):
+        shutil.rmtree(hxl_proxy.app.config['FETCH_CACHE_DIR'])
+        hxl_proxy.app.config.update(self.saved_config)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_fresh(self):
+        """A second read inside the freshness window doesn't go upstream."""
+        first = self._read()
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+        self.assertEqual(first, self._read())
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_partial_read(self):
+        """Don't cache a source that wasn't read to the end."""
+        stream = fetch.open_stream(URL)
+        stream.read(10)
+        stream.close()
+        self._read()
+        self.assertEqual(2, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_too_big(self):
+        hxl_proxy.app.config['FETCH_CACHE_MAX_ENTRY_SIZE'] = 10
+        self._read()
+        self._read()
+        self.assertEqual(2, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_forget(self):
+        self._read()
+        fetch.forget([URL])
+        self._read()
+        self.assertEqual(2, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_stale_no_validators(self):
+        """Without validators, a stale source is downloaded again."""
+        hxl_proxy.app.config['FETCH_CACHE_FRESHNESS'] = 0
+        self._read()
+        self._read()
+        self.assertEqual(2, URL_MOCK_OBJECT.call_count)
+
+    @patch('hxl_proxy.upstream.request')
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_revalidate(self, upstream_request):
+        """A stale source with validators is reused when upstream answers 304."""
+        hxl_proxy.app.config['FETCH_CACHE_FRESHNESS'] = 0
+        with patch('hxl_proxy.fetch._save_validators', new=lambda url, headers: fetch._remember_validators(url, {'etag': '"xxx"'})):
+            first = self._read()
+        upstream_request.return_value = Mock(status_code=304)
+        self.assertEqual(first, self._read())
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+        self.assertEqual('"xxx"', upstream_request.call_args[1]['headers']['If-None-Match'])
+        self.assertEqual({'etag': '"xxx"'}, fetch.get_validators(URL))
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_side_data(self):
+        """Auxiliary datasets stay parsed in memory until forgotten."""
+        fetch._side_data.clear()
+        rows = [row.values for row in fetch.open_dataset(URL)]
+        self.assertTrue(rows)
+        self.assertIs(fetch.get_side_data(URL), fetch.get_side_data(URL))
+        self.assertEqual(rows, [row.values for row in fetch.open_dataset(URL)])
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+        fetch.forget([URL])
+        fetch.get_side_data(URL)
+        self.assertEqual(2, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_side_data_too_big(self):
+        """Auxiliary datasets with more than SIDE_CACHE_MAX_ROWS rows stream instead."""
+        fetch._side_data.clear()
+        saved = hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS']
+        hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS'] = 2
+        try:
+            # a filter streams on over the same download
+            side_data, dataset = fetch.open_side_data(URL)
+            self.assertIsNone(side_data)
+            self.assertEqual(3, len(dataset.values))
+            self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+            # and next time, streams straight away
+            self.assertEqual(3, len(fetch.open_dataset(URL).values))
+            self.assertIsNone(fetch.get_side_data(URL))
+            self.assertEqual(1, URL_MOCK_OBJECT.call_count) # from the fetch cache
+        finally:
+            hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS'] = saved
+            fetch._side_data.clear()
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_side_data_too_big_prefetched(self):
+        """A prefetch that finds a dataset too big still leaves it in the fetch cache for the filter."""
+        fetch._side_data.clear()
+        saved = hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS']
+        hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS'] = 2
+        try:
+            self.assertIsNone(fetch.get_side_data(URL))
+            self.assertEqual(3, len(fetch.open_dataset(URL).values))
+            self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+        finally:
+            hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS'] = saved
+            fetch._side_data.clear()
+
+    def test_prefetch(self):
+        """Auxiliary datasets download in parallel, but no more than the limit per host at once."""
+        from tests import resolve_path
+        hxl_proxy.app.config['SIDE_FETCH_MAX_PER_HOST'] = 2
+        fetch._side_data.clear()
+        state = {'active': 0, 'max_active': 0}
+        lock = threading.Lock()
+        def slow_open(url, allow_local=False):
+            with lock:
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+            time.sleep(0.05)
+            with lock:
+                state['active'] -= 1
+            return open(resolve_path('files/basic-dataset.csv'), 'rb')
+        urls = ['http://prefetch.example.org/data{}.csv'.format(n) for n in range(6)]
+        with patch(URL_MOCK_TARGET, new=Mock(side_effect=slow_open)) as open_url:
+            fetch.prefetch_side_data(urls)
+            self.assertEqual(6, open_url.call_count)
+            self.assertEqual(2, state['max_active'])
+            # now they're in memory
+            fetch.prefetch_side_data(urls)
+            fetch.open_dataset(urls[0])
+            self.assertEqual(6, open_url.call_count)
+
+    @patch('hxl_proxy.upstream.request')
+    def test_sniff_range(self, upstream_request):
+        """The tagger reads a CSV prefix with a Range request, dropping the partial last line."""
+        hxl_proxy.app.config['SNIFF_RANGE_BYTES'] = 25
+        fetch._sniffs.clear()
+        upstream_request.return_value = Mock(
+            status_code=206,
+            headers={'Content-Range': 'bytes 0-24/1000'},
+            raw=io.BytesIO(b'Org,Sector\nOrg A,WASH\nOrg B,Educ')
+        )
+        self.assertEqual((['Org', 'Sector'], ['Org A', 'WASH']), fetch.sniff_rows(URL, max_rows=25))
+        self.assertEqual('bytes=0-24', upstream_request.call_args[1]['headers']['Range'])
+        fetch.sniff_rows(URL, max_rows=25)
+        self.assertEqual(1, upstream_request.call_count)
+
+    @patch('hxl_proxy.upstream.request')
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_sniff_workbook(self, upstream_request):
+        """A workbook can't be read from a prefix, so download the whole thing."""
+        fetch._sniffs.clear()
+        upstream_request.return_value = Mock(status_code=206, headers={}, raw=io.BytesIO(b'PK\x03\x04xxxx'))
+        rows = fetch.sniff_rows(URL, max_rows=2)
+        self.assertEqual(2, len(rows))
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_sniff_no_range(self):
+        """Without Range requests, stop reading after max_rows."""
+        hxl_proxy.app.config['SNIFF_RANGE_BYTES'] = 0
+        fetch._sniffs.clear()
+        self.assertEqual(1, len(fetch.sniff_rows(URL, max_rows=1)))
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+
+    def _read(self):
+        stream = fetch.open_stream(URL)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+# end
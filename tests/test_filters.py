@@ -10,6 +10,8 @@ import unittest
 import sys
 import operator
 
+import hxl
+import hxl_proxy
 from hxl.model import TagPattern
 from hxl.io import ArrayInput, HXLReader
 from hxl_proxy.filters import *
@@ -52,6 +54,81 @@ class TestSetupFilters(unittest.TestCase):
         self.assertEqual('CountFilter', source.source.source.__class__.__name__, "count filter is second")
         self.assertEqual('HXLReader', source.source.source.source.__class__.__name__, "reader is first")
 
+    def test_get_source_urls(self):
+        args = {
+            'url': 'http://example.org/data.csv',
+            'filter01': 'merge',
+            'merge-url01': 'http://example.org/merge.csv',
+            'filter02': 'append',
+            'append-dataset02-01': 'http://example.org/append1.csv',
+            'append-dataset02-02': 'http://example.org/append2.csv',
+            'filter03': 'replace-map',
+            'replace-map-url03': 'http://example.org/map.csv',
+            'merge-url04': 'http://example.org/unused.csv'
+        }
+        self.assertEqual([
+            'http://example.org/data.csv',
+            'http://example.org/merge.csv',
+            'http://example.org/append1.csv',
+            'http://example.org/append2.csv',
+            'http://example.org/map.csv'
+        ], get_source_urls(args))
+
+    def test_normalise_args(self):
+        args = {
+            'url': 'http://example.org/data.csv',
+            'strip-headers': '',
+            'filter03': 'column',
+            'cut-include-tags03': 'org',
+            'filter07': 'select',
+            'select-query07-02': 'sector=WASH',
+            'count-tags05': 'adm1'
+        }
+        self.assertEqual({
+            'url': 'http://example.org/data.csv',
+            'filter01': 'cut',
+            'cut-include-tags01': 'org',
+            'filter02': 'select',
+            'select-query02-02': 'sector=WASH'
+        }, normalise_args(args))
+
+    def test_compile_plan(self):
+        args = {
+            'url': 'http://example.org/data.csv',
+            'sheet': '1',
+            'tagger-02-header': 'Sector',
+            'tagger-02-tag': 'sector',
+            'tagger-01-header': 'Organisation',
+            'tagger-01-tag': '#org',
+            'filter02': 'rows',
+            'select-query02-01': 'sector=WASH',
+            'filter05': 'sort',
+            'sort-tags05': 'org,adm1',
+            'sort-reverse05': 'on'
+        }
+        plan = compile_plan(args)
+        self.assertEqual(1, plan.sheet_index)
+        self.assertEqual((('Organisation', '#org'), ('Sector', '#sector')), plan.tagger_specs)
+        self.assertEqual(['select', 'sort'], [step.filter for step in plan.steps])
+        self.assertEqual(('sector=WASH',), plan.steps[0].params['queries'])
+        self.assertEqual(['#org', '#adm1'], [str(tag) for tag in plan.steps[1].params['tags']])
+        self.assertTrue(plan.steps[1].params['reverse'])
+        self.assertEqual(('http://example.org/data.csv',), plan.source_urls)
+        with self.assertRaises(TypeError):
+            plan.steps[1].params['reverse'] = False
+
+    def test_get_plan(self):
+        """Equivalent recipes share one compiled plan."""
+        plan = get_plan({'url': 'http://example.org/data.csv', 'filter01': 'cut', 'cut-include-tags01': 'org'})
+        self.assertIs(plan, get_plan({
+            'url': 'http://example.org/data.csv', 'filter03': 'column', 'cut-include-tags03': 'org', 'name': 'x'
+        }))
+        self.assertIsNot(plan, get_plan({'url': 'http://example.org/data.csv', 'filter01': 'cut', 'cut-include-tags01': 'sector'}))
+
+    def test_unknown_filter(self):
+        with self.assertRaises(Exception):
+            compile_plan({'url': 'http://example.org/data.csv', 'filter01': 'xxx'})
+
     def test_null_recipe(self):
         self.assertIsNone(setup_filters(None), "ok to pass None to setup_filters")
 
@@ -135,6 +212,40 @@ class TestPipelineFunctions(unittest.TestCase):
         self.assertTrue(filter.overwrite)
         #self.assertEquals(args['merge-url11'], filter.merge_source._input) # need to be able to get URL
 
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_add_merge_filter_memoised(self):
+        """A second, separately-built merge against the same lookup table reuses its index, with the same output."""
+        hxl_proxy.fetch.forget(['http://example.org/basic-dataset.csv'])
+        URL_MOCK_OBJECT.reset_mock()
+        args = {
+            'merge-keys01': 'org',
+            'merge-tags01': 'sector',
+            'merge-url01': 'http://example.org/basic-dataset.csv'
+        }
+        for i in range(2):
+            source = hxl.data([['#org'], ['Org C'], ['Org A'], ['Org X']])
+            filter = add_merge_filter(source, args, 1)
+            self.assertEqual([['Org C', 'Health'], ['Org A', 'WASH'], ['Org X', '']], filter.values)
+        self.assertEqual(1, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_add_merge_filter_too_big(self):
+        """A lookup table with more than SIDE_CACHE_MAX_ROWS rows streams, and isn't memoised."""
+        url = 'http://example.org/basic-dataset.csv'
+        hxl_proxy.fetch.forget([url])
+        hxl_proxy.filters._side_indexes.clear()
+        saved = hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS']
+        hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS'] = 2
+        try:
+            args = {'merge-keys01': 'org', 'merge-tags01': 'sector', 'merge-url01': url}
+            filter = add_merge_filter(hxl.data([['#org'], ['Org C']]), args, 1)
+            self.assertEqual([['Org C', 'Health']], filter.values)
+            self.assertIsNone(hxl_proxy.fetch.get_side_data(url))
+            self.assertEqual(0, len(hxl_proxy.filters._side_indexes))
+        finally:
+            hxl_proxy.app.config['SIDE_CACHE_MAX_ROWS'] = saved
+            hxl_proxy.fetch.forget([url])
+
     def test_add_rename_filter(self):
         args = {
             'rename-oldtag08': 'loc-sensitive',
@@ -0,0 +1,44 @@
+"""
+Unit tests for hxl_proxy.memo module
+
+License: Public Domain
+"""
+
+import unittest, time
+from unittest.mock import patch
+
+from hxl_proxy.memo import MemoCache
+
+
+class TestMemoCache(unittest.TestCase):
+
+    def test_get_or_create(self):
+        cache = MemoCache()
+        self.assertEqual('aaa', cache.get_or_create('a', lambda: 'aaa'))
+        self.assertEqual('aaa', cache.get_or_create('a', lambda: 'bbb'))
+
+    def test_ttl(self):
+        cache = MemoCache(ttl=10)
+        cache.set('a', 'aaa')
+        with patch('time.time', return_value=time.time() + 20):
+            self.assertIsNone(cache.get('a'))
+
+    def test_lru(self):
+        cache = MemoCache(max_entries=2)
+        cache.set('a', 'aaa')
+        cache.set('b', 'bbb')
+        cache.get('a') # 'b' is now the oldest
+        cache.set('c', 'ccc')
+        self.assertEqual('aaa', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('ccc', cache.get('c'))
+
+    def test_forget(self):
+        cache = MemoCache()
+        cache.set(('x', 1), 'aaa')
+        cache.set(('y', 1), 'bbb')
+        cache.forget(lambda key: key[0] == 'x')
+        self.assertIsNone(cache.get(('x', 1)))
+        self.assertEqual('bbb', cache.get(('y', 1)))
+
+# end
@@ -0,0 +1,146 @@
+"""
+Unit tests for hxl_proxy.optimiser module
+
+License: Public Domain
+"""
+
+import unittest
+
+import hxl
+from hxl_proxy.filters import FILTER_FUNCTIONS, compile_plan
+
+URL = 'http://example.org/data.csv'
+
+DATA = [
+    ['Organisation', 'Sector', 'Province', 'Code', 'Targeted', 'Reached'],
+    ['#org', '#sector', '#adm1', '#adm1+code', '#targeted', '#reached'],
+    ['Org C', 'WASH', 'Coast', 'X02', '300', '200'],
+    ['Org A', 'Health', 'Coast', 'X02', '100', '80'],
+    ['Org B', 'WASH', 'Hills', 'X01', '50', '50'],
+    ['Org A', 'WASH', 'Hills', 'X01', '300', '250'],
+    ['Org B', 'Education', 'Coast', 'X02', '75', '10'],
+    ['Org A', 'Health', 'Coast', 'X02', '100', '90'],
+]
+
+
+class TestOptimiser(unittest.TestCase):
+
+    def assertSameOutput(self, args, expected_filters):
+        """Check that the optimised plan has the expected steps, and produces the same output."""
+        args = dict(args, url=URL)
+        plan = compile_plan(args)
+        optimised_plan = compile_plan(args, optimise=True)
+        self.assertEqual(expected_filters, [step.filter for step in optimised_plan.steps])
+        self.assertEqual(self._run(plan), self._run(optimised_plan))
+        return optimised_plan
+
+    def test_select_before_sort(self):
+        self.assertSameOutput({
+            'filter01': 'sort',
+            'sort-tags01': 'org',
+            'filter02': 'select',
+            'select-query02-01': 'sector=WASH'
+        }, ['select', 'sort'])
+
+    def test_cut_before_sort(self):
+        self.assertSameOutput({
+            'filter01': 'sort',
+            'sort-tags01': 'adm1+code,org',
+            'filter02': 'cut',
+            'cut-include-tags02': 'org,adm1',
+            'filter03': 'select',
+            'select-query03-01': 'org=Org A'
+        }, ['select', 'cut', 'sort'])
+
+    def test_cut_not_before_sort(self):
+        """Don't cut a column that the sort needs, or any column for a sort on all columns."""
+        self.assertSameOutput({
+            'filter01': 'sort',
+            'sort-tags01': 'sector',
+            'filter02': 'cut',
+            'cut-exclude-tags02': 'sector',
+        }, ['sort', 'cut'])
+        self.assertSameOutput({
+            'filter01': 'sort',
+            'filter02': 'cut',
+            'cut-include-tags02': 'reached'
+        }, ['sort', 'cut'])
+
+    def test_select_not_before_cut(self):
+        """A select on a column that the cut removes must stay after the cut."""
+        self.assertSameOutput({
+            'filter01': 'cut',
+            'cut-exclude-tags01': 'sector',
+            'filter02': 'select',
+            'select-query02-01': 'sector=WASH',
+            'select-reverse02': 'on'
+        }, ['cut', 'select'])
+
+    def test_cut_before_dedup(self):
+        self.assertSameOutput({
+            'filter01': 'dedup',
+            'dedup-tags01': 'org,adm1',
+            'filter02': 'cut',
+            'cut-exclude-tags02': 'targeted,reached'
+        }, ['cut', 'dedup'])
+
+    def test_count_barrier(self):
+        self.assertSameOutput({
+            'filter01': 'count',
+            'count-tags01': 'org',
+            'filter02': 'select',
+            'select-query02-01': 'meta+count>1'
+        }, ['count', 'select'])
+
+    def test_fuse_cuts(self):
+        plan = self.assertSameOutput({
+            'filter01': 'cut',
+            'cut-exclude-tags01': 'targeted',
+            'filter02': 'cut',
+            'cut-include-tags02': 'org,sector,targeted,reached',
+            'filter03': 'cut',
+            'cut-exclude-tags03': 'reached',
+            'filter04': 'cut',
+            'cut-include-tags04': 'org'
+        }, ['cut', 'cut'])
+        self.assertEqual(['#targeted', '#reached'], [str(tag) for tag in plan.steps[0].params['exclude_tags']])
+
+    def test_fuse_renames(self):
+        self.assertSameOutput({
+            'filter01': 'rename',
+            'rename-oldtag01': 'org',
+            'rename-newtag01': 'org+impl',
+            'filter02': 'rename',
+            'rename-oldtag02': 'sector',
+            'rename-newtag02': 'sector+cluster'
+        }, ['rename'])
+        # the second rename applies to the output of the first
+        self.assertSameOutput({
+            'filter01': 'rename',
+            'rename-oldtag01': 'org',
+            'rename-newtag01': 'org+impl',
+            'filter02': 'rename',
+            'rename-oldtag02': 'org',
+            'rename-newtag02': 'org+funder'
+        }, ['rename', 'rename'])
+
+    def test_drop_noops(self):
+        self.assertSameOutput({
+            'filter01': 'select',
+            'select-reverse01': 'on',
+            'filter02': 'cut',
+            'filter03': 'sort',
+            'sort-tags03': 'org'
+        }, ['sort'])
+        # a select with no queries removes every row
+        self.assertSameOutput({
+            'filter01': 'select'
+        }, ['select'])
+
+    def _run(self, plan):
+        source = hxl.data(DATA)
+        for step in plan.steps:
+            source = FILTER_FUNCTIONS[step.filter][1](source, step.params)
+        return list(source.gen_raw())
+
+# end
@@ -0,0 +1,55 @@
+"""
+Unit tests for hxl_proxy.preview module
+
+License: Public Domain
+"""
+
+import unittest
+
+import hxl
+from hxl_proxy.preview import PreviewFilter
+
+
+class TestPreviewFilter(unittest.TestCase):
+
+    def make_source(self, row_count):
+        """Make a dataset that records how many rows were read from it."""
+        self.rows_read = 0
+        def gen_rows():
+            yield ['#org', '#affected']
+            for i in range(row_count):
+                self.rows_read += 1
+                yield ['Org {}'.format(i), str(i)]
+        return hxl.data(hxl.io.HXLReader(_GeneratorInput(gen_rows())))
+
+    def test_stops_early(self):
+        """Don't read past the row that shows there are more."""
+        preview = PreviewFilter(self.make_source(1000), max_rows=5)
+        self.assertEqual(5, len(list(preview)))
+        self.assertTrue(preview.has_more_rows)
+        self.assertIsNone(preview.total_rows)
+        self.assertEqual(6, self.rows_read)
+
+    def test_short_dataset(self):
+        preview = PreviewFilter(self.make_source(3), max_rows=5)
+        self.assertEqual(3, len(list(preview)))
+        self.assertFalse(preview.has_more_rows)
+        self.assertEqual(3, preview.total_rows)
+
+    def test_exact_fit(self):
+        preview = PreviewFilter(self.make_source(5), max_rows=5)
+        self.assertEqual(5, len(list(preview)))
+        self.assertFalse(preview.has_more_rows)
+        self.assertEqual(5, preview.total_rows)
+
+
+class _GeneratorInput(hxl.io.AbstractInput):
+    """Lazy HXL input from a generator of rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __next__(self):
+        return next(self.rows)
+
+# end
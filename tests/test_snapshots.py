@@ -0,0 +1,99 @@
+"""
+Unit tests for hxl_proxy.snapshots module
+
+License: Public Domain
+"""
+
+import json, os, shutil, tempfile
+from unittest.mock import patch
+
+import hxl_proxy
+from hxl_proxy import dao, snapshots
+
+from . import URL_MOCK_TARGET, URL_MOCK_OBJECT
+from .base import BaseControllerTest
+
+
+@patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+class TestSnapshots(BaseControllerTest):
+
+    def setUp(self):
+        super().setUp()
+        hxl_proxy.app.config['SNAPSHOT_DIR'] = tempfile.mkdtemp()
+        hxl_proxy.app.config['SNAPSHOT_CHECK_INTERVAL'] = 0 # no scheduler thread
+        hxl_proxy.app.config['SNAPSHOT_MAX_AGE'] = 3600
+        self.recipe = dao.recipes.read(self.recipe_id)
+        self.recipe['materialise'] = True
+        dao.recipes.update(self.recipe)
+
+    def tearDown(self):
+        shutil.rmtree(hxl_proxy.app.config['SNAPSHOT_DIR'])
+        hxl_proxy.app.config['SNAPSHOT_DIR'] = None
+        super().tearDown()
+
+    def test_refresh(self):
+        self.assertTrue(snapshots.refresh(self.recipe))
+        with open(snapshots.get_snapshot(self.recipe, 'csv'), 'r') as input:
+            self.assertIn('#country', input.read())
+        with open(snapshots.get_snapshot(self.recipe, 'json'), 'r') as input:
+            self.assertIn('#country', json.load(input)[1])
+        self.assertFalse(snapshots.needs_refresh(self.recipe))
+
+    def test_refresh_one_pass(self):
+        """Every format comes from the same pass through the pipeline, with the same output as /data."""
+        with patch('hxl_proxy.filters.setup_filters', wraps=hxl_proxy.filters.setup_filters) as setup_filters:
+            snapshots.refresh(self.recipe)
+            self.assertEqual(1, setup_filters.call_count)
+        for format in snapshots.FORMATS:
+            with open(snapshots.get_snapshot(self.recipe, format), 'rb') as input:
+                snapshot = input.read()
+            live = self.get('/data/{}.{}'.format(self.recipe_id, format), {'force': 'on'}).data
+            self.assertEqual(live, snapshot)
+
+    def test_not_materialised(self):
+        snapshots.refresh(self.recipe)
+        self.recipe['materialise'] = False
+        self.assertIsNone(snapshots.get_snapshot(self.recipe, 'csv'))
+
+    def test_recipe_changed(self):
+        snapshots.refresh(self.recipe)
+        self.recipe['args']['filter01'] = 'sort'
+        self.assertIsNone(snapshots.get_snapshot(self.recipe, 'csv'))
+        self.assertTrue(snapshots.needs_refresh(self.recipe))
+
+    def test_too_old(self):
+        snapshots.refresh(self.recipe)
+        path = os.path.join(hxl_proxy.app.config['SNAPSHOT_DIR'], self.recipe_id, 'meta.json')
+        with open(path, 'r') as input:
+            meta = json.load(input)
+        meta['created'] -= 7200
+        with open(path, 'w') as output:
+            json.dump(meta, output)
+        self.assertTrue(snapshots.needs_refresh(self.recipe))
+        # still served until the new one is ready
+        self.assertIsNotNone(snapshots.get_snapshot(self.recipe, 'csv'))
+
+    def test_show_data(self):
+        snapshots.refresh(self.recipe)
+        with open(snapshots.get_snapshot(self.recipe, 'csv'), 'w') as output:
+            output.write('#org\nFrom the snapshot\n')
+        URL_MOCK_OBJECT.reset_mock()
+        response = self.get('/data/{}.csv'.format(self.recipe_id))
+        self.assertEqual(b'#org\nFrom the snapshot\n', response.data)
+        self.assertEqual('attachment; filename=recipe1.csv', response.headers['Content-Disposition'])
+        self.assertEqual('*', response.headers['Access-Control-Allow-Origin'])
+        URL_MOCK_OBJECT.assert_not_called()
+
+    def test_show_data_without_snapshot(self):
+        with patch('hxl_proxy.snapshots.request_refresh') as request_refresh:
+            self.assertBasicDataset(self.get('/data/{}.csv'.format(self.recipe_id)))
+            request_refresh.assert_called_once_with(self.recipe_id)
+
+    def test_check_all(self):
+        with patch('hxl_proxy.snapshots.request_refresh') as request_refresh:
+            snapshots.check_all()
+            request_refresh.assert_called_once_with(self.recipe_id)
+            request_refresh.reset_mock()
+            snapshots.refresh(self.recipe)
+            snapshots.check_all()
+            request_refresh.assert_not_called()
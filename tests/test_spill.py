@@ -0,0 +1,113 @@
+"""
+Unit tests for hxl_proxy.spill module
+
+License: Public Domain
+"""
+
+import unittest
+from unittest.mock import patch
+
+import hxl
+from hxl_proxy import app, filters, spill
+
+DATA = [
+    ['Organisation', 'Sector', 'Province', 'Date', 'Targeted', 'Reached'],
+    ['#org', '#sector', '#adm1', '#date', '#targeted', '#reached'],
+    ['Org C', 'WASH', 'Coast', '2017-03-01', '300', '200'],
+    ['Org A', 'Health', ' coast', 'Feb 1 2017', '100', '80'],
+    ['Org B', 'WASH', 'Hills', '2017-01-15', '50', 'n/a'],
+    ['org a', 'WASH', 'Hills', '', '300', '250'],
+    ['Org B', 'Education', 'Coast', 'unknown', '75', ''],
+    ['Org A', 'Health', 'Coast', '2017-02-01', '100', '90'],
+    ['Org D', '', 'Coast', '2017-01-15', '1e3', '10'],
+    ['Org A', 'Health', 'Coast', '2017-02-01', '100', '90'],
+    ['Org E', 'WASH', 'Lake', '', '', ''],
+]
+
+# budgets small enough to make every filter spill, and one big enough not to
+BUDGETS = (1, 2, 3, 1000)
+
+
+class TestSpill(unittest.TestCase):
+
+    def assertSameRows(self, expected, actual):
+        """Check that two filters (each with its own source) produce the same columns and rows."""
+        self.assertEqual([column.display_tag for column in expected.columns], [column.display_tag for column in actual.columns])
+        self.assertEqual(expected.values, actual.values)
+
+    def test_sort(self):
+        for max_rows in BUDGETS:
+            for tags in (['org'], ['adm1', 'targeted'], ['date'], ['sector'], []):
+                for reverse in (False, True):
+                    self.assertSameRows(
+                        hxl.data(DATA).sort(tags, reverse),
+                        spill.SpillingSortFilter(hxl.data(DATA), tags, reverse, max_rows=max_rows)
+                    )
+
+    def test_count(self):
+        for max_rows in BUDGETS:
+            for tags in (['adm1'], ['org', 'adm1'], ['sector'], []):
+                for aggregate in (None, 'targeted', 'reached'):
+                    self.assertSameRows(
+                        hxl.data(DATA).count(tags, aggregate_pattern=aggregate),
+                        spill.SpillingCountFilter(hxl.data(DATA), tags, aggregate_pattern=aggregate, max_rows=max_rows)
+                    )
+
+    def test_count_queries(self):
+        self.assertSameRows(
+            hxl.data(DATA).count('sector', queries='adm1=coast'),
+            spill.SpillingCountFilter(hxl.data(DATA), 'sector', queries='adm1=coast', max_rows=1)
+        )
+
+    def test_dedup(self):
+        for max_rows in BUDGETS:
+            for tags in (['org'], ['sector', 'adm1'], ['date'], []):
+                self.assertSameRows(
+                    hxl.data(DATA).dedup(tags),
+                    spill.SpillingDedupFilter(hxl.data(DATA), tags, max_rows=max_rows)
+                )
+
+    def test_dedup_queries(self):
+        self.assertSameRows(
+            hxl.data(DATA).dedup('org', queries='sector=WASH'),
+            spill.SpillingDedupFilter(hxl.data(DATA), 'org', queries='sector=WASH', max_rows=1)
+        )
+
+    def test_sort_records(self):
+        records = [(key, n) for n, key in enumerate([3, 1, 2, 1, 3, 2, 1])]
+        for max_rows in (None, 1, 2, 3):
+            self.assertEqual(
+                sorted(records, key=lambda record: record[0]),
+                list(spill.sort_records(iter(records), max_rows=max_rows))
+            )
+            self.assertEqual(
+                sorted(records, key=lambda record: record[0], reverse=True),
+                list(spill.sort_records(iter(records), reverse=True, max_rows=max_rows))
+            )
+
+    def test_sort_records_passes(self):
+        """Sorting still works (and stays stable) when the runs merge in several passes."""
+        records = [(key, n) for n, key in enumerate([(n * 7) % 11 for n in range(200)])]
+        for fan_in in (2, 3, 16):
+            with patch.object(spill, 'FAN_IN', fan_in):
+                for max_rows in (1, 2, 5):
+                    for reverse in (False, True):
+                        self.assertEqual(
+                            sorted(records, key=lambda record: record[0], reverse=reverse),
+                            list(spill.sort_records(iter(records), reverse=reverse, max_rows=max_rows))
+                        )
+
+    def test_config(self):
+        """The pipeline uses these filters only when SPILL_MAX_ROWS is set."""
+        params = {'tags': hxl.TagPattern.parse_list('org'), 'reverse': False}
+        saved = app.config.get('SPILL_MAX_ROWS')
+        try:
+            app.config['SPILL_MAX_ROWS'] = 0
+            self.assertNotIsInstance(filters.apply_sort_filter(hxl.data(DATA), params), spill.SpillingSortFilter)
+            app.config['SPILL_MAX_ROWS'] = 2
+            sort_filter = filters.apply_sort_filter(hxl.data(DATA), params)
+            self.assertIsInstance(sort_filter, spill.SpillingSortFilter)
+            self.assertEqual(2, sort_filter.max_rows)
+            self.assertIsInstance(filters.apply_dedup_filter(hxl.data(DATA), params), spill.SpillingDedupFilter)
+        finally:
+            app.config['SPILL_MAX_ROWS'] = saved
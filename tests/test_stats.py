@@ -0,0 +1,65 @@
+"""
+Unit tests for the hxl_proxy.stats module
+
+License: Public Domain
+"""
+
+import unittest
+
+import hxl
+from hxl_proxy import stats
+from hxl_proxy.filters import compile_plan
+
+from . import URL_MOCK_TARGET, URL_MOCK_OBJECT
+from unittest.mock import patch
+from .base import BaseControllerTest
+
+DATASET_URL = 'http://example.org/basic-dataset.csv'
+
+
+class TestMakeStats(BaseControllerTest):
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_stages(self):
+        result = stats.make_stats(compile_plan({
+            'url': DATASET_URL,
+            'filter01': 'select', 'select-query01-01': 'sector!=WASH',
+            'filter02': 'cut', 'cut-include-tags02': 'org'
+        }))
+        self.assertEqual(['input', 'select', 'cut'], [stage['filter'] for stage in result['stages']])
+        self.assertEqual([3, 2, 2], [stage['rows'] for stage in result['stages']])
+        self.assertEqual(['#org'], [column['tag'] for column in result['stages'][2]['columns']])
+        org = result['stages'][1]['columns'][0]
+        self.assertEqual(2, org['distinct'])
+        self.assertEqual(('Org B', 'Org C'), (org['min'], org['max']))
+
+
+class TestColumnStats(unittest.TestCase):
+
+    def make_stats(self, values, max_distinct=None):
+        column_stats = stats.ColumnStats(hxl.model.Column.parse('#affected'), max_distinct)
+        for value in values:
+            column_stats.add(value)
+        return column_stats.to_dict()
+
+    def test_numbers(self):
+        """Numbers compare as numbers, not strings."""
+        result = self.make_stats(['9', '10', '', '10'])
+        self.assertEqual(2, result['distinct'])
+        self.assertEqual((9, 10), (result['min'], result['max']))
+
+    def test_strings(self):
+        result = self.make_stats(['9', 'ten'])
+        self.assertEqual(('9', 'ten'), (result['min'], result['max']))
+
+    def test_empty(self):
+        result = self.make_stats(['', None])
+        self.assertEqual(0, result['distinct'])
+        self.assertIsNone(result['min'])
+
+    def test_max_distinct(self):
+        result = self.make_stats(['a', 'b', 'A', 'c', 'd'], max_distinct=2)
+        self.assertEqual(2, result['distinct'])
+        self.assertTrue(result['distinct_capped'])
+        result = self.make_stats(['a', 'b', 'A'], max_distinct=2)
+        self.assertFalse(result['distinct_capped'])
@@ -0,0 +1,47 @@
+"""
+Unit tests for the hxl_proxy.upstream module
+
+License: Public Domain
+"""
+
+import unittest
+from unittest.mock import patch, Mock
+
+import hxl_proxy
+from hxl_proxy import upstream
+
+
+class TestUpstream(unittest.TestCase):
+
+    def test_shared_session(self):
+        session = upstream.get_session()
+        self.assertIs(session, upstream.get_session())
+        adapter = session.get_adapter('https://data.example.org/')
+        self.assertEqual(hxl_proxy.app.config['UPSTREAM_RETRIES'], adapter.max_retries.total)
+
+    def test_default_timeout(self):
+        with patch.object(upstream.get_session(), 'request') as request:
+            upstream.request('GET', 'https://data.example.org/data.csv')
+            self.assertEqual(hxl_proxy.app.config['UPSTREAM_TIMEOUT'], request.call_args[1]['timeout'])
+            upstream.request('GET', 'https://data.example.org/data.csv', timeout=1)
+            self.assertEqual(1, request.call_args[1]['timeout'])
+
+    def test_open_url(self):
+        raw = Mock()
+        with patch.object(upstream.get_session(), 'request', return_value=Mock(status_code=200, raw=raw)) as request:
+            self.assertIs(raw, upstream.open_url('https://data.example.org/data.csv'))
+            self.assertTrue(request.call_args[1]['stream'])
+            self.assertTrue(raw.decode_content)
+
+    def test_open_url_error(self):
+        response = Mock(status_code=404)
+        with patch.object(upstream.get_session(), 'request', return_value=response):
+            with self.assertRaises(IOError):
+                upstream.open_url('https://data.example.org/data.csv')
+        self.assertTrue(response.close.called)
+
+    def test_no_local_files(self):
+        with self.assertRaises(IOError):
+            upstream.open_url('/etc/passwd')
+
+# end
@@ -14,13 +14,39 @@ class TestUtil(unittest.TestCase):
 
     def test_make_cache_key(self):
         """Test making a cache key for a set of arguments."""
-        import pickle
         with hxl_proxy.app.test_request_context('/data?a=aa&b=bb&force=1'):
+            key = hxl_proxy.util.make_cache_key()
+            self.assertEqual(len('data:') + 64, len(key))
             # force should be skipped
-            args_out = {'a': 'aa', 'b': 'bb'}
-            # this could fail in the future because key ordering isn't predictable
-            expected = '/data' + pickle.dumps(args_out).decode('latin1')
-            self.assertEqual(expected, hxl_proxy.util.make_cache_key())
+            self.assertEqual(key, hxl_proxy.util.make_cache_key('/data', {'a': 'aa', 'b': 'bb'}))
+            # order and empty values don't matter
+            self.assertEqual(key, hxl_proxy.util.make_cache_key('/data', OrderedDict([('b', 'bb'), ('c', ''), ('a', 'aa')])))
+            # but values and paths do
+            self.assertNotEqual(key, hxl_proxy.util.make_cache_key('/data', {'a': 'aa', 'b': 'cc'}))
+            self.assertNotEqual(key, hxl_proxy.util.make_cache_key('/data.csv', {'a': 'aa', 'b': 'bb'}))
+
+    def test_make_cache_key_filters(self):
+        """Equivalent recipes with different filter numbering should share a key."""
+        args1 = {
+            'url': 'http://example.org/data.csv',
+            'filter01': 'select',
+            'select-query01-01': 'org=UNICEF',
+            'filter02': 'count',
+            'count-tags02': 'adm1'
+        }
+        args2 = {
+            'url': 'http://example.org/data.csv',
+            'filter02': 'rows',
+            'select-query02-01': 'org=UNICEF',
+            'select-query02-02': '',
+            'sort-tags03': 'adm1',
+            'filter05': 'count',
+            'count-tags05': 'adm1'
+        }
+        self.assertEqual(
+            hxl_proxy.util.make_cache_key('/data.csv', args1),
+            hxl_proxy.util.make_cache_key('/data.csv', args2)
+        )
 
     def test_skip_cache_p(self):
         """Check if there's a force argument for cache skipping."""
@@ -34,6 +60,14 @@ class TestUtil(unittest.TestCase):
         self.assertEqual('foo bar', hxl_proxy.util.strnorm('  foo   Bar   '))
         self.assertEqual('foo bar', hxl_proxy.util.strnorm("  foO\nBar   "))
 
+    def test_to_number(self):
+        """Test parsing cell values as numbers."""
+        self.assertEqual(200, hxl_proxy.util.to_number(' 200 '))
+        self.assertIsInstance(hxl_proxy.util.to_number('2e2'), int)
+        self.assertEqual(1.5, hxl_proxy.util.to_number('1.5'))
+        for value in ('', 'n/a', 'nan', 'inf', None):
+            self.assertIsNone(hxl_proxy.util.to_number(value))
+
     # skip stream_template
 
     def test_urlquote(self):
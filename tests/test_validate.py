@@ -0,0 +1,179 @@
+"""
+Unit tests for the hxl_proxy.validate module
+
+License: Public Domain
+"""
+
+import time
+from unittest.mock import patch
+
+import hxl
+import hxl_proxy
+from hxl_proxy import validate
+
+from . import URL_MOCK_TARGET, URL_MOCK_OBJECT
+from .base import BaseControllerTest
+
+DATASET_URL = 'http://example.org/basic-dataset.csv'
+SCHEMA_URL = 'http://example.org/bad-schema.csv'
+
+
+class TestValidate(BaseControllerTest):
+
+    def setUp(self):
+        super().setUp()
+        self.saved_config = dict(hxl_proxy.app.config)
+        URL_MOCK_OBJECT.reset_mock()
+
+    def tearDown(self):
+        hxl_proxy.app.config.update(self.saved_config)
+        super().tearDown()
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_errors(self):
+        errors = validate.get_errors({'args': {'url': DATASET_URL}}, SCHEMA_URL)
+        self.assertEqual(2, len(errors))
+        values = sorted(error['value'] for summary in errors.values() for error in summary['examples'])
+        self.assertEqual(['Education', 'Myanmar'], values)
+        self.assertEqual([1, 1], [summary['count'] for summary in errors.values()])
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_severity(self):
+        errors = validate.get_errors({'args': {'url': DATASET_URL}}, SCHEMA_URL, 'error')
+        self.assertEqual(['Unknown country'], [errors[key]['rule']['description'] for key in errors])
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_max_examples(self):
+        """Count every error, but keep only the first few."""
+        source = hxl.data([['#sector']] + [['Education']] * 50)
+        errors = validate.do_validate(source, SCHEMA_URL, max_examples=5)
+        summary = list(errors.values())[0]
+        self.assertEqual(50, summary['count'])
+        self.assertEqual(5, len(summary['examples']))
+        self.assertEqual([0, 1, 2, 3, 4], [error['row_number'] for error in summary['examples']])
+        self.assertEqual('#sector', summary['examples'][0]['column'])
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_processes(self):
+        """Validating chunks in worker processes gives the same summary as one pass."""
+        rows = [['#org', '#sector', '#country']] + [
+            ['Org {}'.format(i), ['WASH', 'Education', 'Health'][i % 3], ['Colombia', 'Myanmar'][i % 2]]
+            for i in range(25)
+        ]
+        def summarise(errors):
+            # messages list the allowed values in set order, which varies between processes
+            return {
+                rule_hash: (summary['count'], [(error['row_number'], error['value']) for error in summary['examples']])
+                for rule_hash, summary in errors.items()
+            }
+        expected = validate.do_validate(hxl.data(rows), SCHEMA_URL, max_examples=4)
+        hxl_proxy.app.config['VALIDATION_PROCESSES'] = 2
+        hxl_proxy.app.config['VALIDATION_CHUNK_SIZE'] = 3
+        actual = validate.do_validate(hxl.data(rows), SCHEMA_URL, max_examples=4)
+        self.assertEqual(summarise(expected), summarise(actual))
+        self.assertEqual(list(expected), list(actual))
+        self.assertFalse(validate.do_validate(hxl.data(rows[:1]), SCHEMA_URL))
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_error_page(self):
+        """Pages past the examples come from validating again."""
+        hxl_proxy.app.config['VALIDATION_MAX_EXAMPLES'] = 1
+        recipe = {'args': {'url': DATASET_URL, 'filter01': 'append', 'append-dataset01-01': DATASET_URL}}
+        errors = validate.get_errors(recipe, SCHEMA_URL)
+        rule_hash = [key for key in errors if errors[key]['rule']['description'] == 'Unknown country'][0]
+        self.assertEqual(2, errors[rule_hash]['count'])
+        self.assertEqual(1, len(errors[rule_hash]['examples']))
+        page = validate.get_error_page(recipe, SCHEMA_URL, None, rule_hash, page=2, page_size=1)
+        self.assertEqual([5], [error['row_number'] for error in page])
+        self.assertEqual([], validate.get_error_page(recipe, SCHEMA_URL, None, rule_hash, page=3, page_size=1))
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_cached_report(self):
+        """The same data and schema don't get validated (or downloaded) again."""
+        recipe = {'args': {'url': DATASET_URL}}
+        errors = validate.get_errors(recipe, SCHEMA_URL)
+        call_count = URL_MOCK_OBJECT.call_count
+        with patch('hxl_proxy.validate.do_validate') as do_validate:
+            self.assertEqual(errors, validate.get_errors(recipe, SCHEMA_URL))
+            self.assertFalse(do_validate.called)
+        self.assertEqual(call_count, URL_MOCK_OBJECT.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_compiled_schema(self):
+        """The schema compiles once, but each request gets its own rules and callback."""
+        validate._schemas.clear()
+        callback1, callback2 = (lambda error: None), (lambda error: None)
+        with patch('hxl.schema', wraps=hxl.schema) as schema:
+            schema1 = validate.get_schema(SCHEMA_URL, callback1)
+            schema2 = validate.get_schema(SCHEMA_URL, callback2)
+            self.assertEqual(1, schema.call_count)
+        self.assertIs(callback1, schema1.callback)
+        self.assertIs(callback2, schema2.callback)
+        self.assertIsNot(schema1.rules[0], schema2.rules[0])
+        self.assertIs(schema1.rules[0].enum, schema2.rules[0].enum)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_schema_revalidation(self):
+        """A compiled schema is read again only after FETCH_CACHE_FRESHNESS, and only if it changed."""
+        validate._schemas.clear()
+        hxl_proxy.app.config['FETCH_CACHE_FRESHNESS'] = 60
+        now = time.time()
+        with patch('hxl.schema', wraps=hxl.schema) as schema:
+            validate.get_schema(SCHEMA_URL, None)
+            call_count = URL_MOCK_OBJECT.call_count
+            with patch('time.time', return_value=now + 30), patch('hxl_proxy.fetch.is_modified') as is_modified:
+                validate.get_schema(SCHEMA_URL, None)
+                self.assertFalse(is_modified.called)
+            self.assertEqual(call_count, URL_MOCK_OBJECT.call_count)
+
+            # the mock server sends no validators, so there's nothing to ask with
+            with patch('time.time', return_value=now + 90):
+                validate.get_schema(SCHEMA_URL, None)
+            self.assertEqual(2, schema.call_count)
+
+            # with validators, a HEAD request is enough
+            validate._schemas.set(SCHEMA_URL, validate._schemas.get(SCHEMA_URL)._replace(validators={'etag': '"x"'}, checked=now))
+            with patch('time.time', return_value=now + 90), patch('hxl_proxy.fetch.is_modified', return_value=False) as is_modified:
+                validate.get_schema(SCHEMA_URL, None)
+                is_modified.assert_called_once_with(SCHEMA_URL, {'etag': '"x"'})
+            self.assertEqual(2, schema.call_count)
+            with patch('time.time', return_value=now + 200), patch('hxl_proxy.fetch.is_modified', return_value=True):
+                validate.get_schema(SCHEMA_URL, None)
+            self.assertEqual(3, schema.call_count)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    @patch('hxl_proxy.fetch.get_validators', return_value={'etag': '"x"'})
+    def test_report_key(self, get_validators):
+        """The key follows the recipe, the schema, and the severity, without reading data that has validators."""
+        args = {'url': DATASET_URL}
+        key = validate.make_report_key(args, SCHEMA_URL)
+        self.assertEqual(key, validate.make_report_key(args, SCHEMA_URL))
+        self.assertNotEqual(key, validate.make_report_key(args, SCHEMA_URL, 'error'))
+        self.assertNotEqual(key, validate.make_report_key(args, 'http://example.org/good-schema.csv'))
+        self.assertNotEqual(key, validate.make_report_key(dict(args, filter01='sort'), SCHEMA_URL))
+        self.assertFalse(URL_MOCK_OBJECT.called)
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_report_key_fingerprint(self):
+        """Without upstream validators, the key follows the content of the data and the schema."""
+        args = {'url': DATASET_URL}
+        key = validate.make_report_key(args, SCHEMA_URL)
+        self.assertEqual(key, validate.make_report_key(args, SCHEMA_URL))
+        get_fingerprint = hxl_proxy.fetch.get_fingerprint
+        for changed_url in (DATASET_URL, SCHEMA_URL):
+            fingerprint = lambda url: 'changed' if url == changed_url else get_fingerprint(url)
+            with patch('hxl_proxy.fetch.get_fingerprint', side_effect=fingerprint):
+                self.assertNotEqual(key, validate.make_report_key(args, SCHEMA_URL))
+
+    @patch(URL_MOCK_TARGET, new=URL_MOCK_OBJECT)
+    def test_report_invalidated(self):
+        """A stored report doesn't survive a change to its data or schema."""
+        recipe = {'args': {'url': DATASET_URL}}
+        errors = validate.get_errors(recipe, SCHEMA_URL)
+        for url in (DATASET_URL, SCHEMA_URL):
+            hxl_proxy.caching.invalidate_urls([url])
+            with patch('hxl_proxy.validate.do_validate', return_value=errors) as do_validate:
+                validate.get_errors(recipe, SCHEMA_URL)
+                self.assertTrue(do_validate.called)
+
+# end